@@ -3,23 +3,51 @@
 """ papper cli """
 
 import argparse
-from .bibliography import cli as bibliography_cli
+from .bibliography import cli as bibliography_cli, batch_cli, index_cli, \
+    serve_cli, store_cli, citations_cli, worker_cli, deferred_cli
 
 
 def parse_papper_options():
     parser = argparse.ArgumentParser(description='Process bibliography:'
                                                  ' convert bbl to bibtex'
                                                  ' format')
-    parser.add_argument('bib', default=False, action='store_true',
-                        help='Convert bbl format to bibtex')
-    return parser.parse_known_args()[0]
+    parser.add_argument('command',
+                        choices=('bib', 'batch', 'index', 'serve', 'store',
+                                 'citations', 'worker', 'deferred'),
+                        help='bib: convert bbl format to bibtex;'
+                             ' batch: convert a corpus of papers;'
+                             ' index: build a local DOI index;'
+                             ' serve: run the bibliography HTTP API;'
+                             ' store: look up stored entries;'
+                             ' citations: query the citation graph;'
+                             ' worker: resolve the papers read from'
+                             ' stdin;'
+                             ' deferred: resolve again the references'
+                             ' deferred by a deadline')
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='Command arguments')
+    return parser.parse_args()
 
 
 def papper_cli():
     options = parse_papper_options()
 
-    if options.bib:
-        bibliography_cli()
+    if options.command == 'bib':
+        bibliography_cli(options.args)
+    elif options.command == 'batch':
+        batch_cli(options.args)
+    elif options.command == 'index':
+        index_cli(options.args)
+    elif options.command == 'serve':
+        serve_cli(options.args)
+    elif options.command == 'store':
+        store_cli(options.args)
+    elif options.command == 'citations':
+        citations_cli(options.args)
+    elif options.command == 'worker':
+        worker_cli(options.args)
+    elif options.command == 'deferred':
+        deferred_cli(options.args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+
+""" benchmarks of the bibliography pipeline on synthetic papers """
+
+from .corpus import CorpusGenerator
+from .stages import StubSession, measure, run_stages
+from .stub import StubServer
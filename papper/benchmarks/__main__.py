@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+""" cli interface for benchmarks """
+
+import argparse
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from .corpus import (CorpusGenerator, DEFAULT_FILES, DEFAULT_BIBITEMS,
+                     DEFAULT_ACCENTS, DEFAULT_PARAGRAPHS)
+from .stages import run_stages, DEFAULT_REPEAT
+
+
+def parse_benchmark_options(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark each bbl2bib'
+                                                 ' stage on a synthetic'
+                                                 ' corpus')
+    parser.add_argument('-o', '--output', type=str, default='-',
+                        help='Path to the JSON results (defaults to stdout)')
+    parser.add_argument('--papers', type=int, default=20,
+                        help='Number of generated papers')
+    parser.add_argument('--files', type=int, default=DEFAULT_FILES,
+                        help='Number of tex files per paper')
+    parser.add_argument('--bibitems', type=int, default=DEFAULT_BIBITEMS,
+                        help='Number of references per paper')
+    parser.add_argument('--paragraphs', type=int, default=DEFAULT_PARAGRAPHS,
+                        help='Number of paragraphs per tex file')
+    parser.add_argument('--external', action='store_true',
+                        help='Write bibliographies in bbl files rather than'
+                             ' inline')
+    parser.add_argument('--accents', type=float, default=DEFAULT_ACCENTS,
+                        help='Share of author name letters written as LaTeX'
+                             ' accents')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the corpus generator')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='Number of timed runs per stage (best is kept)')
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='Simulated latency (in seconds) of each stubbed'
+                             ' resolution request')
+    parser.add_argument('--corpus', type=str, default=None,
+                        help='Folder receiving the generated corpus (kept);'
+                             ' a temporary folder is used by default')
+    return parser.parse_args(args)
+
+
+def benchmark(args=None):
+    options = parse_benchmark_options(args)
+    parameters = dict((key, getattr(options, key))
+                      for key in ('papers', 'files', 'bibitems', 'paragraphs',
+                                  'external', 'accents', 'seed', 'repeat',
+                                  'latency'))
+    root = options.corpus or tempfile.mkdtemp(prefix='papper-benchmark-')
+    try:
+        CorpusGenerator(seed=options.seed, files=options.files,
+                        bibitems=options.bibitems,
+                        inline=not options.external,
+                        accents=options.accents,
+                        paragraphs=options.paragraphs).corpus(root,
+                                                              options.papers)
+        results = {
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': parameters,
+            'stages': run_stages(root, repeat=options.repeat,
+                                 latency=options.latency),
+        }
+    finally:
+        if options.corpus is None:
+            shutil.rmtree(root)
+
+    output = sys.stdout if options.output == '-' \
+        else open(options.output, 'w')
+    try:
+        json.dump(results, output, indent=2, sort_keys=True)
+        output.write('\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+benchmark()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+""" deterministic generator of synthetic arXiv-like paper trees """
+
+import os
+import random
+
+from ..bibliography.latex import LATEX_SYMBOLS
+
+
+DEFAULT_FILES = 4
+DEFAULT_BIBITEMS = 40
+DEFAULT_ACCENTS = 0.05
+DEFAULT_PARAGRAPHS = 20
+
+WORDS = ('quantum', 'field', 'theory', 'lattice', 'gauge', 'spin', 'chain',
+         'model', 'random', 'matrix', 'entropy', 'black', 'hole', 'dark',
+         'matter', 'energy', 'cosmic', 'inflation', 'neural', 'network',
+         'graph', 'algorithm', 'complexity', 'bound', 'sparse', 'signal',
+         'recovery', 'boundary', 'conformal', 'symmetry', 'breaking',
+         'topological', 'phase', 'transition', 'scattering', 'amplitude')
+NAMES = ('Smith', 'Muller', 'Erdos', 'Wang', 'Garcia', 'Ivanov', 'Tanaka',
+         'Kowalski', 'Dubois', 'Rossi', 'Nguyen', 'Andersson', 'Cohen',
+         'Schmidt', 'Novak', 'Silva', 'Horvath', 'Kumar', 'Okafor', 'Lee')
+VENUES = ('Phys. Rev. Lett.', 'Phys. Rev. B', 'Phys. Rev. D', 'JHEP',
+          'Nucl. Phys. B', 'Ann. Math.', 'Comm. Math. Phys.', 'J. ACM',
+          'IEEE Trans. Inf. Theory', 'Astrophys. J.')
+
+# accented letters, by plain letter, e.g. 'e': ["\\'e", '\\"e', ...]
+_accents = {}
+for _latex, _ in LATEX_SYMBOLS:
+    if len(_latex) == 3 and _latex[0] == '\\' and _latex[2].isalpha():
+        _accents.setdefault(_latex[2], []).append(_latex)
+
+
+class CorpusGenerator(object):
+    """
+    Write synthetic papers: `files` tex files, a bibliography of `bibitems`
+    references either inline (thebibliography in the main file) or external
+    (a bbl file included with \\bibliography), with a share `accents` of the
+    letters of author names written as LaTeX accents. A given `seed` always
+    produces the same tree.
+
+    >>> generator = CorpusGenerator(seed=1, bibitems=2, accents=0.)
+    >>> print(generator.bibitem(1))
+    \\bibitem{ref1} W.~Silva, \\newblock {\\em Lattice field breaking energy boundary quantum cosmic signal random}, \\newblock Astrophys. J. \\textbf{109}, 306 (1951).
+    """
+    def __init__(self, seed=0, files=DEFAULT_FILES, bibitems=DEFAULT_BIBITEMS,
+                 inline=True, accents=DEFAULT_ACCENTS,
+                 paragraphs=DEFAULT_PARAGRAPHS):
+        self.random = random.Random(seed)
+        self.files = max(1, files)
+        self.bibitems = bibitems
+        self.inline = inline
+        self.accents = accents
+        self.paragraphs = paragraphs
+
+    def _accented(self, word):
+        choices = self.random.random
+        return ''.join(self.random.choice(_accents[char])
+                       if char in _accents and choices() < self.accents
+                       else char
+                       for char in word)
+
+    def _words(self, count):
+        return ' '.join(self.random.choice(WORDS) for _ in xrange(count))
+
+    def author(self):
+        initial = chr(ord('A') + self.random.randrange(26))
+        return '{}.~{}'.format(initial,
+                               self._accented(self.random.choice(NAMES)))
+
+    def bibitem(self, number):
+        authors = ' and '.join(self.author()
+                               for _ in xrange(self.random.randint(1, 4)))
+        title = self._words(self.random.randint(3, 10)).capitalize()
+        return ('\\bibitem{{ref{}}} {}, \\newblock {{\\em {}}}, \\newblock '
+                '{} \\textbf{{{}}}, {} ({}).'.format(
+                    number, authors, title, self.random.choice(VENUES),
+                    self.random.randint(1, 120),
+                    self.random.randint(1, 9999),
+                    self.random.randint(1950, 2015)))
+
+    def bibliography(self):
+        lines = ['\\begin{thebibliography}{99}']
+        lines.extend(self.bibitem(number) for number in xrange(self.bibitems))
+        lines.append('\\end{thebibliography}')
+        return '\n\n'.join(lines) + '\n'
+
+    def section(self, number):
+        paragraphs = ['\\section{{{}}}'.format(self._words(3))]
+        paragraphs.extend('{} \\cite{{ref{}}}.'.format(
+            self._words(80), self.random.randrange(max(1, self.bibitems)))
+            for _ in xrange(self.paragraphs))
+        return '\n\n'.join(paragraphs) + '\n'
+
+    def paper(self, path):
+        """ write a paper in the `path` folder; return the written files """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        contents = {}
+        sections = ['section{}.tex'.format(number)
+                    for number in xrange(1, self.files)]
+        main = ['\\documentclass{article}', '\\begin{document}',
+                self.section(0)]
+        main.extend('\\input{{{}}}'.format(os.path.splitext(section)[0])
+                    for section in sections)
+        if self.inline:
+            main.append(self.bibliography())
+        else:
+            main.append('\\bibliography{main}')
+            contents['main.bbl'] = self.bibliography()
+        main.append('\\end{document}\n')
+        contents['main.tex'] = '\n'.join(main)
+        for number, section in enumerate(sections, 1):
+            contents[section] = self.section(number)
+
+        for filename, content in sorted(contents.items()):
+            with open(os.path.join(path, filename), 'w') as output:
+                output.write(content)
+        return sorted(contents)
+
+    def corpus(self, root, papers):
+        """ write `papers` papers under `root`; return their folders """
+        folders = [os.path.join(root, '{:04d}.{:05d}'.format(1501, number))
+                   for number in xrange(papers)]
+        for folder in folders:
+            self.paper(folder)
+        return folders
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+""" microbenchmarks of each bbl2bib stage and of the whole pipeline """
+
+import gc
+import os
+import re
+import time
+
+from ..bibliography import bbl2bib
+from ..bibliography.bibliography import Article
+from ..bibliography.includes import IncludeGraph, scan_document
+from ..bibliography.latex import LATEX_SYMBOLS, unlatexify
+from ..bibliography.metrics import Metrics
+from ..bibliography.sources import open_source
+
+
+DEFAULT_REPEAT = 3
+# blanks and \newblock collapsed by the unlatexify baseline
+_newblock = re.compile(r'\\newblock')
+_blanks = re.compile(r'\s+')
+
+
+class StubResponse(object):
+    ok = True
+    status_code = 200
+    content = '{}'
+
+    def raise_for_status(self):
+        pass
+
+
+class StubSession(object):
+    """
+    Stands for the HTTP session: every request finds no match after
+    `latency` seconds so that references fall back to the local parser.
+    """
+    def __init__(self, latency=0.):
+        self.latency = latency
+        self.requests = 0
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return StubResponse()
+
+    def post(self, url, **kwargs):
+        return self.get(url, **kwargs)
+
+
+class NullOutput(object):
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def measure(function, items, size=None, repeat=DEFAULT_REPEAT):
+    """
+    Best of `repeat` timings of `function()`, which processes `items` items
+    (and `size` bytes). Garbage collection is disabled while timing.
+
+    >>> result = measure(lambda: sum(xrange(1000)), items=1000, repeat=2)
+    >>> sorted(result)
+    ['items', 'items/s', 'mean', 'runs', 'seconds']
+    """
+    timings = []
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in xrange(repeat):
+            start = time.time()
+            function()
+            timings.append(time.time() - start)
+    finally:
+        if enabled:
+            gc.enable()
+    best = max(min(timings), 1e-9)
+    result = {'seconds': best, 'mean': sum(timings) / len(timings),
+              'runs': repeat, 'items': items, 'items/s': items / best}
+    if size is not None:
+        result['bytes'] = size
+        result['MB/s'] = size / best / 1e6
+    return result
+
+
+def list_files(papers, extensions):
+    """ tex/bbl files of each paper, as listed by iter_bib """
+    return [(source, list(source.filenames(extensions=extensions)))
+            for source in map(open_source, papers)]
+
+
+def read_bibliographies(sources, metrics=None):
+    """ bibliography lines of each document, as read by iter_bib """
+    bibliographies = []
+    for source, filenames in sources:
+        graph = IncludeGraph(source, filenames, metrics=metrics)
+        bibliographies.extend(list(graph.lines(document))
+                              for document in graph.documents())
+    return bibliographies
+
+
+def read_contents(sources):
+    """ content of every tex/bbl file, read once """
+    contents = []
+    for source, filenames in sources:
+        for filename in filenames:
+            with source.mapped(filename) as content:
+                contents.append(content[:])
+    return contents
+
+
+def scan_lines(content):
+    """
+    Baseline of scan_document: the former extractor classified each line
+    with several str.find calls.
+
+    >>> list(scan_lines('\\\\begin{thebibliography}{9}\\n\\\\bibitem{a} A\\n'
+    ...                 '%c\\n\\\\end{thebibliography}\\n'))
+    ['\\\\bibitem{a} A\\n']
+    """
+    biblio = False
+    for line in content.splitlines(True):
+        if line.find(r'\begin{thebibliography}') != -1:
+            biblio = True
+        elif line.find(r'\end{thebibliography}') != -1:
+            biblio = False
+        elif line.startswith('%'):
+            continue
+        elif (line.find(r'\input{') != -1 and line.find('.bbl}') != -1) or \
+                line.find(r'\bibliography{') != -1:
+            continue
+        elif biblio:
+            yield line
+
+
+def replace_symbols(content):
+    """
+    Baseline of unlatexify: the former implementation collapsed blanks and
+    \\newblock, then chained one str.replace per LaTeX symbol.
+
+    >>> replace_symbols('M\\\\"uller \\\\newblock  and')
+    'M\\xc3\\xbcller and'
+    """
+    content = _blanks.sub(' ', _newblock.sub(' ', content))
+    for latex, text in LATEX_SYMBOLS:
+        content = content.replace(latex, text)
+    return content
+
+
+def split_bibliographies(bibliographies):
+    return [list(bbl2bib.iter_unique_bibitems(lines))
+            for lines in bibliographies]
+
+
+def run_stages(root, repeat=DEFAULT_REPEAT, latency=0., workers=None):
+    """ benchmark every stage over the papers found under `root` """
+    extensions = ('tex', 'bbl')
+    papers = sorted(os.path.join(root, name) for name in os.listdir(root))
+    sources = list_files(papers, extensions)
+    files = sum(len(filenames) for _, filenames in sources)
+    metrics = Metrics()
+    bibliographies = read_bibliographies(sources, metrics=metrics)
+    size = metrics.counters.get('bytes', 0)
+    references = [bibitem['raw']
+                  for bibitems in split_bibliographies(bibliographies)
+                  for bibitem in bibitems]
+    entries = [Article(json={'author': reference[:40],
+                             'title': reference[40:120],
+                             'journal': 'Phys. Rev. B', 'year': '2013',
+                             'volume': '98', 'pages': '1--10'})
+               for reference in references]
+    bbl_size = sum(len(line) for lines in bibliographies for line in lines)
+    contents = read_contents(sources)
+    references_size = sum(len(reference) for reference in references)
+
+    stages = {
+        'list_files': measure(
+            lambda: list_files(papers, extensions),
+            files, repeat=repeat),
+        'parse_bibliography': measure(
+            lambda: read_bibliographies(sources),
+            files, size, repeat=repeat),
+        'scan_document': measure(
+            lambda: [list(scan_document(content)) for content in contents],
+            files, size, repeat=repeat),
+        'scan_document_baseline': measure(
+            lambda: [list(scan_lines(content)) for content in contents],
+            files, size, repeat=repeat),
+        'split_bibitems': measure(
+            lambda: split_bibliographies(bibliographies),
+            len(references), bbl_size, repeat=repeat),
+        'unlatexify': measure(
+            lambda: map(unlatexify, references),
+            len(references), references_size, repeat=repeat),
+        'unlatexify_baseline': measure(
+            lambda: map(replace_symbols, references),
+            len(references), references_size, repeat=repeat),
+        'parse': measure(
+            lambda: map(bbl2bib.parse, references),
+            len(references), references_size, repeat=repeat),
+        'to_bibtex': measure(
+            lambda: [entry.to_bibtex('label') for entry in entries],
+            len(entries), repeat=repeat),
+    }
+
+    session = StubSession(latency=latency)
+    options = {'session': session}
+    if workers is not None:
+        options['workers'] = workers
+    stages['end_to_end'] = measure(
+        lambda: [bbl2bib.stream_bib(paper, NullOutput(), **options)
+                 for paper in papers],
+        len(references), size, repeat=repeat)
+    stages['end_to_end']['papers'] = len(papers)
+    stages['end_to_end']['papers/s'] = \
+        len(papers) / stages['end_to_end']['seconds']
+    stages['end_to_end']['requests'] = session.requests // repeat
+    return stages
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+""" local HTTP server standing for CrossRef in transport checks """
+
+import BaseHTTPServer
+import threading
+
+
+class StubServer(object):
+    """
+    HTTP server on localhost answering its n-th request with the n-th of
+    `statuses` (the last one once they are exhausted); 3xx answers redirect
+    to the requested path. Counts the requests received.
+
+    Transport check: the circuit opens after 2 failures, its half-open
+    trial is redirected in a loop (an error that is not retried) and opens
+    it again, and the next trial closes it.
+
+    >>> import time
+    >>> import requests
+    >>> from papper.bibliography.transport import Transport, CircuitOpenError
+    >>> server = StubServer([503, 503, 302, 302, 200])
+    >>> session = requests.Session(); session.max_redirects = 1
+    >>> transport = Transport(retries=0, failures=2, cooldown=0.1)
+    >>> def send():
+    ...     try:
+    ...         return transport.send('stub', session.get,
+    ...                               url=server.url).status_code
+    ...     except (requests.RequestException, CircuitOpenError) as error:
+    ...         return type(error).__name__
+    >>> send(), send(), send(), server.requests
+    ('HTTPError', 'HTTPError', 'CircuitOpenError', 2)
+    >>> time.sleep(0.15); send(), send()
+    ('TooManyRedirects', 'CircuitOpenError')
+    >>> time.sleep(0.15); send(), send(), server.requests
+    (200, 200, 6)
+    >>> server.close()
+    """
+    def __init__(self, statuses, host='127.0.0.1'):
+        self.statuses = list(statuses)
+        self.requests = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                status = stub.next_status()
+                self.send_response(status)
+                if 300 <= status < 400:
+                    self.send_header('Location', self.path)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write('{}')
+            do_POST = do_GET
+
+        self._server = BaseHTTPServer.HTTPServer((host, 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(*self._server.server_address)
+
+    def next_status(self):
+        with self._lock:
+            self.requests += 1
+            return self.statuses[min(self.requests, len(self.statuses)) - 1]
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+""" corpus-level processing: one bibtex file per paper over a process pool """
+
+import multiprocessing
+import os
+import sys
+import time
+
+from .bibliography import iter_bibtex
+from .bbl2bib import (stream_bib, DEFAULT_WORKERS, DEFAULT_PER_HOST,
+                      DEFAULT_BATCH_SIZE)
+from .cache import ResolutionCache
+from .citations import CitationGraph
+from .deadline import Budget
+from .dedup import NearDuplicates
+from .index import DoiIndex
+from .manifest import Manifest
+from .metrics import Metrics
+from .references import DEFAULT_CONFIDENCE
+from .store import EntryStore, normalize_doi
+from .transport import Transport
+from .sources import ARCHIVE_EXTENSIONS, is_archive, open_source
+
+
+CHECKPOINT = '.papper-checkpoint'
+# papers written to the entry store at once
+STORE_BATCH = 100
+
+# per-process resolution settings, set by the pool initializer
+_options = {}
+_incremental = False
+
+
+def paper_id(path):
+    """
+    >>> paper_id('/data/arxiv/1501.00001.tar.gz')
+    '1501.00001'
+    >>> paper_id('/data/arxiv/1501.00002/')
+    '1501.00002'
+    """
+    name = os.path.basename(os.path.normpath(path))
+    for extension in sorted(ARCHIVE_EXTENSIONS, key=len, reverse=True):
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+
+def list_papers(path):
+    """
+    Papers are the sub-directories and source archives of `path` when it is
+    a directory, or the lines of `path` when it is a manifest file.
+    """
+    if os.path.isdir(path):
+        names = sorted(os.listdir(path))
+        papers = [os.path.join(path, name) for name in names]
+        return [paper for paper in papers
+                if os.path.isdir(paper) or is_archive(paper)]
+
+    with open(path, 'r') as manifest:
+        return filter(None, [line.strip() for line in manifest])
+
+
+def read_checkpoint(filename):
+    try:
+        with open(filename, 'r') as checkpoint:
+            return set(line.rstrip('\n') for line in checkpoint)
+    except IOError:
+        return set()
+
+
+def _initialize(workers, per_host, cache, incremental, near_duplicates,
+                doi_index, transport, confidence, batch_size, metadata,
+                budget):
+    global _incremental
+    _incremental = incremental
+    _options['workers'] = workers
+    _options['per_host'] = per_host
+    _options['cache'] = ResolutionCache(cache) if cache else None
+    # each process shares resolutions across all the papers it handles
+    _options['duplicates'] = NearDuplicates(threshold=near_duplicates) \
+        if near_duplicates else None
+    _options['index'] = DoiIndex(doi_index) if doi_index else None
+    _options['transport'] = Transport(**(transport or {}))
+    _options['confidence'] = confidence
+    _options['batch_size'] = batch_size
+    _options['metadata'] = metadata
+    _options['budget'] = Budget(**budget) if budget else None
+
+
+def _process(job):
+    paper, bib = job
+    partial = bib + '.part'
+    try:
+        source = open_source(paper)
+        manifest = Manifest(bib + '.manifest') if _incremental else None
+        if manifest is not None and os.path.exists(bib) and \
+                manifest.unchanged(source,
+                                   source.filenames(('tex', 'bbl'))):
+            return (paper, len(manifest), None, True, None)
+        metrics = Metrics()
+        with open(partial, 'w') as output:
+            count = stream_bib(source, output, manifest=manifest,
+                               metrics=metrics, **_options)
+        os.rename(partial, bib)
+        return (paper, count, None, False, metrics.to_dict())
+    except Exception as error:
+        if os.path.exists(partial):
+            os.remove(partial)
+        return (paper, 0, '{}: {}'.format(type(error).__name__, error),
+                False, None)
+
+
+def _stored(paper, output):
+    """ (paper id, entries) read back from the bibtex file of a paper """
+    identifier = paper_id(paper)
+    with open(os.path.join(output, identifier + '.bib'), 'r') as bib:
+        return (identifier, list(iter_bibtex(bib)))
+
+
+def _cited(entries):
+    """ DOIs cited by the entries of a paper, joined if wrapped """
+    return filter(None, [normalize_doi(''.join((entry['doi'] or '').split()))
+                         for entry in entries])
+
+
+def _checkpoint(papers, checkpointed, output, store=None, citations=None):
+    """
+    store the entries of converted `papers` and record their citations,
+    then checkpoint them
+    """
+    if (store is not None or citations is not None) and papers:
+        stored = [_stored(paper, output) for paper in papers]
+        if store is not None:
+            store.put_many(stored)
+        if citations is not None:
+            CitationGraph.record(citations, [(identifier, _cited(entries))
+                                             for identifier, entries
+                                             in stored])
+    for paper in papers:
+        checkpointed.write(paper + '\n')
+    checkpointed.flush()
+    del papers[:]
+
+
+def run_batch(papers, output, processes=None, workers=DEFAULT_WORKERS,
+              per_host=DEFAULT_PER_HOST, cache=None, incremental=False,
+              near_duplicates=None, doi_index=None, metrics=None,
+              transport=None, confidence=DEFAULT_CONFIDENCE,
+              batch_size=DEFAULT_BATCH_SIZE, metadata=True, store=None,
+              citations=None, budget=None):
+    """
+    Convert each paper to `<output>/<paper id>.bib`. Completed papers are
+    recorded in a checkpoint file so that an interrupted run resumes where
+    it stopped. Returns a throughput summary.
+    In incremental mode every paper is checked against its manifest
+    (`<output>/<paper id>.bib.manifest`) instead: unchanged papers are
+    skipped and only the entries of modified files are rebuilt.
+    A `near_duplicates` similarity threshold lets near-duplicate references
+    share a single resolution. With a `doi_index` folder, references are
+    resolved against that local index rather than CrossRef.
+    The instrumentation of every processed paper is merged into `metrics`.
+    `transport` holds the Transport options of the resolution requests.
+    References parsed locally with at least `confidence` skip CrossRef, the
+    others are matched by batches of `batch_size`. With `metadata`, entries
+    are built from the search results rather than fetched by DOI.
+    `budget` holds the Budget options of every paper, if any.
+    With a `store` folder, the entries of every converted paper are also
+    written to that EntryStore, by batches of STORE_BATCH papers; papers are
+    only checkpointed once stored.
+    With a `citations` folder, the DOIs cited by every converted paper are
+    merged into that CitationGraph at the end of the run.
+    """
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    checkpoint = os.path.join(output, CHECKPOINT)
+    done = read_checkpoint(checkpoint) if not incremental else set()
+    jobs = [(paper, os.path.join(output, paper_id(paper) + '.bib'))
+            for paper in papers if paper not in done]
+
+    summary = {'papers': 0, 'references': 0, 'failures': 0,
+               'skipped': len(papers) - len(jobs), 'unchanged': 0}
+    store = EntryStore(store) if store else None
+    converted = []
+    start = time.time()
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count(),
+                                initializer=_initialize,
+                                initargs=(workers, per_host, cache,
+                                          incremental, near_duplicates,
+                                          doi_index, transport,
+                                          confidence, batch_size,
+                                          metadata, budget))
+    try:
+        with open(checkpoint, 'a') as checkpointed:
+            for paper, count, error, unchanged, recorded in \
+                    pool.imap_unordered(_process, jobs):
+                if metrics is not None and recorded is not None:
+                    metrics.merge(recorded)
+                if error:
+                    summary['failures'] += 1
+                    sys.stderr.write("Error while processing '{}': {}\n"
+                                     .format(paper, error))
+                    continue
+                if unchanged:
+                    summary['unchanged'] += 1
+                    continue
+                summary['papers'] += 1
+                summary['references'] += count
+                converted.append(paper)
+                if store is None and citations is None or \
+                        len(converted) >= STORE_BATCH:
+                    _checkpoint(converted, checkpointed, output, store,
+                                citations)
+            _checkpoint(converted, checkpointed, output, store, citations)
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+        if store is not None:
+            store.close()
+
+    if citations is not None:
+        graph = CitationGraph.update(citations)
+        summary['citations'] = graph.edges
+        graph.close()
+
+    elapsed = time.time() - start
+    summary['seconds'] = elapsed
+    summary['papers/s'] = summary['papers'] / elapsed if elapsed else 0.
+    summary['references/s'] = summary['references'] / elapsed \
+        if elapsed else 0.
+    return summary
+
+
+def format_summary(summary):
+    return ('{papers} papers ({skipped} skipped, {unchanged} unchanged,'
+            ' {failures} failed),'
+            ' {references} references in {seconds:.1f}s:'
+            ' {papers/s:.2f} papers/s, {references/s:.2f} references/s'
+            .format(**summary))
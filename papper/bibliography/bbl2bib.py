@@ -1,27 +1,172 @@
 # -*- coding: utf-8 -*-
 
-import os
 import re
 import json
-import requests
+import functools
+import hashlib
+import threading
+import urlparse
+from collections import OrderedDict
+from itertools import chain, imap, islice
 
 from . import bibliography
+from .deadline import race
+from .includes import IncludeGraph
+from .latex import unlatexify
+from .lazy import LazyModule
+from .metrics import NULL_METRICS
+from .references import (parse_reference, DEFAULT_CONFIDENCE,
+                         MINIMUM_CONFIDENCE)
+from .sources import iter_files, open_source
+from .transport import CircuitOpenError, Transport
+
+
+# imported on first use: most commands never reach the network
+requests = LazyModule('requests')
+
+# number of references resolved concurrently
+DEFAULT_WORKERS = 8
+# number of in-flight requests allowed against a single host
+DEFAULT_PER_HOST = 4
+# number of references per worker held in memory while streaming
+RESOLUTION_WINDOW = 4
+# citations matched by a single CrossRef links request (0 disables batches)
+DEFAULT_BATCH_SIZE = 20
+CROSSREF_SEARCH_URL = 'http://search.labs.crossref.org/dois'
+CROSSREF_LINKS_URL = 'http://search.crossref.org/links'
+DOI_URL = 'http://dx.doi.org/'
+# entry types of the COinS genres found in CrossRef search results
+COINS_GENRES = {
+    'article': bibliography.Article,
+    'proceeding': bibliography.InProceedings,
+    'conference': bibliography.InProceedings,
+    'book': bibliography.Book,
+    'bookitem': bibliography.InCollection,
+    'dissertation': bibliography.PhdThesis,
+    'report': bibliography.TechReport,
+}
+
+
+def bbl_to_bib(path, **options):
+    bibliography = list(iter_bib(path, **options))
+    print(bibliography)
+    # 5. return formatted bibtex bibliography
+    return '\n'.join(bibliography)
 
 
-def bbl_to_bib(path):
+def iter_bib(path, workers=DEFAULT_WORKERS, per_host=DEFAULT_PER_HOST,
+             cache=None, manifest=None, duplicates=None, index=None,
+             session=None, metrics=None, transport=None,
+             confidence=DEFAULT_CONFIDENCE, batch_size=DEFAULT_BATCH_SIZE,
+             metadata=True, budget=None):
+    """
+    Lazily yield the resolved bibtex entries found under `path` (a paper
+    directory or a tar/tar.gz/gzip source archive): only a window of
+    references is held in memory at any time.
+    Every file is read once to build the include graph of the paper, which
+    yields one bibliography per root document, without repeated labels.
+    With a `manifest`, entries of unchanged documents are reused instead.
+    With `duplicates`, near-duplicate references are resolved once.
+    With `index` (a DoiIndex), references are resolved offline.
+    A `session` replaces the default pooled HTTP session, which sends
+    requests through `transport` (rate limits, retries, timeouts).
+    References parsed locally with at least `confidence` skip CrossRef,
+    the others are matched by batches of `batch_size` citations. With
+    `metadata`, entries are built from the search results and the DOI
+    bibtex is only fetched for incomplete ones.
+    With a `budget` (a Budget), the paper is resolved within its latency
+    budget, counted from this call.
+    Stage timings and counts are recorded in `metrics` (a Metrics).
+    """
+    metrics = metrics or NULL_METRICS
+    deadline = budget.deadline() if budget is not None else None
     context = {}
     # 1. list all files
-    context['filenames'] = list_all_files(path, extensions=('tex', 'bbl'))
-    # 2. split content from bibliography
-    context['bbl'] = reduce(lambda x, y: x + y,
-                            map(parse_bibliography, context['filenames']))
-    # 3. split bibliography
-    context['bibitems'] = split_bibitems(context['bbl'])
-    # 4. resolve reference
-    context['bibliography'] = map(resolve, context['bibitems'])
-    print(context['bibliography'])
-    # 5. return formatted bibtex bibliography
-    return '\n'.join(context['bibliography'])
+    with metrics.timer('list_files'):
+        source = open_source(path)
+    context['filenames'] = metrics.timed(
+        'list_files', source.filenames(extensions=('tex', 'bbl')),
+        counter='files')
+    session = session or PooledSession(workers=workers, per_host=per_host,
+                                       transport=transport)
+    if manifest is not None:
+        resolver = functools.partial(iter_resolve, workers=workers,
+                                     session=session, cache=cache,
+                                     duplicates=duplicates, index=index,
+                                     metrics=metrics, confidence=confidence,
+                                     batch_size=batch_size,
+                                     metadata=metadata, budget=budget,
+                                     deadline=deadline)
+    # 2. read every file once and find the root documents
+    with metrics.timer('parse_bibliography'):
+        graph = IncludeGraph(source, context['filenames'], metrics=metrics)
+        documents = graph.documents()
+    metrics.count('documents', len(documents))
+    if manifest is not None:
+        return iter_incremental(source, graph, documents, manifest,
+                                resolver, metrics=metrics, budget=budget)
+    # 3. split content from bibliography, following inclusions
+    context['bbl'] = imap(lambda document: metrics.timed(
+        'parse_bibliography', graph.lines(document)), documents)
+    # 4. split bibliography of each document
+    context['bibitems'] = metrics.timed(
+        'split_bibitems',
+        chain.from_iterable(imap(functools.partial(iter_unique_bibitems,
+                                                   metrics=metrics),
+                                 context['bbl'])),
+        counter='bibitems')
+    # 5. resolve reference
+    context['bibliography'] = metrics.timed(
+        'resolve', iter_resolve(context['bibitems'], workers=workers,
+                                session=session, cache=cache,
+                                duplicates=duplicates, index=index,
+                                metrics=metrics, confidence=confidence,
+                                batch_size=batch_size, metadata=metadata,
+                                budget=budget, deadline=deadline))
+    return context['bibliography']
+
+
+def iter_incremental(source, graph, documents, manifest, resolver,
+                     metrics=None, budget=None):
+    """
+    Yield the entries of each document of the include `graph`, reusing the
+    manifest ones for documents (and the files they include) left unchanged
+    since the previous run. Documents with references deferred by the
+    `budget` are not recorded, so that they are resolved again.
+    """
+    metrics = metrics or NULL_METRICS
+    for document in documents:
+        entries = manifest.lookup(source, document)
+        if entries is None:
+            files = []
+            bbl = metrics.timed('parse_bibliography',
+                                graph.lines(document, files=files))
+            bibitems = metrics.timed('split_bibitems',
+                                     iter_unique_bibitems(bbl,
+                                                          metrics=metrics),
+                                     counter='bibitems')
+            deferred = budget.deferred if budget is not None else 0
+            entries = list(metrics.timed('resolve', resolver(bibitems)))
+            if budget is None or budget.deferred == deferred:
+                manifest.record(source, document,
+                                [name for name in files if name != document],
+                                entries)
+        else:
+            metrics.count('reused_entries', len(entries))
+        for entry in entries:
+            yield entry
+    manifest.prune(documents, filenames=graph.parts)
+    manifest.save()
+
+
+def stream_bib(path, output, **options):
+    """ write each bibtex entry to `output` as soon as it is resolved """
+    count = 0
+    for entry in iter_bib(path, **options):
+        output.write(entry + '\n')
+        output.flush()
+        count += 1
+    return count
 
 
 def concatenate_dict_values(dictionaries):
@@ -59,87 +204,48 @@ def extract(string, begin, end):
 
 
 def list_all_files(path, discard=None, extensions=None):
-    filenames = []
-    path = os.path.abspath(path)
-    for root, _, files in os.walk(path, topdown=True):
-        filenames.extend(map(lambda x: os.path.join(root, x), files))
-
-    if discard is not None:
-        discard = set(discard)
-        filenames = filter(lambda x: x not in discard, filenames)
-
-    if extensions:
-        filenames = filter(lambda x: any(map(x.endswith, extensions)),
-                           filenames)
-
-    return filenames
+    return list(iter_files(path, discard=discard, extensions=extensions))
 
 
-def parse_bibliography(filename):
-    references = []
-
-    def find_pattern(string, pattern):
-        position = string.find(pattern)
-        return position if position != -1 else None
-
-    def is_inlined_bbl(line):
-        return (find_pattern(line, r'\input{') is not None and
-                find_pattern(line, r'.bbl}') is not None) or \
-            find_pattern(line, r'\bibliography{')
-
-    def bbl_file(line):
-        folder = os.path.dirname(filename)
-        bbl = line.split('{', 1)[1].split('}', 1)[0]
-        if not os.path.isabs(bbl):
-            bbl = os.path.join(folder, bbl)
-        bbl += '.bbl'
-        return bbl if os.path.exists(bbl) else None
-
-    def default_bbl():
-        return os.path.splitext(filename)[0] + '.bbl'
-
-    def is_biblio_begin(line):
-        return find_pattern(line, r'\begin{thebibliography}') is not None
-
-    def is_biblio_end(line):
-        return find_pattern(line, r'\end{thebibliography}') is not None
-
-    def is_bib(line):
-        return not is_biblio_begin(line) and not is_biblio_end(line)
-
-    def is_comment(line):
-        return line.startswith('%')
+def iter_bibitems(lines):
+    """
+    >>> list(iter_bibitems(['\\\\bibitem{foo1} bar1', ' baz1\\n',
+    ...                     '\\\\bibitem{foo2} bar2 \\\\bibitem{foo3} bar3']))
+    [{'raw': 'bar1 baz1', 'label': 'foo1'}, {'raw': 'bar2', 'label': 'foo2'}, {'raw': 'bar3', 'label': 'foo3'}]
+    """
+    def bibitem(chunks):
+        # filter reference alias and citation
+        label, raw = extract(''.join(chunks).strip(), '{', '}')
+        return {'label': label, 'raw': raw.strip()}
+
+    chunks = []
+    for line in lines:
+        parts = line.split(r'\bibitem')
+        chunks.append(parts[0])
+        for part in parts[1:]:
+            if ''.join(chunks).strip():
+                yield bibitem(chunks)
+            chunks = [part]
+    if ''.join(chunks).strip():
+        yield bibitem(chunks)
+
+
+def iter_unique_bibitems(lines, metrics=None):
+    """
+    bibitems of a document bibliography, the ones repeating a label dropped
 
-    def parse_inline_biblio(line):
-        bbl = bbl_file(line) or default_bbl()
-        try:
-            with open(bbl, 'r') as external_bbl:
-                bbl_lines = filter(is_bib,
-                                   external_bbl.readlines())
-        except IOError:
-            print("Error while trying to read '{}'".format(bbl))
-            bbl_lines = ''
-        return '\n'.join(bbl_lines)
-
-    with open(filename, 'r') as data:
-        biblio = False
-
-        for line in data:
-            if is_biblio_begin(line):
-                biblio = True
-                continue
-            elif is_biblio_end(line):
-                biblio = False
-                continue
-            elif is_comment(line):
-                continue
-
-            if is_inlined_bbl(line):
-                references.append(parse_inline_biblio(line))
-            elif bibliography:
-                references.append(line)
-
-    return '\n'.join(references)
+    >>> [bibitem['raw'] for bibitem in iter_unique_bibitems(
+    ...     ['\\\\bibitem{a} A1', '\\\\bibitem{b} B', '\\\\bibitem{a} A2'])]
+    ['A1', 'B']
+    """
+    metrics = metrics or NULL_METRICS
+    labels = set()
+    for bibitem in iter_bibitems(lines):
+        if bibitem['label'] in labels:
+            metrics.count('duplicate_bibitems')
+            continue
+        labels.add(bibitem['label'])
+        yield bibitem
 
 
 def split_bibitems(bbl):
@@ -147,247 +253,80 @@ def split_bibitems(bbl):
     >>> split_bibitems('\\\\bibitem{foo1} bar1 \\n\\\\bibitem{foo2} bar2')
     [{'raw': 'bar1', 'label': 'foo1'}, {'raw': 'bar2', 'label': 'foo2'}]
     """
+    return list(iter_bibitems([bbl]))
 
-    # split each bibitem
-    bibitems = bbl.split(r'\bibitem')
-    # removes leading/trailing spaces
-    bibitems = map(lambda item: item.strip(), bibitems)
-    # filter empty reference
-    bibitems = filter(None, bibitems)
-    # filter reference alias and citation
-    bibitems = map(lambda ref: extract(ref, '{', '}'), bibitems)
-    return [{'label': bibitem[0], 'raw': bibitem[1].strip()}
-            for bibitem in bibitems]
-
-
-def unlatexify(content):
-    # see http://arxiv.org/help/prep#author
-    blocks = re.compile('\\\\newblock')
-    blanks = re.compile('\s+')
-    strip = lambda regexp, string: regexp.sub(' ', string)
-
-    return strip(blanks, strip(blocks, content))\
-        .replace('\\"A', "Ä")\
-        .replace('\\"a', "ä")\
-        .replace("\\'A", "Á")\
-        .replace("\\'a", "á")\
-        .replace("\\.A", "Ȧ")\
-        .replace("\\.a", "ȧ")\
-        .replace("\\=A", "Ā")\
-        .replace("\\=a", "ā")\
-        .replace("\\^A", "Â")\
-        .replace("\\^a", "â")\
-        .replace("\\`A", "À")\
-        .replace("\\`a", "à")\
-        .replace("\\k{A}", "Ą")\
-        .replace("\\k{a}", "ą")\
-        .replace("\\r{A}", "Å")\
-        .replace("\\r{a}", "å")\
-        .replace("\\u{A}", "Ă")\
-        .replace("\\u{a}", "ă")\
-        .replace("\\v{A}", "Ǎ")\
-        .replace("\\v{a}", "ǎ")\
-        .replace("\\~A", "Ã")\
-        .replace("\\~a", "ã")\
-        .replace("\\'C", "Ć")\
-        .replace("\\'c", "ć")\
-        .replace("\\.C", "Ċ")\
-        .replace("\\.c", "ċ")\
-        .replace("\\^C", "Ĉ")\
-        .replace("\\^c", "ĉ")\
-        .replace("\\c{C}", "Ç")\
-        .replace("\\c{c}", "ç")\
-        .replace("\\v{C}", "Č")\
-        .replace("\\v{c}", "č")\
-        .replace("\\v{D}", "Ď")\
-        .replace("\\v{d}", "ď")\
-        .replace('\\"E', "Ë")\
-        .replace('\\"e', "ë")\
-        .replace("\\'E", "É")\
-        .replace("\\'e", "é")\
-        .replace("\\.E", "Ė")\
-        .replace("\\.e", "ė")\
-        .replace("\\=E", "Ē")\
-        .replace("\\=e", "ē")\
-        .replace("\\^E", "Ê")\
-        .replace("\\^e", "ê")\
-        .replace("\\`E", "È")\
-        .replace("\\`e", "è")\
-        .replace("\\c{E}", "Ȩ")\
-        .replace("\\c{e}", "ȩ")\
-        .replace("\\k{E}", "Ę")\
-        .replace("\\k{e}", "ę")\
-        .replace("\\u{E}", "Ĕ")\
-        .replace("\\u{e}", "ĕ")\
-        .replace("\\v{E}", "Ě")\
-        .replace("\\v{e}", "ě")\
-        .replace("\\.G", "Ġ")\
-        .replace("\\.g", "ġ")\
-        .replace("\\^G", "Ĝ")\
-        .replace("\\^g", "ĝ")\
-        .replace("\\c{G}", "Ģ")\
-        .replace("\\c{g}", "ģ")\
-        .replace("\\u{G}", "Ğ")\
-        .replace("\\u{g}", "ğ")\
-        .replace("\\v{G}", "Ǧ")\
-        .replace("\\v{g}", "ǧ")\
-        .replace("\\^H", "Ĥ")\
-        .replace("\\^h", "ĥ")\
-        .replace("\\v{H}", "Ȟ")\
-        .replace("\\v{h}", "ȟ")\
-        .replace('\\"I', "Ï")\
-        .replace('\\"i', "ï")\
-        .replace("\\'I", "Í")\
-        .replace("\\'i", "í")\
-        .replace("\\.I", "İ")\
-        .replace("\\=I", "Ī")\
-        .replace("\\=i", "ī")\
-        .replace("\\^I", "Î")\
-        .replace("\\^i", "î")\
-        .replace("\\`I", "Ì")\
-        .replace("\\`i", "ì")\
-        .replace("\\k{I}", "Į")\
-        .replace("\\k{i}", "į")\
-        .replace("\\u{I}", "Ĭ")\
-        .replace("\\u{i}", "ĭ")\
-        .replace("\\v{I}", "Ǐ")\
-        .replace("\\v{i}", "ǐ")\
-        .replace("\\~I", "Ĩ")\
-        .replace("\\~i", "ĩ")\
-        .replace("\\^J", "Ĵ")\
-        .replace("\\^j", "ĵ")\
-        .replace("\\c{K}", "Ķ")\
-        .replace("\\c{k}", "ķ")\
-        .replace("\\v{K}", "Ǩ")\
-        .replace("\\v{k}", "ǩ")\
-        .replace("\\'L", "Ĺ")\
-        .replace("\\'l", "ĺ")\
-        .replace("\\c{L}", "Ļ")\
-        .replace("\\c{l}", "ļ")\
-        .replace("\\v{L}", "Ľ")\
-        .replace("\\v{l}", "ľ")\
-        .replace("\\'N", "Ń")\
-        .replace("\\'n", "ń")\
-        .replace("\\c{N}", "Ņ")\
-        .replace("\\c{n}", "ņ")\
-        .replace("\\v{N}", "Ň")\
-        .replace("\\v{n}", "ň")\
-        .replace("\\~N", "Ñ")\
-        .replace("\\~n", "ñ")\
-        .replace('\\"O', "Ö")\
-        .replace('\\"o', "ö")\
-        .replace("\\'O", "Ó")\
-        .replace("\\'o", "ó")\
-        .replace("\\.O", "Ȯ")\
-        .replace("\\.o", "ȯ")\
-        .replace("\\=O", "Ō")\
-        .replace("\\=o", "ō")\
-        .replace("\\^O", "Ô")\
-        .replace("\\^o", "ô")\
-        .replace("\\`O", "Ò")\
-        .replace("\\`o", "ò")\
-        .replace("\\H{O}", "Ő")\
-        .replace("\\H{o}", "ő")\
-        .replace("\\k{O}", "Ǫ")\
-        .replace("\\k{o}", "ǫ")\
-        .replace("\\u{O}", "Ŏ")\
-        .replace("\\u{o}", "ŏ")\
-        .replace("\\v{O}", "Ǒ")\
-        .replace("\\v{o}", "ǒ")\
-        .replace("\\~O", "Õ")\
-        .replace("\\~o", "õ")\
-        .replace("\\'R", "Ŕ")\
-        .replace("\\'r", "ŕ")\
-        .replace("\\c{R}", "Ŗ")\
-        .replace("\\c{r}", "ŗ")\
-        .replace("\\v{R}", "Ř")\
-        .replace("\\v{r}", "ř")\
-        .replace("\\'S", "Ś")\
-        .replace("\\'s", "ś")\
-        .replace("\\^S", "Ŝ")\
-        .replace("\\^s", "ŝ")\
-        .replace("\\c{S}", "Ş")\
-        .replace("\\c{s}", "ş")\
-        .replace("\\v{S}", "Š")\
-        .replace("\\v{s}", "š")\
-        .replace("\\c{T}", "Ţ")\
-        .replace("\\c{t}", "ţ")\
-        .replace("\\v{T}", "Ť")\
-        .replace("\\v{t}", "ť")\
-        .replace('\\"U', "Ü")\
-        .replace('\\"u', "ü")\
-        .replace("\\'U", "Ú")\
-        .replace("\\'u", "ú")\
-        .replace("\\=U", "Ū")\
-        .replace("\\=u", "ū")\
-        .replace("\\^U", "Û")\
-        .replace("\\^u", "û")\
-        .replace("\\`U", "Ù")\
-        .replace("\\`u", "ù")\
-        .replace("\\H{U}", "Ű")\
-        .replace("\\H{u}", "ű")\
-        .replace("\\k{U}", "Ų")\
-        .replace("\\k{u}", "ų")\
-        .replace("\\r{U}", "Ů")\
-        .replace("\\r{u}", "ů")\
-        .replace("\\u{U}", "Ŭ")\
-        .replace("\\u{u}", "ŭ")\
-        .replace("\\v{U}", "Ǔ")\
-        .replace("\\v{u}", "ǔ")\
-        .replace("\\~U", "Ũ")\
-        .replace("\\~u", "ũ")\
-        .replace("\\^W", "Ŵ")\
-        .replace("\\^w", "ŵ")\
-        .replace('\\"Y', "Ÿ")\
-        .replace('\\"y', "ÿ")\
-        .replace("\\'Y", "Ý")\
-        .replace("\\'y", "ý")\
-        .replace("\\=Y", "Ȳ")\
-        .replace("\\=y", "ȳ")\
-        .replace("\\^Y", "Ŷ")\
-        .replace("\\^y", "ŷ")\
-        .replace("\\'Z", "Ź")\
-        .replace("\\'z", "ź")\
-        .replace("\\.Z", "Ż")\
-        .replace("\\.z", "ż")\
-        .replace("\\v{Z}", "Ž")\
-        .replace("\\v{z}", "ž")\
-        .replace("{\\aa}", "å")\
-        .replace("{\\AA}", "Å")\
-        .replace("{\\ae}", "æ")\
-        .replace("{\\AE}", "Æ")\
-        .replace("{\\DH}", "Ð")\
-        .replace("{\\dh}", "ð")\
-        .replace("{\\dj}", "đ")\
-        .replace("{\\DJ}", "Đ")\
-        .replace("{\\eth}", "ð")\
-        .replace("{\\ETH}", "Ð")\
-        .replace("{\\i}", "ı")\
-        .replace("{\\I}", "ł")\
-        .replace("{\\L}", "Ł")\
-        .replace("{\\ng}", "ŋ")\
-        .replace("{\\NG}", "Ŋ")\
-        .replace("{\\O}", "Ø")\
-        .replace("{\\o}", "ø")\
-        .replace("{\\oe}", "œ")\
-        .replace("{\\OE}", "Œ")\
-        .replace("{\\ss}", "ß")\
-        .replace("{\\th}", "þ")\
-        .replace("{\\TH}", "Þ")\
-        .replace("~", " ")\
-        .replace("\mbox{.}", "")
-
-
-def crossref(reference):
-    def query_dois(filters):
-        response = requests.get('http://search.labs.crossref.org/dois',
-                                params=filters)
-        return json.loads(response.content) if response.ok else None
 
-    def resolve_doi(doi):
-        headers = {'Accept': 'application/x-bibtex'}
-        response = requests.get(doi, headers=headers)
-        return response.content if response.ok else None
+class PooledSession(object):
+    """
+    Keep-alive session shared by the resolution workers: connections are
+    pooled, the number of concurrent requests per host is bounded and
+    requests are sent through a Transport policy. The underlying
+    requests.Session is only created by the first request.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, per_host=DEFAULT_PER_HOST,
+                 transport=None):
+        self.workers = workers
+        self.per_host = per_host
+        self.transport = transport or Transport()
+        self._session = None
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=self.workers, pool_maxsize=self.workers)
+                self._session = requests.Session()
+                self._session.mount('http://', adapter)
+                self._session.mount('https://', adapter)
+            return self._session
+
+    def _host_slot(self, host):
+        with self._lock:
+            return self._hosts.setdefault(
+                host, threading.BoundedSemaphore(self.per_host))
+
+    def request(self, method, url, *args, **kwargs):
+        host = urlparse.urlsplit(url).netloc
+        send = functools.partial(self.session.request, method, url, *args)
+        # the slot is released while the transport backs off
+        return self.transport.send(host, send, slot=self._host_slot(host),
+                                   **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+def crossref(reference, session=requests, index=None, metrics=None,
+             metadata=True):
+    """
+    bibtex entry of the best CrossRef match for `reference`. With `index`
+    (a local DoiIndex) candidates are searched and formatted offline.
+    With `metadata`, the entry is built from the metadata of the search
+    result and the DOI is only fetched when required fields are missing.
+    """
+    metrics = metrics or NULL_METRICS
+    if index is not None:
+        with metrics.latency('index_query_seconds'):
+            candidates = index.query(reference, count=1)
+        return index.bibtex(candidates[0]) if candidates else None
+
+    def query_dois(filters):
+        with metrics.latency('crossref_query_seconds'):
+            response = session.get(CROSSREF_SEARCH_URL, params=filters)
+        response.raise_for_status()
+        return json.loads(response.content)
 
     # http://labs.crossref.org/resolving-citations-we-dont-need-no-stinkin-parser
     candidates = query_dois({
@@ -395,12 +334,162 @@ def crossref(reference):
         'sort': 'score'
     })
 
-    return resolve_doi(candidates[0]['doi']) if candidates else None
+    if not candidates:
+        return None
+    if metadata:
+        entry = search_entry(candidates[0])
+        if entry is not None and entry.is_valid():
+            metrics.count('metadata_resolutions')
+            return entry.to_bibtex()
+    return fetch_doi(candidates[0]['doi'], session=session, metrics=metrics)
 
 
-def parse(reference):
-    # FIXME: we should parse reference to label each reference fields
-    return bibliography.Misc(json={'note': unlatexify(reference)}).to_bibtex()
+def search_entry(candidate):
+    """
+    bibliography Entry filled with the COinS metadata of a CrossRef search
+    result, None when the result has none or is of an unknown genre (a
+    Misc entry would always be valid, the DOI bibtex is more accurate)
+
+    >>> entry = search_entry({'doi': 'http://dx.doi.org/10.1/x', 'coins':
+    ...     'rft.genre=article&amp;rft.atitle=On+things&amp;rft.jtitle=Phys.'
+    ...     '+Rev.+B&amp;rft.date=2007-05&amp;rft.volume=98&amp;rft.spage=1'
+    ...     '&amp;rft.epage=10&amp;rft.au=J.+Doe&amp;rft.au=A.+Smith'})
+    >>> print(entry.to_bibtex('doe07'))  # doctest: +NORMALIZE_WHITESPACE
+    @ARTICLE{doe07,
+        author = {J. Doe and A. Smith},
+        title = {On things},
+        journal = {Phys. Rev. B},
+        year = {2007},
+        volume = {98},
+        pages = {1--10},
+        doi = {10.1/x}}
+    >>> search_entry({'doi': '10.1/y', 'coins': 'rft.genre=unknown&amp;'
+    ...               'rft.title=Data&amp;rft.date=2007'}) is None
+    True
+    """
+    if not candidate.get('coins'):
+        return None
+    coins = urlparse.parse_qs(candidate['coins'].replace('&amp;', '&'))
+
+    def first(*keys):
+        for key in keys:
+            if coins.get(key):
+                return coins[key][0].strip()
+        return None
+
+    kind = COINS_GENRES.get(first('rft.genre'))
+    if kind is None:
+        return None
+    authors = coins.get('rft.au') or \
+        filter(None, [' '.join(filter(None, [first('rft.aufirst'),
+                                             first('rft.aulast')]))])
+    pages = first('rft.pages') or '--'.join(filter(None, [first('rft.spage'),
+                                                          first('rft.epage')]))
+    year = first('rft.date') or candidate.get('year')
+    fields = {'author': ' and '.join(author.strip() for author in authors),
+              'year': year[:4] if year else None,
+              'volume': first('rft.volume'),
+              'number': first('rft.issue'),
+              'pages': pages,
+              'publisher': first('rft.pub'),
+              'doi': re.sub(r'^https?://(?:dx\.)?doi\.org/', '',
+                            candidate.get('doi') or '')}
+    if kind in (bibliography.Article, bibliography.InProceedings,
+                bibliography.InCollection):
+        fields['title'] = first('rft.atitle', 'rft.title')
+        fields['journal' if kind is bibliography.Article else 'booktitle'] = \
+            first('rft.jtitle', 'rft.btitle', 'rft.title')
+    else:
+        fields['title'] = first('rft.btitle', 'rft.title', 'rft.atitle')
+        if kind is bibliography.PhdThesis:
+            fields['school'] = first('rft.inst', 'rft.pub')
+        elif kind is bibliography.TechReport:
+            fields['institution'] = first('rft.inst', 'rft.pub')
+    return kind(json=dict((key, value) for key, value in fields.items()
+                          if value))
+
+
+def fetch_doi(doi, session=requests, metrics=None):
+    """
+    bibtex entry of a DOI (or DOI url) through content negotiation, None
+    for an unknown DOI; other failed responses raise an HTTPError
+    """
+    metrics = metrics or NULL_METRICS
+    url = doi if doi.startswith('http') else DOI_URL + doi
+    headers = {'Accept': 'application/x-bibtex'}
+    with metrics.latency('doi_fetch_seconds'):
+        response = session.get(url, headers=headers)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.content
+
+
+def crossref_links(references, session=requests, metrics=None):
+    """
+    DOI matched by CrossRef for each of `references` (None for unmatched
+    ones), all sent in a single request.
+    """
+    metrics = metrics or NULL_METRICS
+    metrics.count('batch_requests')
+    with metrics.latency('crossref_batch_seconds'):
+        response = session.post(CROSSREF_LINKS_URL,
+                                data=json.dumps(references),
+                                headers={'Content-Type': 'application/json'})
+    response.raise_for_status()
+    results = json.loads(response.content).get('results') or []
+    # results echo the citation they match
+    dois = dict((result.get('text'), result.get('doi'))
+                for result in results if result.get('match'))
+    return [dois.get(reference) for reference in references]
+
+
+def fingerprint(reference):
+    """
+    >>> a = fingerprint('Foo,   B. \\\\newblock {\\\\em Bar}.')
+    >>> b = fingerprint('foo, b. {\\\\em bar}.')
+    >>> a == b
+    True
+    """
+    text = unlatexify(reference).decode('utf-8', 'replace').lower()
+    return hashlib.sha1(' '.join(text.split()).encode('utf-8')).hexdigest()
+
+
+def cached_crossref(reference, session=requests, cache=None, index=None,
+                    metrics=None, metadata=True):
+    """
+    crossref through `cache`: only answers are cached, a reference without
+    match included, while failed requests raise before reaching the cache
+    """
+    metrics = metrics or NULL_METRICS
+    if cache is None:
+        return crossref(reference, session=session, index=index,
+                        metrics=metrics, metadata=metadata)
+
+    key = fingerprint(reference)
+    hit, resolved = cache.get(key)
+    metrics.count('cache_hits' if hit else 'cache_misses')
+    if not hit:
+        resolved = crossref(reference, session=session, index=index,
+                            metrics=metrics, metadata=metadata)
+        cache.set(key, resolved)
+    return resolved
+
+
+def parse(reference, parsed=None):
+    """
+    bibtex entry built from the fields found locally in `reference` (see
+    parse_reference), or holding its whole text as note when they are not
+    reliable enough
+
+    >>> parse('J.~Doe. \\\\newblock On things. \\\\newblock '
+    ...       '{\\\\em Phys. Rev. B}, 98:1--10.').split(',')[0]
+    '@MISC{None'
+    """
+    entry, confidence = parsed or parse_reference(reference)
+    if confidence < MINIMUM_CONFIDENCE:
+        entry = bibliography.Misc(json={'note': unlatexify(reference)})
+    return entry.to_bibtex()
 
 
 def set_label(reference, label):
@@ -413,6 +502,284 @@ def set_label(reference, label):
                     reference.split(',', 1)[1]])
 
 
-def resolve(reference):
-    resolved = crossref(reference['raw']) or parse(reference['raw'])
+def resolve_reference(raw, session=requests, cache=None, index=None,
+                      metrics=None, confidence=DEFAULT_CONFIDENCE,
+                      metadata=True):
+    """
+    unlabelled bibtex entry of a raw reference; CrossRef is only queried
+    when the local parse confidence is below `confidence`
+    """
+    metrics = metrics or NULL_METRICS
+    metrics.count('references')
+    parsed = parse_reference(raw)
+    if parsed[1] >= confidence:
+        metrics.count('local_resolutions')
+        return parsed[0].to_bibtex()
+    try:
+        resolved = cached_crossref(raw, session=session, cache=cache,
+                                   index=index, metrics=metrics,
+                                   metadata=metadata)
+    except (requests.RequestException, CircuitOpenError):
+        # upstream unreachable, throttling us or circuit open
+        metrics.count('crossref_errors')
+        resolved = None
+    if not resolved:
+        metrics.count('parse_fallbacks')
+        resolved = parse(raw, parsed=parsed)
+    return resolved
+
+
+# result of a lookup that failed on transport, unlike a lookup without match
+_FAILED = object()
+
+
+def resolve_batch(raws, session=requests, cache=None, metrics=None,
+                  confidence=DEFAULT_CONFIDENCE,
+                  batch_size=DEFAULT_BATCH_SIZE, pool=None, metadata=True):
+    """
+    unlabelled bibtex entries of raw references, like resolve_reference,
+    but the references not resolved locally (nor cached) are matched by
+    CrossRef `batch_size` at a time; only the misses are queried one by one.
+    Requests are sent concurrently on `pool` (a ThreadPool).
+    """
+    metrics = metrics or NULL_METRICS
+    metrics.count('references', len(raws))
+    pool_map = pool.map if pool is not None else map
+    parsed = map(parse_reference, raws)
+    keys = [fingerprint(raw) for raw in raws] if cache is not None else None
+    resolved = {}
+    for position, (entry, score) in enumerate(parsed):
+        if score >= confidence:
+            metrics.count('local_resolutions')
+            resolved[position] = entry.to_bibtex()
+        elif cache is not None:
+            hit, value = cache.get(keys[position])
+            metrics.count('cache_hits' if hit else 'cache_misses')
+            if hit:
+                resolved[position] = value
+    unsure = [position for position in xrange(len(raws))
+              if position not in resolved]
+
+    def match_chunk(chunk):
+        try:
+            return crossref_links([raws[position] for position in chunk],
+                                  session=session, metrics=metrics)
+        except (requests.RequestException, CircuitOpenError):
+            metrics.count('crossref_errors')
+            return [None] * len(chunk)
+
+    def lookup(matched):
+        position, doi = matched
+        try:
+            if doi is not None:
+                return fetch_doi(doi, session=session, metrics=metrics)
+            return crossref(raws[position], session=session, metrics=metrics,
+                            metadata=metadata)
+        except (requests.RequestException, CircuitOpenError):
+            metrics.count('crossref_errors')
+            return _FAILED
+
+    chunks = [unsure[start:start + batch_size]
+              for start in xrange(0, len(unsure), batch_size)]
+    dois = list(chain.from_iterable(pool_map(match_chunk, chunks)))
+    metrics.count('batch_matches', sum(1 for doi in dois if doi))
+    found = pool_map(lookup, zip(unsure, dois))
+    for position, value in zip(unsure, found):
+        if value is _FAILED:
+            # not an answer: the reference is looked up again next time
+            resolved[position] = None
+            continue
+        resolved[position] = value
+        if cache is not None:
+            cache.set(keys[position], value)
+
+    entries = []
+    for position, raw in enumerate(raws):
+        if not resolved[position]:
+            metrics.count('parse_fallbacks')
+            resolved[position] = parse(raw, parsed=parsed[position])
+        entries.append(resolved[position])
+    return entries
+
+
+def resolve_deadline(raws, budget, deadline=None, session=requests,
+                     cache=None, index=None, metrics=None,
+                     confidence=DEFAULT_CONFIDENCE, metadata=True,
+                     workers=DEFAULT_WORKERS):
+    """
+    unlabelled bibtex entries of raw references, like resolve_reference,
+    but looked up within the `budget` (a Budget) and before `deadline`:
+    stragglers get a hedged request, and the references not resolved in
+    time, or whose every request failed, fall back to their local parse
+    and are deferred by the budget. Late answers still reach the `cache`.
+    """
+    metrics = metrics or NULL_METRICS
+    metrics.count('references', len(raws))
+    parsed = map(parse_reference, raws)
+    resolved = {}
+    for position, (entry, score) in enumerate(parsed):
+        if score >= confidence:
+            metrics.count('local_resolutions')
+            resolved[position] = entry.to_bibtex()
+    unsure = [position for position in xrange(len(raws))
+              if position not in resolved]
+
+    def lookup(raw):
+        try:
+            return cached_crossref(raw, session=session, cache=cache,
+                                   index=index, metrics=metrics,
+                                   metadata=metadata)
+        except (requests.RequestException, CircuitOpenError):
+            metrics.count('crossref_errors')
+            raise
+
+    found, expired = race(lookup, [raws[position] for position in unsure],
+                          budget, deadline=deadline, workers=workers,
+                          metrics=metrics)
+    resolved.update(zip(unsure, found))
+    budget.defer([raws[unsure[position]] for position in expired])
+    metrics.count('deferred_references', len(expired))
+
+    entries = []
+    for position, raw in enumerate(raws):
+        if not resolved[position]:
+            metrics.count('parse_fallbacks')
+            resolved[position] = parse(raw, parsed=parsed[position])
+        entries.append(resolved[position])
+    return entries
+
+
+def resolve_deferred(log, session=None, cache=None, index=None,
+                     metrics=None, metadata=True, workers=DEFAULT_WORKERS):
+    """
+    Resolve again, without any deadline, the references of a DeferredLog
+    and store their entries in `cache`; the ones failing again go back to
+    the log. Returns the number of references resolved to an entry.
+    """
+    from multiprocessing.pool import ThreadPool
+    metrics = metrics or NULL_METRICS
+    session = session or PooledSession(workers=workers)
+    references = log.take()
+
+    def lookup(raw):
+        try:
+            return cached_crossref(raw, session=session, cache=cache,
+                                   index=index, metrics=metrics,
+                                   metadata=metadata)
+        except (requests.RequestException, CircuitOpenError):
+            metrics.count('crossref_errors')
+            return _FAILED
+
+    pool = ThreadPool(max(1, workers))
+    try:
+        done = pool.map(lookup, references)
+    finally:
+        pool.close()
+        pool.join()
+    log.append([reference for reference, entry in zip(references, done)
+                if entry is _FAILED])
+    log.release()
+    return sum(1 for entry in done if entry not in (None, _FAILED))
+
+
+def resolve(reference, session=requests, cache=None, index=None,
+            metrics=None, confidence=DEFAULT_CONFIDENCE, metadata=True):
+    resolved = resolve_reference(reference['raw'], session=session,
+                                 cache=cache, index=index, metrics=metrics,
+                                 confidence=confidence, metadata=metadata)
     return set_label(resolved, reference['label'])
+
+
+def resolve_clusters(references, duplicates, resolver):
+    """
+    Resolve a single reference per cluster of near-duplicates and share its
+    result with the rest of the cluster (and with later references).
+    `resolver` maps a list of raw references to their unlabelled entries.
+    """
+    representatives = [duplicates.representative(reference['raw'])
+                       for reference in references]
+    resolved = dict((representative, duplicates.resolved[representative])
+                    for representative in set(representatives)
+                    if representative in duplicates.resolved)
+    pending = OrderedDict()
+    for representative, reference in zip(representatives, references):
+        if representative not in resolved:
+            pending.setdefault(representative, reference['raw'])
+    resolved.update(zip(pending, resolver(pending.values())))
+    for representative in pending:
+        duplicates.resolved[representative] = resolved[representative]
+    return [set_label(resolved[representative], reference['label'])
+            for representative, reference in zip(representatives, references)]
+
+
+def iter_resolve(references, workers=DEFAULT_WORKERS, session=None,
+                 cache=None, duplicates=None, index=None, metrics=None,
+                 confidence=DEFAULT_CONFIDENCE, batch_size=DEFAULT_BATCH_SIZE,
+                 metadata=True, budget=None, deadline=None):
+    """
+    Resolve references concurrently and yield them in their original order.
+    References are consumed by windows so that memory does not grow with
+    the number of references. With `duplicates` (a NearDuplicates index),
+    near-duplicate references are only resolved once. With a `batch_size`
+    (and no local `index`), the references of a window are matched by
+    batches instead of one query each. With a `budget`, references are
+    rather queried one by one, within the budget and before `deadline`
+    (see resolve_deadline).
+    """
+    # deferred: loading multiprocessing is not needed by every command
+    from multiprocessing.pool import ThreadPool
+    session = session or PooledSession(workers=workers)
+    workers = max(1, workers)
+    references = iter(references)
+    pool = ThreadPool(workers)
+    size = workers * RESOLUTION_WINDOW
+    if budget is not None:
+        resolver = functools.partial(resolve_deadline, budget=budget,
+                                     deadline=deadline, session=session,
+                                     cache=cache, index=index,
+                                     metrics=metrics, confidence=confidence,
+                                     metadata=metadata, workers=workers)
+    elif batch_size and index is None:
+        size = max(size, batch_size)
+        resolver = functools.partial(resolve_batch, session=session,
+                                     cache=cache, metrics=metrics,
+                                     confidence=confidence,
+                                     batch_size=batch_size, pool=pool,
+                                     metadata=metadata)
+    else:
+        resolver = functools.partial(pool.map, functools.partial(
+            resolve_reference, session=session, cache=cache, index=index,
+            metrics=metrics, confidence=confidence, metadata=metadata))
+    try:
+        while True:
+            window = list(islice(references, size))
+            if not window:
+                break
+            if duplicates is None:
+                resolved = [set_label(entry, reference['label'])
+                            for entry, reference in zip(
+                                resolver([reference['raw']
+                                          for reference in window]),
+                                window)]
+            else:
+                resolved = resolve_clusters(window, duplicates, resolver)
+            for entry in resolved:
+                yield entry
+    finally:
+        pool.close()
+        pool.join()
+
+
+def resolve_all(references, workers=DEFAULT_WORKERS, session=None,
+                cache=None, duplicates=None, index=None, metrics=None,
+                confidence=DEFAULT_CONFIDENCE, batch_size=DEFAULT_BATCH_SIZE,
+                metadata=True, budget=None, deadline=None):
+    """
+    Resolve references concurrently; results keep the references order.
+    """
+    return list(iter_resolve(references, workers=workers, session=session,
+                             cache=cache, duplicates=duplicates,
+                             index=index, metrics=metrics,
+                             confidence=confidence, batch_size=batch_size,
+                             metadata=metadata, budget=budget,
+                             deadline=deadline))
@@ -1,3 +1,11 @@
+# -*- coding: utf-8 -*-
+
+from collections import MutableMapping
+
+from .bibtex import iter_records
+from .latex import latexify
+
+
 def one(args):
     """
     >>> one([True, False])
@@ -58,6 +66,103 @@ class Xor(object):
         return filter(None, content)[0]
 
 
+# fields whose values repeat across entries and are shared between them
+INTERNED_FIELDS = frozenset(['journal', 'publisher', 'booktitle', 'series',
+                             'school', 'institution', 'organization',
+                             'address', 'howpublished', 'month', 'year',
+                             'type'])
+# identifiers every entry type may carry, serialized after the spec fields
+IDENTIFIER_FIELDS = ['doi', 'url']
+_interned = {}
+
+
+def intern_value(value):
+    """
+    >>> intern_value(''.join(['Phys. ', 'Rev.'])) is intern_value('Phys. Rev.')
+    True
+    """
+    try:
+        return _interned.setdefault(value, value)
+    except TypeError:
+        return value
+
+
+def spec_fields(keys):
+    """
+    >>> spec_fields(['title', Xor('author', 'editor'), 'title'])
+    ('title', 'author', 'editor')
+    """
+    fields = []
+    for key in keys:
+        for field in (key.fields if isinstance(key, (Or, Xor)) else (key,)):
+            if field not in fields:
+                fields.append(field)
+    return tuple(fields)
+
+
+class EntryType(type):
+    """
+    Compile an entry `spec` once, at class creation: the fields it lists get
+    their own slot and the validator/serializer only walk precomputed
+    tuples.
+    """
+    def __new__(mcs, name, bases, namespace):
+        spec = namespace['spec']
+        optional = spec_fields(spec['optional'] + IDENTIFIER_FIELDS)
+        layout = spec_fields(spec['required'] + list(optional))
+        inherited = set()
+        for base in bases:
+            inherited.update(getattr(base, '_layout', ()))
+        namespace['__slots__'] = tuple(namespace.get('__slots__', ())) + \
+            tuple(field for field in layout if field not in inherited)
+        namespace['_layout'] = frozenset(layout)
+        namespace['_required'] = tuple(spec['required'])
+        namespace['_required_fields'] = tuple(
+            key for key in spec['required'] if not isinstance(key, (Or, Xor)))
+        namespace['_alternatives'] = tuple(
+            key for key in spec['required'] if isinstance(key, (Or, Xor)))
+        namespace['_optional'] = optional
+        namespace['_head'] = spec['format'].split('{', 1)[0] + '{'
+        return super(EntryType, mcs).__new__(mcs, name, bases, namespace)
+
+
+class Fields(MutableMapping):
+    """ dict-like, write-through view on the fields of an entry """
+    __slots__ = ('_entry',)
+
+    def __init__(self, entry):
+        self._entry = entry
+
+    def __getitem__(self, key):
+        value = self._entry._get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._entry._set(key, value)
+
+    def __delitem__(self, key):
+        if self._entry._get(key) is None:
+            raise KeyError(key)
+        self._entry._set(key, None)
+
+    def __iter__(self):
+        entry = self._entry
+        for field in entry.__class__.fields():
+            if getattr(entry, field, None) is not None:
+                yield field
+        for field, value in entry._extra.items():
+            if value is not None:
+                yield field
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
 # from http://nwalsh.com/tex/texhelp/bibtx-7.html
 class Entry(object):
     """
@@ -82,8 +187,25 @@ class Entry(object):
     >>> article.entries['journal'] = 'paywall'
     >>> article.is_valid()
     True
-    >>> print article.to_bibtex()
+    >>> print article.to_bibtex()  # doctest: +NORMALIZE_WHITESPACE
+    @ARTICLE{None,
+        author = {foo},
+        title = {foo},
+        journal = {paywall},
+        year = {2013},
+        pages = {05--17}}
+    >>> print Book(json={'editor': 'foo', 'title': 'bar', 'publisher': 'baz',
+    ...                  'year': 2013}).to_bibtex('foo')
+    ... # doctest: +NORMALIZE_WHITESPACE
+    @BOOK{foo,
+        editor = {foo},
+        title = {bar},
+        publisher = {baz},
+        year = {2013}}
     """
+    __metaclass__ = EntryType
+    __slots__ = ('_extra', 'label')
+
     spec = {
         'required': [],
         'optional': [],
@@ -91,48 +213,96 @@ class Entry(object):
     }
 
     def __init__(self, **kwargs):
-        self.entries = kwargs['json'] if kwargs.get('json') \
+        self._extra = {}
+        self.label = kwargs.get('label')
+        entries = kwargs['json'] if kwargs.get('json') is not None \
             else self.from_bibtex(kwargs['bibtex'])
+        for key, value in entries.items():
+            self._set(key, value)
+
+    @classmethod
+    def fields(cls):
+        """ slotted fields, in spec order """
+        for klass in reversed(cls.__mro__):
+            for field in klass.__dict__.get('__slots__', ()):
+                if field in cls._layout:
+                    yield field
+
+    def from_bibtex(self, bibtex):
+        """
+        >>> Article(bibtex='@article{foo, title={Bar}, year=2013}').label
+        'foo'
+        """
+        for _, label, fields in iter_records(bibtex):
+            self.label = self.label or label
+            return fields
+        raise ValueError('no bibtex entry found in {!r}'.format(bibtex))
+
+    def _get(self, key):
+        if key in self._layout:
+            return getattr(self, key, None)
+        return self._extra.get(key)
+
+    def _set(self, key, value):
+        if key in INTERNED_FIELDS:
+            value = intern_value(value)
+        if key in self._layout:
+            setattr(self, key, value)
+        else:
+            self._extra[key] = value
+
+    @property
+    def entries(self):
+        return Fields(self)
 
     @staticmethod
     def _format_bibtex_entry(key, value):
-        return '\n\t{key} = {{{value}}}'.format(key=key, value=value) if value else ''
+        return '\n\t%s = {%s}' % (key, value) if value else ''
 
     @property
     def _spec(self):
         return self.__class__.spec
 
-    def _format_bibtex_required(self):
-        bibtex_entry = Entry._format_bibtex_entry
-        return ','.join(map(lambda key: bibtex_entry(key, self[key]),
-                            self._spec['required']))
-
-    def _format_bibtex_optional(self):
-        bibtex_entry = Entry._format_bibtex_entry
-        return ','.join(filter(None,
-                               map(lambda key: bibtex_entry(key, self[key]),
-                                   self._spec['optional'])))
+    def _resolve(self, key):
+        """ (field name, value) of a spec key, None if unset """
+        if key.__class__ in (Or, Xor):
+            values = [(field, self._get(field)) for field in key.fields]
+            values = [(field, value) for field, value in values if value]
+            if not values or isinstance(key, Xor) and len(values) != 1:
+                return (None, None)
+            return values[0]
+        return (key, getattr(self, key, None))
 
     def is_valid(self):
-        return all(self[key] for key in self.__class__.spec['required'])
-
-    def to_bibtex(self, label=None):
-        required = self._format_bibtex_required()
-        optional = self._format_bibtex_optional()
+        for key in self._required_fields:
+            if not getattr(self, key, None):
+                return False
+        for key in self._alternatives:
+            if not self._resolve(key)[1]:
+                return False
+        return True
+
+    def to_bibtex(self, label=None, escape=None):
+        """ `escape` (e.g. latexify) is applied to every field value """
+        bibtex_entry = Entry._format_bibtex_entry
+        if escape is not None:
+            bibtex_entry = lambda key, value: \
+                Entry._format_bibtex_entry(key, escape(value))
+        required = ','.join(filter(None, [bibtex_entry(*self._resolve(key))
+                                          for key in self._required]))
+        optional = ','.join([bibtex_entry(key, value)
+                             for key, value in [(key, getattr(self, key, None))
+                                                for key in self._optional]
+                             if value])
         sep = ',' if required and optional else ''
-        return self._spec['format'].format(label=label,
-                                           required=required,
-                                           sep=sep,
-                                           optional=optional)
+        label = label if label is not None else self.label
+        return ''.join([self._head, '%s' % label, ', ', required, sep,
+                        optional, '}'])
 
     def __getitem__(self, key):
-        try:
-            if isinstance(key, (Xor, Or)):
-                return key.inside(self.entries)
-            else:
-                return self.entries[key]
-        except KeyError:
-            return None
+        if isinstance(key, (Xor, Or)):
+            return key.inside(self.entries)
+        return self._get(key)
 
 
 class Article(Entry):
@@ -301,10 +471,180 @@ class Unpublished(Entry):
     }
 
 
+# bytes held by a BibtexWriter before they are written out
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+
+def _bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return '' if value is None else str(value)
+
+
+def sort_key(entry):
+    """ deterministic order of entries: by label, type, then main fields """
+    return (_bytes(entry.label), entry.spec['type']) + tuple(
+        _bytes(entry._get(field)) for field in ('year', 'title', 'doi'))
+
+
+def label_suffix(number):
+    """
+    suffix of the `number`-th repetition of a label
+
+    >>> [label_suffix(number) for number in (1, 2, 26, 27)]
+    ['a', 'b', 'z', 'aa']
+    """
+    suffix = ''
+    while number:
+        number, digit = divmod(number - 1, 26)
+        suffix = chr(ord('a') + digit) + suffix
+    return suffix
+
+
+class BibtexWriter(object):
+    """
+    Buffered writer of bibtex entries: each entry is serialized (its values
+    escaped by latexify) as one record, and records are written to `output`
+    by chunks of about `buffer_size` bytes. With `unique_labels`, a label
+    already written gets the first free suffix (foo13, foo13a, foo13b...).
+
+    >>> from StringIO import StringIO
+    >>> output = StringIO()
+    >>> with BibtexWriter(output, unique_labels=True) as writer:
+    ...     for title in ('Foo & Bar', 'Baz'):
+    ...         label = writer.write(Misc(label='foo13', json={'title': title}))
+    >>> label, writer.count
+    ('foo13a', 2)
+    >>> print(output.getvalue())  # doctest: +NORMALIZE_WHITESPACE
+    @MISC{foo13, title = {Foo \\& Bar}}
+    @MISC{foo13a, title = {Baz}}
+    """
+    def __init__(self, output, escape=True, unique_labels=False,
+                 buffer_size=DEFAULT_BUFFER_SIZE):
+        self.output = output
+        self.escape = latexify if escape else None
+        self.labels = set() if unique_labels else None
+        self.buffer_size = buffer_size
+        self.count = 0
+        self._suffixes = {}
+        self._buffer = []
+        self._size = 0
+
+    def _unique(self, label):
+        if self.labels is None or label is None:
+            return label
+        # suffixes already taken are not tried again: numeric labels repeat
+        # across a whole corpus
+        number = self._suffixes.get(label, 0)
+        unique = label + label_suffix(number)
+        while unique in self.labels:
+            number += 1
+            unique = label + label_suffix(number)
+        self._suffixes[label] = number
+        self.labels.add(unique)
+        return unique
+
+    def write(self, entry):
+        """ buffer an entry, returns the label it is written with """
+        label = self._unique(_bytes(entry.label) if entry.label is not None
+                             else None)
+        record = entry.to_bibtex(label, escape=self.escape)
+        if isinstance(record, unicode):
+            record = record.encode('utf-8')
+        self._buffer.append(record)
+        self._buffer.append('\n')
+        self._size += len(record) + 1
+        self.count += 1
+        if self._size >= self.buffer_size:
+            self.flush()
+        return label
+
+    def flush(self):
+        if self._buffer:
+            self.output.write(''.join(self._buffer))
+            del self._buffer[:]
+            self._size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.flush()
+
+
 class Bibtex(object):
+    """
+    Collection of entries, written out as a bibtex file. Entries are kept
+    in insertion order, or sorted by sort_key when `ordered`, and their
+    labels made unique at write time with `unique_labels`: the same
+    entries always give the same file.
+
+    >>> from StringIO import StringIO
+    >>> bibtex = Bibtex([Misc(label='smith99', json={'title': 'Müller'}),
+    ...                  Misc(label='doe07', json={'title': 'Y'}),
+    ...                  Misc(label='doe07', json={'title': 'X'})],
+    ...                 unique_labels=True, ordered=True)
+    >>> output = StringIO()
+    >>> bibtex.write(output), len(bibtex)
+    (3, 3)
+    >>> print(output.getvalue())  # doctest: +NORMALIZE_WHITESPACE
+    @MISC{doe07, title = {X}}
+    @MISC{doe07a, title = {Y}}
+    @MISC{smith99, title = {M{\\"u}ller}}
+    """
     entries = [Article, Book, Booklet, Conference, InBook, InCollection,
                InProceedings, Manual, MasterThesis, Misc, PhdThesis,
                Proceedings, TechReport, Unpublished]
+    types = dict([(entry.spec['type'], entry) for entry in entries] +
+                 [('mastersthesis', MasterThesis)])
 
-    def __init__(self, **kwargs):
-        pass
+    @classmethod
+    def entry(cls, kind, label, fields):
+        """ build the Entry matching a bibtex type, Misc for unknown ones """
+        return cls.types.get(kind, Misc)(json=fields, label=label)
+
+    def __init__(self, entries=(), unique_labels=False, ordered=False):
+        self._entries = list(entries)
+        self.unique_labels = unique_labels
+        self.ordered = ordered
+
+    def add(self, entry):
+        self._entries.append(entry)
+
+    def extend(self, entries):
+        self._entries.extend(entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        if self.ordered:
+            return iter(sorted(self._entries, key=sort_key))
+        return iter(self._entries)
+
+    def write(self, output, escape=True, buffer_size=DEFAULT_BUFFER_SIZE):
+        """ write the entries to `output`, returns their number """
+        with BibtexWriter(output, escape=escape,
+                          unique_labels=self.unique_labels,
+                          buffer_size=buffer_size) as writer:
+            for entry in self:
+                writer.write(entry)
+        return writer.count
+
+    def save(self, path, **options):
+        with open(path, 'wb') as output:
+            return self.write(output, **options)
+
+
+def iter_bibtex(bibtex):
+    """
+    Lazily map the records of a bibtex stream (or string) onto their Entry
+    subclass.
+
+    >>> [(entry.__class__.__name__, entry.label, entry['journal'])
+    ...  for entry in iter_bibtex('''@ARTICLE{foo, journal = {Nature}}
+    ...                            @online{bar, title = "Baz"}''')]
+    [('Article', 'foo', 'Nature'), ('Misc', 'bar', None)]
+    """
+    for kind, label, fields in iter_records(bibtex):
+        yield Bibtex.entry(kind, label, fields)
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+""" incremental bibtex reader """
+
+import re
+from collections import OrderedDict
+from StringIO import StringIO
+
+
+CHUNK_SIZE = 1 << 16
+
+MONTHS = {'jan': 'January', 'feb': 'February', 'mar': 'March',
+          'apr': 'April', 'may': 'May', 'jun': 'June', 'jul': 'July',
+          'aug': 'August', 'sep': 'September', 'oct': 'October',
+          'nov': 'November', 'dec': 'December'}
+
+_header = re.compile(r'@\s*([A-Za-z][\w-]*)\s*([{(])')
+# longest header we wait for before deciding an '@' is not an entry
+_header_size = 256
+_closing = {'{': re.compile(r'[{}]'), '(': re.compile(r'[{})]')}
+_name = re.compile(r'\s*([^\s=,{}"#()]+)\s*=\s*')
+# fast path for fields holding a single, unnested value
+_simple = re.compile(r'\s*([^\s=,{}"#()]+)\s*=\s*'
+                     r'(?:\{([^{}]*)\}|"([^"{}]*)"|([^\s,#{}"]+))\s*(?:,|\Z)')
+_bare = re.compile(r'[^\s,#{}"]+')
+_blanks = re.compile(r'\s+')
+# values with blanks to normalize
+_untidy = re.compile(r'^\s|\s$|\s\s|[^\S ]')
+
+
+class BibtexError(ValueError):
+    pass
+
+
+class BibtexReader(object):
+    """
+    Lazily read `(type, key, fields)` records from a bibtex stream: the
+    stream is consumed by chunks and only the entry being parsed is kept in
+    memory. @string macros, '#' concatenation, quoted and (nested) braced
+    values are supported; @comment and @preamble are skipped.
+
+    >>> bibtex = '''
+    ... @string{prl = "Phys. Rev." # { Lett.}}
+    ... @comment{ignored}
+    ... @Article{foo,
+    ...   author = {M{\\\\"u}ller, J.},
+    ...   journal = prl,
+    ...   month = jan,
+    ...   year = 2013,
+    ... }
+    ... @book(bar, title = "A {"}quoted{"} title")'''
+    >>> for record in BibtexReader(StringIO(bibtex), chunk_size=16):
+    ...     print(record)
+    ('article', 'foo', OrderedDict([('author', 'M{\\\\"u}ller, J.'), ('journal', 'Phys. Rev. Lett.'), ('month', 'January'), ('year', '2013')]))
+    ('book', 'bar', OrderedDict([('title', 'A {"}quoted{"} title')]))
+    """
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.macros = dict(MONTHS)
+
+    def __iter__(self):
+        return self.records()
+
+    def records(self):
+        chunks = iter(lambda: self.stream.read(self.chunk_size), '')
+        buffer, position = '', 0
+        while True:
+            start = buffer.find('@', position)
+            if start == -1:
+                # text outside of entries is a comment
+                buffer, position = next(chunks, None), 0
+                if buffer is None:
+                    return
+                continue
+
+            header = _header.match(buffer, start)
+            while header is None and len(buffer) - start < _header_size:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                buffer, start = buffer[start:] + chunk, 0
+                header = _header.match(buffer, start)
+            if header is None:
+                position = start + 1
+                continue
+
+            end, buffer, header = self._find_end(buffer, header, chunks)
+            if end is None:
+                raise BibtexError('unterminated entry @{}'.format(
+                    header.group(1)))
+            record = self._record(header.group(1).lower(),
+                                  buffer[header.end():end])
+            position = end + 1
+            if record is not None:
+                yield record
+
+    def _find_end(self, buffer, header, chunks):
+        """
+        Position of the delimiter closing the entry opened by `header`, along
+        with the (possibly refilled) buffer and header.
+        """
+        opening = header.group(2)
+        closing = _closing[opening]
+        depth, position = 0, header.end()
+        while True:
+            for delimiter in closing.finditer(buffer, position):
+                char = delimiter.group()
+                if char == '{':
+                    depth += 1
+                elif depth:
+                    depth -= 1
+                elif char == ')' or opening == '{':
+                    return (delimiter.start(), buffer, header)
+            chunk = next(chunks, None)
+            if chunk is None:
+                return (None, buffer, header)
+            # keep the entry being read, drop what precedes it
+            offset = header.start()
+            header = _header.match(buffer[offset:] + chunk)
+            position = len(buffer) - offset
+            buffer = buffer[offset:] + chunk
+
+    def _record(self, kind, body):
+        if kind in ('comment', 'preamble'):
+            return None
+        if kind == 'string':
+            for name, value in self._fields(body).items():
+                self.macros[name] = value
+            return None
+        key, _, body = body.partition(',')
+        return (kind, key.strip(), self._fields(body))
+
+    def _fields(self, body):
+        fields = OrderedDict()
+        position = 0
+        while True:
+            simple = _simple.match(body, position)
+            if simple is not None:
+                value = simple.group(simple.lastindex)
+                if simple.lastindex == 4 and not value.isdigit():
+                    value = self.macros.get(value.lower(), value)
+                position = simple.end()
+            else:
+                name = _name.match(body, position)
+                if name is None:
+                    return fields
+                value, position = self._value(body, name.end())
+                position = body.find(',', position)
+                position = len(body) if position == -1 else position + 1
+            if _untidy.search(value) is not None:
+                value = _blanks.sub(' ', value).strip()
+            fields[(simple or name).group(1).lower()] = value
+
+    def _value(self, body, position):
+        """ value starting at `position`, with its '#' concatenations """
+        pieces = []
+        while True:
+            while position < len(body) and body[position].isspace():
+                position += 1
+            if position >= len(body):
+                break
+            char = body[position]
+            if char == '{':
+                end = _matching_brace(body, position)
+                pieces.append(body[position + 1:end])
+                position = end + 1
+            elif char == '"':
+                end = _closing_quote(body, position)
+                pieces.append(body[position + 1:end])
+                position = end + 1
+            else:
+                bare = _bare.match(body, position)
+                if bare is None:
+                    break
+                word = bare.group()
+                pieces.append(word if word.isdigit()
+                              else self.macros.get(word.lower(), word))
+                position = bare.end()
+            while position < len(body) and body[position].isspace():
+                position += 1
+            if not body.startswith('#', position):
+                break
+            position += 1
+        return (''.join(pieces), position)
+
+
+def _matching_brace(text, position):
+    depth = 0
+    for delimiter in _closing['{'].finditer(text, position):
+        depth += 1 if delimiter.group() == '{' else -1
+        if not depth:
+            return delimiter.start()
+    raise BibtexError('unbalanced braces in {!r}'.format(text[position:]))
+
+
+def _closing_quote(text, position):
+    depth = 0
+    for index in xrange(position + 1, len(text)):
+        char = text[index]
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+        elif char == '"' and not depth:
+            return index
+    raise BibtexError('unterminated quote in {!r}'.format(text[position:]))
+
+
+def iter_records(bibtex):
+    """ records of a bibtex stream or string """
+    if isinstance(bibtex, basestring):
+        bibtex = StringIO(bibtex)
+    return iter(BibtexReader(bibtex))
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+""" persistent cache of resolved references """
+
+import threading
+import time
+
+from .lazy import LazyModule
+
+
+# only loaded once a cache is opened
+sqlite3 = LazyModule('sqlite3')
+
+# resolved references are kept for 90 days
+DEFAULT_TTL = 90 * 24 * 3600
+# references crossref could not resolve are retried after a week
+DEFAULT_NEGATIVE_TTL = 7 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 1000000
+# size bound is enforced every EVICTION_PERIOD insertions
+EVICTION_PERIOD = 1000
+
+
+class ResolutionCache(object):
+    """
+    SQLite-backed store of crossref results keyed by reference fingerprint.
+    Unresolved references are stored as negative results (`None`).
+
+    >>> cache = ResolutionCache(':memory:')
+    >>> cache.get('foo')
+    (False, None)
+    >>> cache.set('foo', '@misc{foo, note = {bar}}')
+    >>> cache.set('baz', None)
+    >>> cache.get('foo')
+    (True, '@misc{foo, note = {bar}}')
+    >>> cache.get('baz')
+    (True, None)
+    >>> cache.stats()
+    {'hits': 2, 'misses': 1, 'size': 2}
+    """
+    def __init__(self, path, ttl=DEFAULT_TTL,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._insertions = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.text_factory = str
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS crossref ('
+                ' key TEXT PRIMARY KEY,'
+                ' bibtex TEXT,'
+                ' created REAL,'
+                ' accessed REAL)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS crossref_accessed'
+                ' ON crossref (accessed)')
+
+    def _expired(self, bibtex, created, now):
+        ttl = self.ttl if bibtex is not None else self.negative_ttl
+        return created + ttl < now
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT bibtex, created FROM crossref WHERE key = ?',
+                (key,)).fetchone()
+            if row is None or self._expired(row[0], row[1], now):
+                self.misses += 1
+                return (False, None)
+            with self._connection:
+                self._connection.execute(
+                    'UPDATE crossref SET accessed = ? WHERE key = ?',
+                    (now, key))
+            self.hits += 1
+            return (True, row[0])
+
+    def set(self, key, bibtex):
+        now = time.time()
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO crossref VALUES (?, ?, ?, ?)',
+                    (key, bibtex, now, now))
+                self._insertions += 1
+                if self._insertions % EVICTION_PERIOD == 0:
+                    self._evict()
+
+    def _evict(self):
+        # drop least recently accessed entries beyond the size bound
+        self._connection.execute(
+            'DELETE FROM crossref WHERE key IN ('
+            ' SELECT key FROM crossref ORDER BY accessed DESC'
+            ' LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def purge(self):
+        """ remove expired entries """
+        now = time.time()
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    'DELETE FROM crossref WHERE'
+                    ' (bibtex IS NOT NULL AND created + ? < ?) OR'
+                    ' (bibtex IS NULL AND created + ? < ?)',
+                    (self.ttl, now, self.negative_ttl, now))
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM crossref').fetchone()[0]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
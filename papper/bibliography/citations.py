@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+""" citation graph of papers and the DOIs they cite """
+
+import mmap
+import os
+import struct
+from array import array
+from itertools import chain, izip
+
+
+NAMES = 'names.txt'
+NAME_OFFSETS = 'names.offsets'
+# node ids sorted by name, for lookups by bisection
+NAME_ORDER = 'names.order'
+CITES_OFFSETS = 'cites.offsets'
+CITES = 'cites.targets'
+CITED_BY_OFFSETS = 'cited_by.offsets'
+CITED_BY = 'cited_by.sources'
+# citations recorded since the graph was last rebuilt
+PENDING = 'pending.tsv'
+
+DIRECTIONS = ('cites', 'cited_by', 'both')
+
+
+def checked(names):
+    """
+    `names` of papers or DOIs, which are stored as tab separated fields and
+    newline terminated rows
+
+    >>> checked(['1501.00001', '10.1/a'])
+    ['1501.00001', '10.1/a']
+    >>> checked(['10.1/a\\tb'])
+    Traceback (most recent call last):
+    ...
+    ValueError: name with a tab or newline: '10.1/a\\tb'
+    """
+    for name in names:
+        if '\t' in name or '\n' in name:
+            raise ValueError('name with a tab or newline: {!r}'.format(name))
+    return names
+
+
+def csr(keys, values, size):
+    """
+    Compressed sparse rows of the `(key, value)` pairs: `values[offsets[k]:
+    offsets[k + 1]]` are the values of key k, in insertion order.
+
+    >>> offsets, ordered = csr(array('I', [2, 0, 2]), array('I', [7, 8, 9]), 3)
+    >>> map(int, offsets), map(int, ordered)
+    ([0, 1, 1, 3], [8, 7, 9])
+    """
+    offsets = array('I', [0]) * (size + 1)
+    for key in keys:
+        offsets[key + 1] += 1
+    for node in xrange(size):
+        offsets[node + 1] += offsets[node]
+    position = array('I', offsets)
+    ordered = array('I', [0]) * len(values)
+    for key, value in izip(keys, values):
+        ordered[position[key]] = value
+        position[key] += 1
+    return offsets, ordered
+
+
+class CitationGraph(object):
+    """
+    Papers and the DOIs they cite, interned to integer ids. Adjacency is
+    stored as CSR arrays in both directions (what a node cites, what cites
+    it) and every file is memory-mapped: queries only page in the rows they
+    walk and names are found by bisection over the sorted ids.
+
+    >>> import shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> graph = CitationGraph.update(directory, [
+    ...     ('1501.00001', ['10.1/a', '10.1/b']), ('1501.00002', ['10.1/b'])])
+    >>> graph.cites('1501.00001'), graph.cited_by('10.1/b')
+    (['10.1/a', '10.1/b'], ['1501.00001', '1501.00002'])
+    >>> sorted(graph.neighbourhood('1501.00002', hops=3).items())
+    [('10.1/a', 3), ('10.1/b', 1), ('1501.00001', 2)]
+    >>> graph.close()
+    >>> graph = CitationGraph.update(directory, [('1501.00001', ['10.1/c'])])
+    >>> graph.cites('1501.00001'), graph.cited_by('10.1/a')
+    (['10.1/c'], [])
+    >>> graph.size, graph.edges
+    (5, 2)
+    >>> graph.close()
+    >>> CitationGraph.record(directory, [('1501.00003', ['10.1/a'])])
+    >>> graph = CitationGraph.update(directory)
+    >>> graph.cited_by('10.1/a')
+    ['1501.00003']
+    >>> graph.close(); shutil.rmtree(directory)
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._files = []
+        self._maps = []
+        self.size = 0
+        self.edges = 0
+        if not os.path.exists(os.path.join(directory, NAME_ORDER)):
+            return
+        self._names = self._map(NAMES)
+        self._name_offsets = self._map(NAME_OFFSETS)
+        self._order = self._map(NAME_ORDER)
+        self._cites = (self._map(CITES_OFFSETS), self._map(CITES))
+        self._cited_by = (self._map(CITED_BY_OFFSETS), self._map(CITED_BY))
+        self.size = len(self._order) // 4
+        self.edges = len(self._cites[1]) // 4
+
+    def _map(self, name):
+        data = open(os.path.join(self.directory, name), 'rb')
+        self._files.append(data)
+        if not os.fstat(data.fileno()).st_size:
+            return ''
+        mapped = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return mapped
+
+    def close(self):
+        for mapped in self._maps:
+            mapped.close()
+        for data in self._files:
+            data.close()
+
+    def name(self, node):
+        start, end = struct.unpack_from('=II', self._name_offsets, 4 * node)
+        return self._names[start:end - 1]
+
+    def identifier(self, name):
+        """ id of a paper or DOI, None if it is not in the graph """
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            node, = struct.unpack_from('=I', self._order, 4 * middle)
+            if self.name(node) < name:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.size:
+            node, = struct.unpack_from('=I', self._order, 4 * low)
+            if self.name(node) == name:
+                return node
+        return None
+
+    def _adjacent(self, rows, node):
+        offsets, values = rows
+        start, end = struct.unpack_from('=II', offsets, 4 * node)
+        adjacent = array('I')
+        adjacent.fromstring(values[4 * start:4 * end])
+        return adjacent
+
+    def _neighbours(self, node, direction):
+        if direction in ('cites', 'both'):
+            for adjacent in self._adjacent(self._cites, node):
+                yield adjacent
+        if direction in ('cited_by', 'both'):
+            for adjacent in self._adjacent(self._cited_by, node):
+                yield adjacent
+
+    def cites(self, name):
+        """ DOIs cited by a paper """
+        node = self.identifier(name)
+        return [] if node is None else \
+            [self.name(target) for target in self._adjacent(self._cites, node)]
+
+    def cited_by(self, name):
+        """ papers citing a DOI """
+        node = self.identifier(name)
+        return [] if node is None else \
+            [self.name(source)
+             for source in self._adjacent(self._cited_by, node)]
+
+    def neighbourhood(self, name, hops=2, direction='both'):
+        """
+        nodes reached from `name` within `hops` citations (followed in
+        `direction`: 'cites', 'cited_by' or 'both'), with their distance
+        """
+        start = self.identifier(name)
+        if start is None:
+            return {}
+        distances = {start: 0}
+        frontier = [start]
+        for hop in xrange(1, hops + 1):
+            following = []
+            for node in frontier:
+                for adjacent in self._neighbours(node, direction):
+                    if adjacent not in distances:
+                        distances[adjacent] = hop
+                        following.append(adjacent)
+            frontier = following
+        del distances[start]
+        return dict((self.name(node), distance)
+                    for node, distance in distances.items())
+
+    @staticmethod
+    def record(directory, citations):
+        """
+        append `(paper, cited DOIs)` pairs to the citations merged by the
+        next update; nothing is recorded if a name holds a tab or newline
+        """
+        rows = [checked([paper] + list(cited)) for paper, cited in citations]
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, PENDING), 'a') as pending:
+            pending.write(''.join('\t'.join(row) + '\n' for row in rows))
+
+    @staticmethod
+    def _pending(directory):
+        try:
+            with open(os.path.join(directory, PENDING), 'r') as pending:
+                for line in pending:
+                    fields = line.rstrip('\n').split('\t')
+                    yield (fields[0], filter(None, fields[1:]))
+        except IOError:
+            return
+
+    @staticmethod
+    def update(directory, citations=()):
+        """
+        Merge the recorded citations, then the `(paper, cited DOIs)` pairs,
+        into the graph of `directory` (created if needed) and return the
+        updated graph: the DOIs of a paper replace the ones it previously
+        cited. The name table is held in memory while the arrays are
+        rebuilt; queries only map them.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        citations = chain(CitationGraph._pending(directory), citations)
+        previous = CitationGraph(directory)
+        names = [previous.name(node) for node in xrange(previous.size)]
+        ids = dict((name, node) for node, name in enumerate(names))
+
+        def intern(name):
+            node = ids.get(name)
+            if node is None:
+                node = ids[name] = len(names)
+                names.append(name)
+            return node
+
+        # the latest citations of a paper win
+        replaced = {}
+        for paper, cited in citations:
+            replaced[intern(checked([paper])[0])] = checked(list(cited))
+        sources, targets = array('I'), array('I')
+        for source, cited in replaced.iteritems():
+            seen = set()
+            for target in map(intern, cited):
+                if target not in seen:
+                    seen.add(target)
+                    sources.append(source)
+                    targets.append(target)
+        for node in xrange(previous.size):
+            if node not in replaced:
+                adjacent = previous._adjacent(previous._cites, node)
+                sources.extend(array('I', [node]) * len(adjacent))
+                targets.extend(adjacent)
+        previous.close()
+        replaced.clear()
+        CitationGraph._write(directory, names, sources, targets)
+        if os.path.exists(os.path.join(directory, PENDING)):
+            os.remove(os.path.join(directory, PENDING))
+        return CitationGraph(directory)
+
+    @staticmethod
+    def _write(directory, names, sources, targets):
+        path = lambda name: os.path.join(directory, name)
+        written = []
+
+        def write(name, values):
+            with open(path(name + '.part'), 'wb') as output:
+                values.tofile(output)
+            written.append(name)
+
+        offsets, position = array('I', [0]), 0
+        with open(path(NAMES + '.part'), 'wb') as output:
+            for name in names:
+                output.write(name + '\n')
+                position += len(name) + 1
+                offsets.append(position)
+        written.append(NAMES)
+        write(NAME_OFFSETS, offsets)
+        write(NAME_ORDER, array('I', sorted(xrange(len(names)),
+                                            key=names.__getitem__)))
+        for (offsets_name, values_name), (keys, values) in [
+                ((CITES_OFFSETS, CITES), (sources, targets)),
+                ((CITED_BY_OFFSETS, CITED_BY), (targets, sources))]:
+            offsets, ordered = csr(keys, values, len(names))
+            write(offsets_name, offsets)
+            write(values_name, ordered)
+        # the name order is renamed last: it marks a complete graph
+        for name in sorted(written, key=lambda name: name == NAME_ORDER):
+            os.rename(path(name + '.part'), path(name))
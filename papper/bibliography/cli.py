@@ -2,22 +2,532 @@
 
 import argparse
 import os
-from bbl2bib import bbl_to_bib
+import sys
+from bbl2bib import (stream_bib, resolve_deferred, PooledSession,
+                     DEFAULT_WORKERS, DEFAULT_PER_HOST, DEFAULT_BATCH_SIZE)
+from cache import ResolutionCache, DEFAULT_TTL
+from sources import is_archive
+from manifest import Manifest
+from bibliography import Bibtex, BibtexWriter
+from dedup import NearDuplicates
+from deadline import Budget, DeferredLog, DEFAULT_HEDGE_PERCENTILE
+from metrics import Metrics
+from references import DEFAULT_CONFIDENCE
+from transport import (Transport, DEFAULT_TIMEOUT, DEFAULT_RETRIES,
+                       DEFAULT_RATE)
+# the modules of the other commands (process pools, HTTP server, sqlite
+# store, memory-mapped index and graph) are imported by their command
 
 
-def parse_bibliography_options():
+def parse_bibliography_options(args=None):
     parser = argparse.ArgumentParser(description='Process bibliography:'
                                                  ' convert bbl to bibtex'
                                                  ' format')
     parser.add_argument('input', type=str, default='',
-                        help='Path to folder to be processed')
+                        help='Path to folder or source archive'
+                             ' (tar, tar.gz, gz) to be processed')
+    parser.add_argument('-o', '--output', type=str, default='-',
+                        help='Path to the bibtex output (defaults to stdout)')
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Number of references resolved concurrently')
+    parser.add_argument('--per-host', type=int, default=DEFAULT_PER_HOST,
+                        help='Maximum number of concurrent requests per host')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Path to the persistent resolution cache')
+    parser.add_argument('--cache-ttl', type=int, default=DEFAULT_TTL,
+                        help='Lifetime (in seconds) of cached resolutions')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='Path to the manifest used to only reprocess'
+                             ' modified files')
+    parser.add_argument('--near-duplicates', type=float, default=None,
+                        metavar='THRESHOLD',
+                        help='Resolve near-duplicate references (similarity'
+                             ' above THRESHOLD, e.g. 0.7) only once')
+    parser.add_argument('--doi-index', type=str, default=None,
+                        help='Path to a local DOI index used instead of the'
+                             ' CrossRef search service')
+    add_metrics_options(parser)
+    add_transport_options(parser)
+    add_resolution_options(parser)
+    add_budget_options(parser)
 
-    options = parser.parse_known_args()[0]
-    if os.path.isfile(options.input):
+    options = parser.parse_known_args(args)[0]
+    if os.path.isfile(options.input) and not is_archive(options.input):
         options.input = os.path.dirname(options.input)
     return options
 
 
-def cli():
-    options = parse_bibliography_options()
-    bbl_to_bib(options.input)
+def add_metrics_options(parser):
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Path to the pipeline metrics (stage timings,'
+                             ' counts, latencies) written on exit')
+    parser.add_argument('--metrics-format', choices=('json', 'prometheus'),
+                        default='json',
+                        help='Format of the metrics file')
+
+
+def add_transport_options(parser):
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT[1],
+                        help='Timeout (in seconds) of each resolution'
+                             ' request')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                        help='Number of retries of failed or throttled'
+                             ' resolution requests')
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE,
+                        help='Maximum number of requests per second and per'
+                             ' host')
+
+
+def add_resolution_options(parser):
+    parser.add_argument('--confidence', type=float,
+                        default=DEFAULT_CONFIDENCE,
+                        help='References parsed locally with at least this'
+                             ' confidence (between 0 and 1) are not looked'
+                             ' up on CrossRef; above 1, all are')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Number of references matched by a single'
+                             ' CrossRef request (0 queries them one by one)')
+    parser.add_argument('--fetch-bibtex', action='store_true',
+                        help='Always fetch the bibtex of matched DOIs instead'
+                             ' of building entries from the search results')
+
+
+def add_budget_options(parser):
+    parser.add_argument('--deadline', type=float, default=None,
+                        metavar='SECONDS',
+                        help='Latency budget of each paper: references not'
+                             ' resolved in time fall back to their local'
+                             ' parse')
+    parser.add_argument('--reference-timeout', type=float, default=None,
+                        metavar='SECONDS',
+                        help='Latency budget of each reference')
+    parser.add_argument('--hedge-percentile', type=float,
+                        default=DEFAULT_HEDGE_PERCENTILE,
+                        help='References still unresolved past this'
+                             ' percentile of the observed latencies get a'
+                             ' second request (0 disables hedging)')
+    parser.add_argument('--deferred', type=str, default=None,
+                        help='Path to the log of the references resolved'
+                             ' by a fallback for lack of time (see the'
+                             ' deferred command)')
+
+
+def budget_options(options):
+    """ Budget options, None when no budget is set """
+    if options.deadline is None and options.reference_timeout is None:
+        return None
+    return {'paper': options.deadline, 'reference': options.reference_timeout,
+            'hedge': options.hedge_percentile, 'deferred': options.deferred}
+
+
+def transport_options(options):
+    return {'timeout': (DEFAULT_TIMEOUT[0], options.timeout),
+            'retries': options.retries, 'rate': options.rate}
+
+
+def open_index(path):
+    """ DoiIndex at `path`, None without a path """
+    if not path:
+        return None
+    from index import DoiIndex
+    return DoiIndex(path)
+
+
+def write_metrics(metrics, options):
+    if not options.metrics:
+        return
+    with open(options.metrics, 'w') as output:
+        output.write(metrics.to_prometheus()
+                     if options.metrics_format == 'prometheus'
+                     else metrics.to_json(indent=2) + '\n')
+
+
+def cli(args=None):
+    options = parse_bibliography_options(args)
+    cache = ResolutionCache(options.cache, ttl=options.cache_ttl) \
+        if options.cache else None
+    manifest = Manifest(options.manifest) if options.manifest else None
+    duplicates = NearDuplicates(threshold=options.near_duplicates) \
+        if options.near_duplicates else None
+    index = open_index(options.doi_index)
+    budget = budget_options(options)
+    metrics = Metrics()
+    output = sys.stdout if options.output == '-' \
+        else open(options.output, 'w')
+    try:
+        stream_bib(options.input, output, workers=options.workers,
+                   per_host=options.per_host, cache=cache,
+                   manifest=manifest, duplicates=duplicates, index=index,
+                   metrics=metrics,
+                   transport=Transport(**transport_options(options)),
+                   confidence=options.confidence,
+                   batch_size=options.batch_size,
+                   metadata=not options.fetch_bibtex,
+                   budget=Budget(**budget) if budget else None)
+    finally:
+        write_metrics(metrics, options)
+        if output is not sys.stdout:
+            output.close()
+        if index is not None:
+            index.close()
+        if cache is not None:
+            cache.close()
+
+
+def parse_batch_options(args=None):
+    parser = argparse.ArgumentParser(description='Convert a corpus of papers'
+                                                 ' to one bibtex file per'
+                                                 ' paper')
+    parser.add_argument('input', type=str,
+                        help='Root folder holding one folder or source'
+                             ' archive per paper, or manifest file listing'
+                             ' paper paths')
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help='Folder receiving the bibtex files')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='Number of papers processed in parallel'
+                             ' (defaults to the number of cores)')
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Number of references resolved concurrently'
+                             ' per paper')
+    parser.add_argument('--per-host', type=int, default=DEFAULT_PER_HOST,
+                        help='Maximum number of concurrent requests per host')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Path to the persistent resolution cache')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only reprocess papers modified since the'
+                             ' previous run')
+    parser.add_argument('--near-duplicates', type=float, default=None,
+                        metavar='THRESHOLD',
+                        help='Resolve near-duplicate references (similarity'
+                             ' above THRESHOLD, e.g. 0.7) only once')
+    parser.add_argument('--doi-index', type=str, default=None,
+                        help='Path to a local DOI index used instead of the'
+                             ' CrossRef search service')
+    parser.add_argument('--store', type=str, default=None,
+                        help='Folder of the entry store receiving the'
+                             ' entries of every converted paper')
+    parser.add_argument('--citations', type=str, default=None,
+                        help='Folder of the citation graph receiving the'
+                             ' DOIs cited by every converted paper')
+    add_metrics_options(parser)
+    add_transport_options(parser)
+    add_resolution_options(parser)
+    add_budget_options(parser)
+    return parser.parse_known_args(args)[0]
+
+
+def batch_cli(args=None):
+    from batch import format_summary, list_papers, run_batch
+    options = parse_batch_options(args)
+    metrics = Metrics()
+    summary = run_batch(list_papers(options.input), options.output,
+                        processes=options.processes,
+                        workers=options.workers,
+                        per_host=options.per_host,
+                        cache=options.cache,
+                        incremental=options.incremental,
+                        near_duplicates=options.near_duplicates,
+                        doi_index=options.doi_index,
+                        metrics=metrics,
+                        transport=transport_options(options),
+                        confidence=options.confidence,
+                        batch_size=options.batch_size,
+                        metadata=not options.fetch_bibtex,
+                        store=options.store,
+                        citations=options.citations,
+                        budget=budget_options(options))
+    write_metrics(metrics, options)
+    print(format_summary(summary))
+
+
+def parse_index_options(args=None):
+    parser = argparse.ArgumentParser(description='Build a local DOI index'
+                                                 ' from CrossRef metadata'
+                                                 ' dumps')
+    parser.add_argument('dumps', type=str, nargs='+',
+                        help='CrossRef metadata files (one JSON work per'
+                             ' line)')
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help='Folder receiving the index')
+    return parser.parse_known_args(args)[0]
+
+
+def index_cli(args=None):
+    from index import DoiIndex
+    options = parse_index_options(args)
+    index = DoiIndex.build(options.dumps, options.output)
+    print('{} works indexed, {} terms'.format(index.size,
+                                              len(index.lexicon)))
+    index.close()
+
+
+def parse_store_options(args=None):
+    parser = argparse.ArgumentParser(description='Look up entries in a store'
+                                                 ' filled by batch runs')
+    parser.add_argument('store', type=str,
+                        help='Folder of the entry store')
+    lookup = parser.add_mutually_exclusive_group(required=True)
+    lookup.add_argument('--paper', type=str,
+                        help='Entries of a paper (arXiv id)')
+    lookup.add_argument('--doi', type=str,
+                        help='Entries citing a DOI')
+    lookup.add_argument('--label', type=str,
+                        help='Entries with a citation label')
+    lookup.add_argument('--type', type=str,
+                        help='Entries of a type (article, book...)')
+    lookup.add_argument('--export', type=str, metavar='PATH',
+                        help='Write every entry to a bibtex file (- for'
+                             ' stdout)')
+    parser.add_argument('--unique-labels', action='store_true',
+                        help='Suffix repeated labels of the export (foo13a,'
+                             ' foo13b...)')
+    parser.add_argument('--sort', action='store_true',
+                        help='Sort the export by label (held in memory)'
+                             ' instead of writing it by paper')
+    return parser.parse_known_args(args)[0]
+
+
+def export_store(store, options):
+    output = sys.stdout if options.export == '-' \
+        else open(options.export, 'wb')
+    try:
+        entries = (entry for _, entry in store)
+        if options.sort:
+            count = Bibtex(entries, unique_labels=options.unique_labels,
+                           ordered=True).write(output)
+        else:
+            with BibtexWriter(output,
+                              unique_labels=options.unique_labels) as writer:
+                for entry in entries:
+                    writer.write(entry)
+            count = writer.count
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    sys.stderr.write('{} entries exported\n'.format(count))
+
+
+def store_cli(args=None):
+    from store import EntryStore
+    options = parse_store_options(args)
+    store = EntryStore(options.store)
+    try:
+        if options.export:
+            return export_store(store, options)
+        if options.paper:
+            found = [(options.paper, entry)
+                     for entry in store.get(options.paper)]
+        elif options.doi:
+            found = store.by_doi(options.doi)
+        elif options.label:
+            found = store.by_label(options.label)
+        else:
+            found = store.by_type(options.type)
+        for paper, entry in found:
+            print('% {}\n{}'.format(paper, entry.to_bibtex()))
+    finally:
+        store.close()
+
+
+def parse_citations_options(args=None):
+    from citations import DIRECTIONS
+    parser = argparse.ArgumentParser(description='Query a citation graph'
+                                                 ' filled by batch runs')
+    parser.add_argument('graph', type=str,
+                        help='Folder of the citation graph')
+    parser.add_argument('node', type=str,
+                        help='Paper (arXiv id) or DOI')
+    parser.add_argument('--direction', choices=DIRECTIONS, default='cites',
+                        help='Follow the references of the node (cites),'
+                             ' the papers citing it (cited_by) or both')
+    parser.add_argument('--hops', type=int, default=1,
+                        help='Number of citations followed')
+    return parser.parse_known_args(args)[0]
+
+
+def citations_cli(args=None):
+    from citations import CitationGraph
+    options = parse_citations_options(args)
+    graph = CitationGraph(options.graph)
+    try:
+        found = graph.neighbourhood(options.node, hops=options.hops,
+                                    direction=options.direction)
+        for name, distance in sorted(found.items(),
+                                     key=lambda item: (item[1], item[0])):
+            print('{}\t{}'.format(distance, name))
+    finally:
+        graph.close()
+
+
+def parse_serve_options(args=None):
+    from server import DEFAULT_PORT, DEFAULT_LRU_SIZE
+    parser = argparse.ArgumentParser(description='Serve bibliographies as'
+                                                 ' JSON or bibtex over HTTP')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='Port to listen on')
+    parser.add_argument('--root', type=str, default=None,
+                        help='Folder whose papers may be requested by path'
+                             ' (only uploads are accepted otherwise)')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='Number of papers processed in parallel'
+                             ' (defaults to the number of cores)')
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Number of references resolved concurrently'
+                             ' per paper')
+    parser.add_argument('--per-host', type=int, default=DEFAULT_PER_HOST,
+                        help='Maximum number of concurrent requests per host')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Path to the persistent resolution cache')
+    parser.add_argument('--lru-size', type=int, default=DEFAULT_LRU_SIZE,
+                        help='Number of paper results kept in memory')
+    parser.add_argument('--doi-index', type=str, default=None,
+                        help='Path to a local DOI index used instead of the'
+                             ' CrossRef search service')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Log every request')
+    add_transport_options(parser)
+    add_resolution_options(parser)
+    add_budget_options(parser)
+    return parser.parse_known_args(args)[0]
+
+
+def serve_cli(args=None):
+    from server import BibliographyServer, Resolver
+    options = parse_serve_options(args)
+    resolver = Resolver(processes=options.processes,
+                        lru_size=options.lru_size,
+                        workers=options.workers,
+                        per_host=options.per_host,
+                        cache=options.cache,
+                        doi_index=options.doi_index,
+                        transport=transport_options(options),
+                        confidence=options.confidence,
+                        batch_size=options.batch_size,
+                        metadata=not options.fetch_bibtex,
+                        budget=budget_options(options))
+    server = BibliographyServer((options.host, options.port), resolver,
+                                root=options.root, verbose=options.verbose)
+    print('Serving bibliographies on http://{}:{}'.format(
+        *server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        resolver.close()
+
+
+def parse_worker_options(args=None):
+    parser = argparse.ArgumentParser(description='Resolve the papers whose'
+                                                 ' paths (or JSON jobs) are'
+                                                 ' read from stdin, one per'
+                                                 ' line, writing a JSON'
+                                                 ' result per line to'
+                                                 ' stdout')
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Number of references resolved concurrently')
+    parser.add_argument('--per-host', type=int, default=DEFAULT_PER_HOST,
+                        help='Maximum number of concurrent requests per host')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Path to the persistent resolution cache')
+    parser.add_argument('--cache-ttl', type=int, default=DEFAULT_TTL,
+                        help='Lifetime (in seconds) of cached resolutions')
+    parser.add_argument('--near-duplicates', type=float, default=None,
+                        metavar='THRESHOLD',
+                        help='Resolve near-duplicate references (similarity'
+                             ' above THRESHOLD, e.g. 0.7) only once across'
+                             ' all the jobs')
+    parser.add_argument('--doi-index', type=str, default=None,
+                        help='Path to a local DOI index used instead of the'
+                             ' CrossRef search service')
+    add_metrics_options(parser)
+    add_transport_options(parser)
+    add_resolution_options(parser)
+    add_budget_options(parser)
+    return parser.parse_known_args(args)[0]
+
+
+def worker_cli(args=None):
+    from worker import run_worker
+    options = parse_worker_options(args)
+    cache = ResolutionCache(options.cache, ttl=options.cache_ttl) \
+        if options.cache else None
+    duplicates = NearDuplicates(threshold=options.near_duplicates) \
+        if options.near_duplicates else None
+    index = open_index(options.doi_index)
+    # a single budget: hedging learns from the latencies of every job
+    budget = budget_options(options)
+    metrics = Metrics()
+    try:
+        run_worker(sys.stdin, sys.stdout, workers=options.workers,
+                   per_host=options.per_host, cache=cache,
+                   duplicates=duplicates, index=index, metrics=metrics,
+                   transport=Transport(**transport_options(options)),
+                   confidence=options.confidence,
+                   batch_size=options.batch_size,
+                   metadata=not options.fetch_bibtex,
+                   budget=Budget(**budget) if budget else None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        write_metrics(metrics, options)
+        if index is not None:
+            index.close()
+        if cache is not None:
+            cache.close()
+
+
+def parse_deferred_options(args=None):
+    parser = argparse.ArgumentParser(description='Resolve again, without'
+                                                 ' deadline, the references'
+                                                 ' deferred by budgeted'
+                                                 ' runs, caching their'
+                                                 ' entries')
+    parser.add_argument('log', type=str,
+                        help='Path to the log of deferred references')
+    parser.add_argument('--cache', type=str, required=True,
+                        help='Path to the resolution cache receiving the'
+                             ' entries')
+    parser.add_argument('--cache-ttl', type=int, default=DEFAULT_TTL,
+                        help='Lifetime (in seconds) of cached resolutions')
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Number of references resolved concurrently')
+    parser.add_argument('--per-host', type=int, default=DEFAULT_PER_HOST,
+                        help='Maximum number of concurrent requests per host')
+    parser.add_argument('--doi-index', type=str, default=None,
+                        help='Path to a local DOI index used instead of the'
+                             ' CrossRef search service')
+    parser.add_argument('--fetch-bibtex', action='store_true',
+                        help='Always fetch the bibtex of matched DOIs instead'
+                             ' of building entries from the search results')
+    add_metrics_options(parser)
+    add_transport_options(parser)
+    return parser.parse_known_args(args)[0]
+
+
+def deferred_cli(args=None):
+    options = parse_deferred_options(args)
+    log = DeferredLog(options.log)
+    cache = ResolutionCache(options.cache, ttl=options.cache_ttl)
+    index = open_index(options.doi_index)
+    session = PooledSession(workers=options.workers,
+                            per_host=options.per_host,
+                            transport=Transport(**transport_options(options)))
+    metrics = Metrics()
+    try:
+        resolved = resolve_deferred(log, session=session, cache=cache,
+                                    index=index, metrics=metrics,
+                                    metadata=not options.fetch_bibtex,
+                                    workers=options.workers)
+        print('{} references resolved, {} still deferred'.format(
+            resolved, len(log.read())))
+    finally:
+        write_metrics(metrics, options)
+        session.close()
+        if index is not None:
+            index.close()
+        cache.close()
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+""" latency budgets, hedged requests and deferred references """
+
+import fcntl
+import json
+import os
+import Queue
+import threading
+import time
+from collections import deque
+
+from .metrics import NULL_METRICS
+
+
+# references still running past this percentile of the observed latencies
+# get a hedged request
+DEFAULT_HEDGE_PERCENTILE = 0.95
+# latencies kept to compute the percentile, and needed before hedging
+DEFAULT_SAMPLES = 256
+MIN_SAMPLES = 16
+# lookups running at once in a process, the ones given up on included
+DEFAULT_CALLS = 64
+# seconds between checks for a free call slot
+SLOT_POLL = 0.05
+
+
+class LatencyTracker(object):
+    """
+    Latencies of the last `samples` resolutions.
+
+    >>> tracker = LatencyTracker(samples=100, minimum=10)
+    >>> tracker.percentile(0.9) is None
+    True
+    >>> for latency in range(1, 101):
+    ...     tracker.observe(latency / 100.)
+    >>> tracker.percentile(0.9), tracker.percentile(1.)
+    (0.9, 1.0)
+    """
+    def __init__(self, samples=DEFAULT_SAMPLES, minimum=MIN_SAMPLES):
+        self.minimum = minimum
+        self._latencies = deque(maxlen=samples)
+        self._lock = threading.Lock()
+
+    def observe(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, fraction):
+        """ latency below which `fraction` of them fall, None if too few """
+        with self._lock:
+            if len(self._latencies) < self.minimum:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[max(0, int(round(fraction * len(latencies))) - 1)]
+
+
+class DeferredLog(object):
+    """
+    JSON lines file of the references resolved by a fallback for lack of
+    time, to be resolved again later; processes may append concurrently.
+    Appends and takes hold a lock on a `.lock` file next to the log.
+
+    >>> import os, tempfile
+    >>> handle, path = tempfile.mkstemp(); os.close(handle)
+    >>> log = DeferredLog(path)
+    >>> log.append(['Foo, B. 2013', 'Bar, B.']); log.append(['Foo, B. 2013'])
+    >>> log.read()
+    ['Foo, B. 2013', 'Bar, B.']
+    >>> log.take()
+    ['Foo, B. 2013', 'Bar, B.']
+    >>> log.append(['Baz, B.']); log.take()
+    ['Foo, B. 2013', 'Bar, B.']
+    >>> log.release(); log.append(['Bar, B.']); log.read()
+    ['Baz, B.', 'Bar, B.']
+    >>> log.take(); log.release(); log.read()
+    ['Baz, B.', 'Bar, B.']
+    []
+    >>> os.remove(path + '.lock')
+    """
+    def __init__(self, path):
+        self.path = path
+        self.taken = path + '.taken'
+        self._lock = threading.Lock()
+
+    def _locked(self, action):
+        with self._lock:
+            with open(self.path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    return action()
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def append(self, references):
+        lines = ''.join(json.dumps({'raw': reference}) + '\n'
+                        for reference in references)
+
+        def write():
+            with open(self.path, 'a') as log:
+                log.write(lines)
+        self._locked(write)
+
+    def read(self, path=None):
+        """ deferred references, without repetitions """
+        references, seen = [], set()
+        try:
+            with open(path or self.path, 'r') as log:
+                for line in log:
+                    if not line.strip():
+                        continue
+                    reference = json.loads(line)['raw']
+                    if isinstance(reference, unicode):
+                        reference = reference.encode('utf-8')
+                    if reference not in seen:
+                        seen.add(reference)
+                        references.append(reference)
+        except IOError:
+            pass
+        return references
+
+    def take(self):
+        """
+        Move the deferred references aside, so that the ones appended while
+        they are resolved start a new log, and return them. They are taken
+        again until `release` drops them (e.g. after an interrupted run).
+        """
+        def rename():
+            if not os.path.exists(self.taken) and os.path.exists(self.path):
+                os.rename(self.path, self.taken)
+        self._locked(rename)
+        return self.read(self.taken)
+
+    def release(self):
+        """ drop the references taken, once they are handled """
+        if os.path.exists(self.taken):
+            os.remove(self.taken)
+
+
+class Budget(object):
+    """
+    Latency budget of the resolution: each paper is given `paper` seconds
+    and each reference `reference` seconds (None for no limit). References
+    still running past the `hedge` percentile of the latencies observed so
+    far get a second, hedged, request and the first answer wins.
+    References not resolved in time fall back to their local parse and are
+    appended to the `deferred` log (a path) to be resolved again later.
+    A budget is meant to be shared by the papers of a process, so that
+    hedging learns from all of them, and so that at most `calls` lookups
+    (hence threads) run at once: calls given up on keep their slot until
+    they return, and while no slot is free hedges are skipped and new
+    lookups wait.
+    """
+    def __init__(self, paper=None, reference=None,
+                 hedge=DEFAULT_HEDGE_PERCENTILE, deferred=None,
+                 samples=DEFAULT_SAMPLES, calls=DEFAULT_CALLS):
+        self.paper = paper
+        self.reference = reference
+        self.hedge = hedge
+        self.latencies = LatencyTracker(samples=samples)
+        self.log = DeferredLog(deferred) if deferred else None
+        self.deferred = 0
+        self.slots = threading.BoundedSemaphore(max(1, calls))
+        self._lock = threading.Lock()
+
+    def deadline(self):
+        """ time by which a paper starting now must be resolved """
+        return time.time() + self.paper if self.paper else None
+
+    def hedge_after(self):
+        return self.latencies.percentile(self.hedge) if self.hedge else None
+
+    def defer(self, references):
+        if not references:
+            return
+        with self._lock:
+            self.deferred += len(references)
+        if self.log is not None:
+            self.log.append(references)
+
+
+def race(function, items, budget, deadline=None, workers=1, metrics=None):
+    """
+    Call `function` on each of `items`, `workers` at a time, within the
+    `budget` and before `deadline` (a time). Returns the results along with
+    the positions of the items given up on (their result is None): the ones
+    out of time and the ones whose every call raised.
+    Calls run on daemon threads that are never waited for: a call given up
+    on keeps running in the background, holding one of the budget slots,
+    and its late result is dropped.
+
+    >>> budget = Budget(reference=0.2, hedge=None)
+    >>> race(lambda seconds: time.sleep(seconds) or seconds, [0., 5., 0.],
+    ...      budget, workers=3)
+    ([0.0, None, 0.0], [1])
+    >>> race(lambda number: 1 / number, [1, 0, 2], budget, workers=2)
+    ([1, None, 0], [1])
+    >>> budget = Budget(reference=0.2, hedge=None, calls=2)
+    >>> race(lambda seconds: time.sleep(seconds) or seconds, [1., 1., 0.],
+    ...      budget, workers=3)
+    ([None, None, 0.0], [0, 1])
+    """
+    metrics = metrics or NULL_METRICS
+    results = [None] * len(items)
+    finished = Queue.Queue()
+    pending = deque(xrange(len(items)))
+    # position: [start of its first call, number of calls, failed calls]
+    running = {}
+    expired = []
+
+    def call(position):
+        start = time.time()
+        try:
+            result, failed = function(items[position]), False
+        except Exception:
+            result, failed = None, True
+        finally:
+            budget.slots.release()
+        finished.put((position, result, time.time() - start, failed))
+
+    def launch(position):
+        """ start a call if a slot is free """
+        if not budget.slots.acquire(False):
+            return False
+        thread = threading.Thread(target=call, args=(position,))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    while pending or running:
+        now = time.time()
+        if deadline is not None and now >= deadline:
+            break
+        blocked = False
+        while pending and len(running) < max(1, workers):
+            if not launch(pending[0]):
+                blocked = True
+                break
+            running[pending.popleft()] = [now, 1, 0]
+        hedge_after = budget.hedge_after()
+        wakeups = [deadline] if deadline is not None else []
+        if blocked:
+            wakeups.append(now + SLOT_POLL)
+        for position, (start, calls, _) in running.items():
+            if budget.reference is not None:
+                if now - start >= budget.reference:
+                    del running[position]
+                    expired.append(position)
+                    metrics.count('reference_timeouts')
+                    continue
+                wakeups.append(start + budget.reference)
+            if hedge_after is not None and calls == 1:
+                if now - start < hedge_after:
+                    wakeups.append(start + hedge_after)
+                elif launch(position):
+                    running[position][1] += 1
+                    metrics.count('hedged_requests')
+                else:
+                    wakeups.append(now + SLOT_POLL)
+        if not running and not blocked:
+            continue
+        timeout = max(0., min(wakeups) - time.time()) if wakeups else None
+        try:
+            done = [finished.get(timeout=timeout)]
+        except Queue.Empty:
+            continue
+        while True:
+            try:
+                done.append(finished.get_nowait())
+            except Queue.Empty:
+                break
+        for position, result, latency, failed in done:
+            if position not in running:
+                metrics.count('late_results')
+                continue
+            if failed:
+                metrics.count('reference_errors')
+                running[position][2] += 1
+                # a hedged call still running may succeed
+                if running[position][2] == running[position][1]:
+                    del running[position]
+                    expired.append(position)
+                continue
+            del running[position]
+            results[position] = result
+            budget.latencies.observe(latency)
+    if running or pending:
+        metrics.count('deadline_expirations', len(running) + len(pending))
+        expired.extend(running)
+        expired.extend(pending)
+    return results, sorted(expired)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+""" near-duplicate reference detection (MinHash signatures, LSH banding) """
+
+import re
+import zlib
+from array import array
+from collections import OrderedDict
+
+from .latex import unlatexify
+
+
+DEFAULT_THRESHOLD = 0.7
+DEFAULT_BANDS = 16
+DEFAULT_ROWS = 4
+DEFAULT_SHINGLE = 5
+# number of representatives (and resolutions) kept in memory
+DEFAULT_CAPACITY = 1000000
+
+_words = re.compile(r'[^\w]+', re.UNICODE)
+_numbers = re.compile(r'\d+')
+_empty = 0xffffffff
+
+
+def normalize(reference):
+    """
+    >>> normalize('J.~Doe, {\\\\em On Things}, \\\\newblock Phys. Rev. 98 (2007).')
+    u'j doe em on things phys rev 98 2007'
+    """
+    text = unlatexify(reference).decode('utf-8', 'replace').lower()
+    return _words.sub(' ', text).strip()
+
+
+class NearDuplicates(object):
+    """
+    Cluster references whose normalized texts have a Jaccard similarity (over
+    character shingles) above `threshold`. Each cluster is identified by its
+    first reference, the representative: only representatives need to be
+    resolved, their resolution is then shared with the rest of the cluster.
+
+    Signatures use one-permutation MinHash (`bands * rows` bins) and are
+    indexed by LSH bands. References must also cite the same numbers (year,
+    volume, pages) to be clustered. At most `capacity` representatives are
+    kept, least recently matched ones are forgotten first.
+
+    >>> duplicates = NearDuplicates()
+    >>> a = duplicates.representative('J. Doe, On things. Phys. Rev. 98 (2007)')
+    >>> b = duplicates.representative('John Doe, On things, Phys. Rev. 98, 2007')
+    >>> c = duplicates.representative('J. Doe, On things. Phys. Rev. 99 (2008)')
+    >>> a == b, a == c
+    (True, False)
+    """
+    def __init__(self, threshold=DEFAULT_THRESHOLD, bands=DEFAULT_BANDS,
+                 rows=DEFAULT_ROWS, shingle=DEFAULT_SHINGLE,
+                 capacity=DEFAULT_CAPACITY):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        self.size = bands * rows
+        self.shingle = shingle
+        self.capacity = capacity
+        self.resolved = {}
+        self._representatives = OrderedDict()
+        self._buckets = {}
+        self._count = 0
+
+    def signature(self, text):
+        size, shingle = self.size, self.shingle
+        text = text.encode('utf-8')
+        bins = array('I', [_empty]) * size
+        for index in xrange(max(1, len(text) - shingle + 1)):
+            value = zlib.crc32(text[index:index + shingle]) & 0xffffffff
+            position, value = value % size, value // size
+            if value < bins[position]:
+                bins[position] = value
+        # densification: empty bins borrow the next non-empty one
+        filled = [position for position in xrange(size)
+                  if bins[position] != _empty]
+        if filled and len(filled) < size:
+            for position in xrange(size):
+                if bins[position] == _empty:
+                    offset = next((offset for offset in xrange(1, size)
+                                   if bins[(position + offset) % size]
+                                   != _empty), 0)
+                    bins[position] = bins[(position + offset) % size] + \
+                        offset * (_empty // size)
+        return bins
+
+    def _bands(self, signature):
+        rows = self.rows
+        return array('l', [hash((band,) + tuple(signature[band * rows:
+                                                          (band + 1) * rows]))
+                           for band in xrange(self.bands)])
+
+    def similarity(self, signature, other):
+        return sum(1 for a, b in zip(signature, other) if a == b) / \
+            float(self.size)
+
+    def representative(self, reference):
+        """ representative of the cluster `reference` belongs to """
+        text = normalize(reference)
+        numbers = zlib.crc32(' '.join(_numbers.findall(text)))
+        signature = self.signature(text)
+        bands = self._bands(signature)
+
+        candidates = OrderedDict.fromkeys(self._buckets[band]
+                                          for band in bands
+                                          if band in self._buckets)
+        for candidate in candidates:
+            known = self._representatives.get(candidate)
+            if known is None or known[1] != numbers:
+                continue
+            if self.similarity(signature, known[0]) >= self.threshold:
+                # most recently matched representatives are evicted last
+                self._representatives[candidate] = \
+                    self._representatives.pop(candidate)
+                return candidate
+
+        self._count += 1
+        identifier = self._count
+        self._representatives[identifier] = (signature, numbers, bands)
+        for band in bands:
+            self._buckets.setdefault(band, identifier)
+        if len(self._representatives) > self.capacity:
+            self._evict()
+        return identifier
+
+    def _evict(self):
+        identifier, (_, _, bands) = self._representatives.popitem(last=False)
+        for band in bands:
+            if self._buckets.get(band) == identifier:
+                del self._buckets[band]
+        self.resolved.pop(identifier, None)
+
+    def __len__(self):
+        return len(self._representatives)
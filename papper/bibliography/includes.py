@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+""" include graph of the tex/bbl files of a paper """
+
+import os
+import re
+from collections import OrderedDict
+
+from .metrics import NULL_METRICS
+
+
+# statements looked for in every file, in reading order
+_statements = re.compile(r'\\documentclass\b'
+                         r'|\\begin\{thebibliography\}'
+                         r'|\\(?:input|include)\s*\{([^}\n]*)\}'
+                         r'|\\bibliography\s*\{([^}\n]*)\}')
+_comment = re.compile(r'(?<!\\)%')
+_biblio_end = r'\end{thebibliography}'
+
+
+def scan_document(content):
+    """
+    Single pass over a tex/bbl `content` (a string or a memory map) yielding
+    its parts in reading order: ('documentclass', None), ('input', name),
+    ('bibliography', [names]) and ('lines', [lines]) for the lines of a
+    thebibliography environment. Commented statements and lines are
+    skipped.
+
+    >>> content = '\\n'.join(['\\\\documentclass{article}', '\\\\input{intro}',
+    ...                       '% \\\\include{old}', '\\\\bibliography{a, b}',
+    ...                       '\\\\begin{thebibliography}{9}', '\\\\bibitem{a} A',
+    ...                       '%c', '\\\\end{thebibliography}', '\\\\include{app}'])
+    >>> for part in scan_document(content):
+    ...     print(part)
+    ('documentclass', None)
+    ('input', 'intro')
+    ('bibliography', ['a', 'b'])
+    ('lines', ['\\\\bibitem{a} A\\n'])
+    ('input', 'app')
+    """
+    position = 0
+    while True:
+        match = _statements.search(content, position)
+        if match is None:
+            return
+        position = match.end()
+        line = content.rfind('\n', 0, match.start()) + 1
+        if _comment.search(content[line:match.start()]):
+            continue
+        if match.group(1) is not None:
+            yield ('input', match.group(1).strip())
+        elif match.group(2) is not None:
+            yield ('bibliography', [name.strip()
+                                    for name in match.group(2).split(',')
+                                    if name.strip()])
+        elif match.group(0).startswith('\\documentclass'):
+            yield ('documentclass', None)
+        else:
+            begin = content.find('\n', match.end())
+            if begin == -1:
+                return
+            end = content.find(_biblio_end, begin)
+            end = content.rfind('\n', begin, end) + 1 if end != -1 \
+                else len(content)
+            yield ('lines', [line for line
+                             in content[begin + 1:end].splitlines(True)
+                             if not line.startswith('%')])
+            position = end
+
+
+class IncludeGraph(object):
+    """
+    Files of a paper linked by their \\input, \\include and \\bibliography
+    statements. Every file is read (and scanned) exactly once; documents
+    are then walked in reading order, each file being visited at most once
+    per document.
+    Documents are the files declaring a \\documentclass, along with the
+    files no document reaches that hold a bibliography.
+    Included names are looked up next to the including file, then in the
+    top folder of the paper; a missing \\bibliography falls back to the bbl
+    named after the document, as bibtex writes it.
+    """
+    def __init__(self, source, filenames, metrics=None):
+        self.metrics = metrics or NULL_METRICS
+        self.parts = OrderedDict()
+        for filename in filenames:
+            with source.mapped(filename) as content:
+                self.metrics.count('bytes', len(content))
+                self.parts[filename] = list(scan_document(content))
+        folders = [os.path.dirname(filename) for filename in self.parts]
+        self.top = min(folders, key=len) if folders else ''
+
+    def _locate(self, name, filename, extensions):
+        for folder in (os.path.dirname(filename), self.top):
+            for extension in extensions:
+                candidate = os.path.normpath(os.path.join(folder,
+                                                          name + extension))
+                if candidate in self.parts:
+                    return candidate
+        return None
+
+    def targets(self, filename, document=None):
+        """
+        (kind, target) of each part of `filename`: lines are passed along,
+        inclusions are resolved to a filename (None if it is missing, with
+        the expected bbl for bibliographies)
+        """
+        document = document or filename
+        for kind, value in self.parts.get(filename, ()):
+            if kind == 'input':
+                yield (kind, self._locate(value, filename, ('', '.tex')))
+            elif kind == 'bibliography':
+                found = [self._locate(name[:-len('.bbl')]
+                                      if name.endswith('.bbl') else name,
+                                      filename, ('.bbl',))
+                         for name in value]
+                default = os.path.splitext(document)[0] + '.bbl'
+                target = next((bbl for bbl in found if bbl), None) or \
+                    (default if default in self.parts else None)
+                yield (kind, target or ('missing', default))
+            elif kind == 'lines':
+                yield (kind, value)
+
+    def _reached(self, filename):
+        reached, pending = set(), [filename]
+        while pending:
+            current = pending.pop()
+            if current in reached:
+                continue
+            reached.add(current)
+            pending.extend(target for kind, target in self.targets(current)
+                           if kind != 'lines' and
+                           isinstance(target, basestring))
+        return reached
+
+    def documents(self):
+        """ root documents, in file order """
+        documents = [filename for filename, parts in self.parts.items()
+                     if ('documentclass', None) in parts]
+        reached = set()
+        for document in documents:
+            reached.update(self._reached(document))
+        orphans = [filename for filename in self.parts
+                   if filename not in reached]
+        included = set()
+        for orphan in orphans:
+            included.update(self._reached(orphan) - set([orphan]))
+        # orphans included by other orphans come last
+        for orphan in sorted(orphans, key=lambda name: name in included):
+            if orphan in reached:
+                continue
+            files = self._reached(orphan)
+            if any(kind == 'lines' for name in files
+                   for kind, _ in self.parts[name]):
+                documents.append(orphan)
+                reached.update(files)
+        return documents
+
+    def lines(self, document, files=None):
+        """
+        bibliography lines of `document` in reading order; the files read
+        (and the missing bbl looked for) are appended to `files`
+        """
+        visited = set()
+        pending = [iter([('input', document)])]
+        while pending:
+            kind, target = next(pending[-1], (None, None))
+            if kind is None:
+                pending.pop()
+            elif kind == 'lines':
+                for line in target:
+                    yield line
+            elif isinstance(target, tuple):
+                self.metrics.count('missing_bbl')
+                if files is not None:
+                    files.append(target[1])
+            elif target is not None and target not in visited:
+                visited.add(target)
+                if files is not None:
+                    files.append(target)
+                pending.append(self.targets(target, document))
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+
+""" offline DOI index built from a CrossRef metadata dump """
+
+import bisect
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import tempfile
+from array import array
+from collections import defaultdict
+
+from . import bibliography
+from .dedup import normalize
+
+
+LEXICON = 'lexicon.tsv'
+POSTINGS = 'postings.bin'
+DOCUMENTS = 'documents.jsonl'
+OFFSETS = 'offsets.bin'
+LENGTHS = 'lengths.bin'
+META = 'meta.json'
+
+# documents accumulated in memory before a sorted run is flushed to disk
+DEFAULT_RUN_SIZE = 500000
+# terms found in more than this share of documents are not scored
+DEFAULT_MAX_DF = 0.1
+# posting lists longer than this only rescore candidates of rarer terms
+EXHAUSTIVE_DF = 1024
+DEFAULT_CANDIDATES = 5
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+CROSSREF_TYPES = {
+    'journal-article': bibliography.Article,
+    'proceedings-article': bibliography.InProceedings,
+    'book': bibliography.Book,
+    'monograph': bibliography.Book,
+    'edited-book': bibliography.Book,
+    'book-chapter': bibliography.InCollection,
+    'dissertation': bibliography.PhdThesis,
+    'report': bibliography.TechReport,
+    'proceedings': bibliography.Proceedings,
+}
+VENUE_FIELDS = {
+    bibliography.Article: 'journal',
+    bibliography.InProceedings: 'booktitle',
+    bibliography.InCollection: 'booktitle',
+    bibliography.TechReport: 'institution',
+}
+
+_words = re.compile(r'\W+', re.UNICODE)
+
+
+def tokenize(text):
+    """
+    >>> tokenize(u'On the Theory of Things (2007)')
+    ['on', 'the', 'theory', 'of', 'things', '2007']
+    """
+    text = normalize(text) if isinstance(text, str) \
+        else _words.sub(' ', text.lower())
+    return [token.encode('utf-8') for token in text.split()
+            if len(token) > 1]
+
+
+def _first(value):
+    return (value[0] if value else None) if isinstance(value, list) \
+        else value
+
+
+def metadata(item):
+    """
+    Compact metadata of a CrossRef work (as found in the API responses and
+    metadata dumps).
+
+    >>> sorted(metadata({'DOI': '10.1/x', 'type': 'journal-article',
+    ...                  'title': ['T'], 'container-title': ['J'],
+    ...                  'author': [{'family': 'Doe', 'given': 'J.'}],
+    ...                  'issued': {'date-parts': [[2007, 3]]}}).items())
+    [('author', [u'Doe, J.']), ('doi', '10.1/x'), ('title', 'T'), ('type', 'journal-article'), ('venue', 'J'), ('year', u'2007')]
+    """
+    authors = [u', '.join(filter(None, [author.get('family'),
+                                        author.get('given')]))
+               for author in item.get('author') or []]
+    year = _first(_first((item.get('issued') or {}).get('date-parts')))
+    record = {
+        'doi': item.get('DOI'),
+        'type': item.get('type'),
+        'title': _first(item.get('title')),
+        'author': filter(None, authors),
+        'venue': _first(item.get('container-title')),
+        'year': unicode(year) if year else None,
+        'volume': item.get('volume'),
+        'number': item.get('issue'),
+        'pages': item.get('page'),
+        'publisher': item.get('publisher'),
+    }
+    return dict((key, value) for key, value in record.items() if value)
+
+
+def terms(record):
+    text = u' '.join([record.get('title') or u'',
+                      u' '.join(record.get('author') or []),
+                      record.get('venue') or u'',
+                      record.get('year') or u''])
+    return tokenize(text)
+
+
+def to_entry(record):
+    """ bibliography Entry of an index record """
+    kind = CROSSREF_TYPES.get(record.get('type'), bibliography.Misc)
+    fields = dict((key, record[key].encode('utf-8'))
+                  for key in ('title', 'year', 'volume', 'number', 'pages',
+                              'publisher')
+                  if record.get(key))
+    if record.get('author'):
+        fields['author'] = u' and '.join(record['author']).encode('utf-8')
+    if record.get('venue'):
+        fields[VENUE_FIELDS.get(kind, 'howpublished')] = \
+            record['venue'].encode('utf-8')
+    if record.get('doi'):
+        fields['doi'] = record['doi'].encode('utf-8')
+    return kind(json=fields)
+
+
+def citation(record):
+    return u', '.join(filter(None, [u'; '.join(record.get('author') or []),
+                                    record.get('year'),
+                                    record.get('title'),
+                                    record.get('venue'),
+                                    record.get('volume'),
+                                    record.get('pages')]))
+
+
+class DoiIndex(object):
+    """
+    On-disk inverted index of CrossRef works scored with BM25 over title,
+    authors, venue and year tokens. Posting lists, document lengths and
+    documents are memory-mapped; only the lexicon is loaded in memory.
+    A posting list stores sorted document ids then term frequencies, so
+    that frequent terms are only looked up (by bisection) for the
+    candidates found by rarer ones.
+    `query` returns candidates shaped like search.labs.crossref.org/dois
+    results.
+    """
+    def __init__(self, directory, max_df=DEFAULT_MAX_DF):
+        self.directory = directory
+        with open(os.path.join(directory, META), 'r') as meta:
+            meta = json.load(meta)
+        self.size = meta['documents']
+        self.average_length = meta['average_length'] or 1.
+        self.max_df = max(1, int(max_df * self.size))
+        self.lexicon = {}
+        with open(os.path.join(directory, LEXICON), 'r') as lexicon:
+            for line in lexicon:
+                term, offset, df = line.rstrip('\n').split('\t')
+                self.lexicon[term] = (int(offset), int(df))
+        self._files = []
+        self._maps = []
+        self._postings = self._map(POSTINGS)
+        self._lengths = self._map(LENGTHS)
+        self._offsets = self._map(OFFSETS)
+        self._documents = self._map(DOCUMENTS)
+
+    def _map(self, name):
+        data = open(os.path.join(self.directory, name), 'rb')
+        self._files.append(data)
+        if not os.fstat(data.fileno()).st_size:
+            return ''
+        mapped = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return mapped
+
+    def close(self):
+        for mapped in self._maps:
+            mapped.close()
+        for data in self._files:
+            data.close()
+
+    def document(self, identifier):
+        offset, = struct.unpack_from('<Q', self._offsets, 8 * identifier)
+        end = self._documents.find('\n', offset)
+        return json.loads(self._documents[offset:end])
+
+    def _postings_of(self, offset, df):
+        identifiers, frequencies = array('I'), array('I')
+        identifiers.fromstring(self._postings[offset:offset + 4 * df])
+        frequencies.fromstring(self._postings[offset + 4 * df:
+                                              offset + 8 * df])
+        return identifiers, frequencies
+
+    def _weight(self, identifier, frequency, idf):
+        length, = struct.unpack_from('<I', self._lengths, 4 * identifier)
+        norm = BM25_K1 * (1. - BM25_B + BM25_B * length / self.average_length)
+        return idf * frequency * (BM25_K1 + 1.) / (frequency + norm)
+
+    def scores(self, query):
+        """ BM25 score of the documents matching `query` """
+        found = [self.lexicon.get(term) for term in set(tokenize(query))]
+        found = sorted((df, offset) for offset, df in filter(None, found)
+                       if df <= self.max_df)
+        scores = defaultdict(float)
+        for df, offset in found:
+            idf = math.log(1. + (self.size - df + .5) / (df + .5))
+            identifiers, frequencies = self._postings_of(offset, df)
+            if df <= EXHAUSTIVE_DF or not scores:
+                for identifier, frequency in zip(identifiers, frequencies):
+                    scores[identifier] += self._weight(identifier, frequency,
+                                                       idf)
+                continue
+            for identifier in scores.keys():
+                position = bisect.bisect_left(identifiers, identifier)
+                if position < df and identifiers[position] == identifier:
+                    scores[identifier] += self._weight(
+                        identifier, frequencies[position], idf)
+        return scores
+
+    def query(self, reference, count=DEFAULT_CANDIDATES):
+        best = heapq.nlargest(count, self.scores(reference).items(),
+                              key=lambda item: item[1])
+        if not best:
+            return []
+        top = best[0][1]
+        candidates = []
+        for identifier, score in best:
+            record = self.document(identifier)
+            candidates.append({
+                'doi': u'http://dx.doi.org/' + record.get('doi', u''),
+                'score': score,
+                'normalizedScore': int(round(100. * score / top)),
+                'title': record.get('title'),
+                'fullCitation': citation(record),
+                'year': record.get('year'),
+                'coins': u'',
+                'record': record,
+            })
+        return candidates
+
+    def bibtex(self, candidate):
+        return to_entry(candidate['record']).to_bibtex()
+
+    @staticmethod
+    def build(dumps, directory, run_size=DEFAULT_RUN_SIZE):
+        """
+        Build an index in `directory` from CrossRef JSON lines `dumps` (one
+        work per line). Postings are accumulated by runs of `run_size`
+        documents, sorted and spilled to disk, then merged: runs hold
+        increasing identifiers, so the postings of a term are concatenated
+        in run order.
+
+        >>> import shutil
+        >>> directory = tempfile.mkdtemp()
+        >>> dump = os.path.join(directory, 'works.jsonl')
+        >>> with open(dump, 'w') as works:
+        ...     for number in range(30):
+        ...         works.write(json.dumps({'DOI': '10.1/%d' % number,
+        ...                                 'title': ['Common title']}) + '\\n')
+        >>> index = DoiIndex.build([dump], directory, run_size=7)
+        >>> offset, df = index.lexicon['common']
+        >>> identifiers = index._postings_of(offset, df)[0]
+        >>> map(int, identifiers) == range(30)
+        True
+        >>> index.close(); shutil.rmtree(directory)
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = lambda name: os.path.join(directory, name)
+        runs, postings = [], defaultdict(list)
+        identifier, total = 0, 0
+
+        def flush():
+            run = tempfile.TemporaryFile(dir=directory)
+            for term in sorted(postings):
+                run.write('{}\t{}\n'.format(term, ' '.join(postings[term])))
+            run.seek(0)
+            runs.append(run)
+            postings.clear()
+
+        with open(path(DOCUMENTS), 'wb') as documents, \
+                open(path(OFFSETS), 'wb') as offsets, \
+                open(path(LENGTHS), 'wb') as lengths:
+            for dump in dumps:
+                with open(dump, 'r') as lines:
+                    for line in lines:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        item = json.loads(line)
+                        item = item.get('message', item)
+                        record = metadata(item)
+                        if not record.get('doi'):
+                            continue
+                        tokens = terms(record)
+                        frequencies = defaultdict(int)
+                        for token in tokens:
+                            frequencies[token] += 1
+                        for token, frequency in frequencies.items():
+                            postings[token].append('{}:{}'.format(
+                                identifier, frequency))
+                        offsets.write(struct.pack('<Q', documents.tell()))
+                        documents.write(json.dumps(record) + '\n')
+                        lengths.write(struct.pack('<I', len(tokens)))
+                        total += len(tokens)
+                        identifier += 1
+                        if identifier % run_size == 0:
+                            flush()
+        flush()
+
+        def entries(number, run):
+            for line in run:
+                term, values = line.rstrip('\n').split('\t')
+                yield term, number, values
+
+        with open(path(POSTINGS), 'wb') as output, \
+                open(path(LEXICON), 'w') as lexicon:
+            # merged by term, then run number (never by values)
+            merged = heapq.merge(*[entries(number, run)
+                                   for number, run in enumerate(runs)])
+            term, values = None, []
+            for current, _, run_values in merged:
+                if current != term and term is not None:
+                    DoiIndex._write_postings(output, lexicon, term, values)
+                    values = []
+                term = current
+                values.extend(run_values.split())
+            if term is not None:
+                DoiIndex._write_postings(output, lexicon, term, values)
+        for run in runs:
+            run.close()
+
+        with open(path(META), 'w') as meta:
+            json.dump({'documents': identifier,
+                       'average_length': total / float(identifier or 1)},
+                      meta)
+        return DoiIndex(directory)
+
+    @staticmethod
+    def _write_postings(output, lexicon, term, values):
+        identifiers, frequencies = array('I'), array('I')
+        for value in values:
+            identifier, frequency = value.split(':')
+            identifiers.append(int(identifier))
+            frequencies.append(int(frequency))
+        lexicon.write('{}\t{}\t{}\n'.format(term, output.tell(),
+                                            len(values)))
+        identifiers.tofile(output)
+        frequencies.tofile(output)
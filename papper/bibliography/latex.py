@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+
+""" LaTeX to text conversion, and back """
+
+import re
+
+
+# see http://arxiv.org/help/prep#author
+LATEX_SYMBOLS = [
+    ('\\"A', "Ä"),
+    ('\\"a', "ä"),
+    ("\\'A", "Á"),
+    ("\\'a", "á"),
+    ("\\.A", "Ȧ"),
+    ("\\.a", "ȧ"),
+    ("\\=A", "Ā"),
+    ("\\=a", "ā"),
+    ("\\^A", "Â"),
+    ("\\^a", "â"),
+    ("\\`A", "À"),
+    ("\\`a", "à"),
+    ("\\k{A}", "Ą"),
+    ("\\k{a}", "ą"),
+    ("\\r{A}", "Å"),
+    ("\\r{a}", "å"),
+    ("\\u{A}", "Ă"),
+    ("\\u{a}", "ă"),
+    ("\\v{A}", "Ǎ"),
+    ("\\v{a}", "ǎ"),
+    ("\\~A", "Ã"),
+    ("\\~a", "ã"),
+    ("\\'C", "Ć"),
+    ("\\'c", "ć"),
+    ("\\.C", "Ċ"),
+    ("\\.c", "ċ"),
+    ("\\^C", "Ĉ"),
+    ("\\^c", "ĉ"),
+    ("\\c{C}", "Ç"),
+    ("\\c{c}", "ç"),
+    ("\\v{C}", "Č"),
+    ("\\v{c}", "č"),
+    ("\\v{D}", "Ď"),
+    ("\\v{d}", "ď"),
+    ('\\"E', "Ë"),
+    ('\\"e', "ë"),
+    ("\\'E", "É"),
+    ("\\'e", "é"),
+    ("\\.E", "Ė"),
+    ("\\.e", "ė"),
+    ("\\=E", "Ē"),
+    ("\\=e", "ē"),
+    ("\\^E", "Ê"),
+    ("\\^e", "ê"),
+    ("\\`E", "È"),
+    ("\\`e", "è"),
+    ("\\c{E}", "Ȩ"),
+    ("\\c{e}", "ȩ"),
+    ("\\k{E}", "Ę"),
+    ("\\k{e}", "ę"),
+    ("\\u{E}", "Ĕ"),
+    ("\\u{e}", "ĕ"),
+    ("\\v{E}", "Ě"),
+    ("\\v{e}", "ě"),
+    ("\\.G", "Ġ"),
+    ("\\.g", "ġ"),
+    ("\\^G", "Ĝ"),
+    ("\\^g", "ĝ"),
+    ("\\c{G}", "Ģ"),
+    ("\\c{g}", "ģ"),
+    ("\\u{G}", "Ğ"),
+    ("\\u{g}", "ğ"),
+    ("\\v{G}", "Ǧ"),
+    ("\\v{g}", "ǧ"),
+    ("\\^H", "Ĥ"),
+    ("\\^h", "ĥ"),
+    ("\\v{H}", "Ȟ"),
+    ("\\v{h}", "ȟ"),
+    ('\\"I', "Ï"),
+    ('\\"i', "ï"),
+    ("\\'I", "Í"),
+    ("\\'i", "í"),
+    ("\\.I", "İ"),
+    ("\\=I", "Ī"),
+    ("\\=i", "ī"),
+    ("\\^I", "Î"),
+    ("\\^i", "î"),
+    ("\\`I", "Ì"),
+    ("\\`i", "ì"),
+    ("\\k{I}", "Į"),
+    ("\\k{i}", "į"),
+    ("\\u{I}", "Ĭ"),
+    ("\\u{i}", "ĭ"),
+    ("\\v{I}", "Ǐ"),
+    ("\\v{i}", "ǐ"),
+    ("\\~I", "Ĩ"),
+    ("\\~i", "ĩ"),
+    ("\\^J", "Ĵ"),
+    ("\\^j", "ĵ"),
+    ("\\c{K}", "Ķ"),
+    ("\\c{k}", "ķ"),
+    ("\\v{K}", "Ǩ"),
+    ("\\v{k}", "ǩ"),
+    ("\\'L", "Ĺ"),
+    ("\\'l", "ĺ"),
+    ("\\c{L}", "Ļ"),
+    ("\\c{l}", "ļ"),
+    ("\\v{L}", "Ľ"),
+    ("\\v{l}", "ľ"),
+    ("\\'N", "Ń"),
+    ("\\'n", "ń"),
+    ("\\c{N}", "Ņ"),
+    ("\\c{n}", "ņ"),
+    ("\\v{N}", "Ň"),
+    ("\\v{n}", "ň"),
+    ("\\~N", "Ñ"),
+    ("\\~n", "ñ"),
+    ('\\"O', "Ö"),
+    ('\\"o', "ö"),
+    ("\\'O", "Ó"),
+    ("\\'o", "ó"),
+    ("\\.O", "Ȯ"),
+    ("\\.o", "ȯ"),
+    ("\\=O", "Ō"),
+    ("\\=o", "ō"),
+    ("\\^O", "Ô"),
+    ("\\^o", "ô"),
+    ("\\`O", "Ò"),
+    ("\\`o", "ò"),
+    ("\\H{O}", "Ő"),
+    ("\\H{o}", "ő"),
+    ("\\k{O}", "Ǫ"),
+    ("\\k{o}", "ǫ"),
+    ("\\u{O}", "Ŏ"),
+    ("\\u{o}", "ŏ"),
+    ("\\v{O}", "Ǒ"),
+    ("\\v{o}", "ǒ"),
+    ("\\~O", "Õ"),
+    ("\\~o", "õ"),
+    ("\\'R", "Ŕ"),
+    ("\\'r", "ŕ"),
+    ("\\c{R}", "Ŗ"),
+    ("\\c{r}", "ŗ"),
+    ("\\v{R}", "Ř"),
+    ("\\v{r}", "ř"),
+    ("\\'S", "Ś"),
+    ("\\'s", "ś"),
+    ("\\^S", "Ŝ"),
+    ("\\^s", "ŝ"),
+    ("\\c{S}", "Ş"),
+    ("\\c{s}", "ş"),
+    ("\\v{S}", "Š"),
+    ("\\v{s}", "š"),
+    ("\\c{T}", "Ţ"),
+    ("\\c{t}", "ţ"),
+    ("\\v{T}", "Ť"),
+    ("\\v{t}", "ť"),
+    ('\\"U', "Ü"),
+    ('\\"u', "ü"),
+    ("\\'U", "Ú"),
+    ("\\'u", "ú"),
+    ("\\=U", "Ū"),
+    ("\\=u", "ū"),
+    ("\\^U", "Û"),
+    ("\\^u", "û"),
+    ("\\`U", "Ù"),
+    ("\\`u", "ù"),
+    ("\\H{U}", "Ű"),
+    ("\\H{u}", "ű"),
+    ("\\k{U}", "Ų"),
+    ("\\k{u}", "ų"),
+    ("\\r{U}", "Ů"),
+    ("\\r{u}", "ů"),
+    ("\\u{U}", "Ŭ"),
+    ("\\u{u}", "ŭ"),
+    ("\\v{U}", "Ǔ"),
+    ("\\v{u}", "ǔ"),
+    ("\\~U", "Ũ"),
+    ("\\~u", "ũ"),
+    ("\\^W", "Ŵ"),
+    ("\\^w", "ŵ"),
+    ('\\"Y', "Ÿ"),
+    ('\\"y', "ÿ"),
+    ("\\'Y", "Ý"),
+    ("\\'y", "ý"),
+    ("\\=Y", "Ȳ"),
+    ("\\=y", "ȳ"),
+    ("\\^Y", "Ŷ"),
+    ("\\^y", "ŷ"),
+    ("\\'Z", "Ź"),
+    ("\\'z", "ź"),
+    ("\\.Z", "Ż"),
+    ("\\.z", "ż"),
+    ("\\v{Z}", "Ž"),
+    ("\\v{z}", "ž"),
+    ("{\\aa}", "å"),
+    ("{\\AA}", "Å"),
+    ("{\\ae}", "æ"),
+    ("{\\AE}", "Æ"),
+    ("{\\DH}", "Ð"),
+    ("{\\dh}", "ð"),
+    ("{\\dj}", "đ"),
+    ("{\\DJ}", "Đ"),
+    ("{\\eth}", "ð"),
+    ("{\\ETH}", "Ð"),
+    ("{\\i}", "ı"),
+    ("{\\l}", "ł"),
+    ("{\\I}", "ł"),
+    ("{\\L}", "Ł"),
+    ("{\\ng}", "ŋ"),
+    ("{\\NG}", "Ŋ"),
+    ("{\\O}", "Ø"),
+    ("{\\o}", "ø"),
+    ("{\\oe}", "œ"),
+    ("{\\OE}", "Œ"),
+    ("{\\ss}", "ß"),
+    ("{\\th}", "þ"),
+    ("{\\TH}", "Þ"),
+    ("~", " "),
+    ("\\mbox{.}", ""),
+]
+
+# accents written with a symbol e.g. \"o
+SYMBOL_ACCENTS = ('"', "'", '.', '=', '^', '`', '~')
+# accents written with a letter e.g. \v{c}
+LETTER_ACCENTS = ('H', 'c', 'k', 'r', 'u', 'v')
+
+
+def brace_variants(symbols):
+    """
+    Common spellings of accented characters that differ from the canonical
+    ones only by their braces: {\\"o}, \\"{o}, {\\v{c}} and accented
+    dotless i (\\'{\\i}).
+
+    >>> sorted(brace_variants([('\\\\"o', 'o'), ('\\\\v{c}', 'c')]))
+    [('\\\\"{o}', 'o'), ('{\\\\"o}', 'o'), ('{\\\\"{o}}', 'o'), ('{\\\\v{c}}', 'c')]
+    """
+    variants = []
+    for latex, text in symbols:
+        if len(latex) == 3 and latex[1] in SYMBOL_ACCENTS:
+            accent, letter = latex[:2], latex[2]
+            variants.append((accent + '{' + letter + '}', text))
+            variants.append(('{' + latex + '}', text))
+            variants.append(('{' + accent + '{' + letter + '}}', text))
+            if letter == 'i':
+                variants.append((accent + '{\\i}', text))
+                variants.append(('{' + accent + '{\\i}}', text))
+        elif len(latex) == 5 and latex[1] in LETTER_ACCENTS:
+            variants.append(('{' + latex + '}', text))
+    return variants
+
+
+def trie_pattern(keys):
+    """
+    Build a regular expression matching any of `keys`, factored as a trie so
+    that the regexp engine never tries more than one branch per character.
+    Longer keys win over their prefixes.
+
+    >>> trie_pattern(['ab', 'abc', 'b'])
+    '(?:ab(?:c)?|b)'
+    """
+    trie = {}
+    for key in keys:
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def build(node):
+        branches = [re.escape(char) + build(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        pattern = '(?:' + '|'.join(branches) + ')' \
+            if len(branches) > 1 or '' in node else branches[0]
+        return pattern + '?' if '' in node else pattern
+
+    return build(trie)
+
+
+_symbols = dict(brace_variants(LATEX_SYMBOLS))
+_symbols.update(LATEX_SYMBOLS)
+
+# blank runs (and \newblock) collapse to a single space; a lone space is left
+# untouched so that plain text does not trigger any substitution
+_blanks = r'(?! (?!\s|\\newblock))(?:\s|\\newblock)+'
+_pattern = re.compile('|'.join([_blanks, trie_pattern(_symbols)]))
+
+
+def _substitute(match):
+    return _symbols.get(match.group(0), ' ')
+
+
+def unlatexify(content):
+    """
+    >>> print(unlatexify('J.~M\\\\"{u}ller \\\\newblock  Erd\\\\H{o}s'))
+    J. Müller Erdős
+    """
+    return _pattern.sub(_substitute, content)
+
+
+# LaTeX spelling of the characters of LATEX_SYMBOLS (the first one listed
+# wins), braced so that bibtex keeps them whole, and of the characters
+# LaTeX reserves
+_escapes = {}
+for _latex, _text in LATEX_SYMBOLS:
+    if _text.strip():
+        _escapes.setdefault(_text, _latex if _latex.startswith('{')
+                            else '{' + _latex + '}')
+_escapes.update((char, '\\' + char) for char in '&%#')
+# characters already escaped (and control sequences) are matched first to
+# be left untouched
+_escape_pattern = re.compile('|'.join([r'\\.', trie_pattern(_escapes)]))
+# values without any of these (most of them) are returned as they are
+_escaped = re.compile(r'[&%#\\\x80-\xff]')
+
+
+def _escape(match):
+    return _escapes.get(match.group(0), match.group(0))
+
+
+def latexify(content):
+    """
+    Inverse of unlatexify: escape the accented letters and reserved
+    characters of a field value, in a single pass. Unicode values are
+    returned utf-8 encoded.
+
+    >>> print(latexify('J. Müller & Erdős, 100\\\\% sure'))
+    J. M{\\"u}ller \\& Erd{\\H{o}}s, 100\\% sure
+    >>> print(unlatexify(latexify('Gödel, Łukasiewicz'.decode('utf-8'))))
+    Gödel, Łukasiewicz
+    >>> latexify(2013)
+    2013
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    elif not isinstance(content, str):
+        return content
+    if _escaped.search(content) is None:
+        return content
+    return _escape_pattern.sub(_escape, content)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+""" deferred imports of heavy dependencies """
+
+import importlib
+import threading
+
+
+class LazyModule(object):
+    """
+    Stand-in for a module that is only imported on first attribute access,
+    so that commands not using it do not pay for its import.
+
+    >>> decimal = LazyModule('decimal')
+    >>> decimal.loaded
+    False
+    >>> decimal.Decimal('1.5') * 2
+    Decimal('3.0')
+    >>> decimal.loaded
+    True
+    """
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self.__dict__['_module'] = importlib.import_module(
+                        self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
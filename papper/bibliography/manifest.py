@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+""" content-hash manifest used to reprocess papers incrementally """
+
+import hashlib
+import json
+import os
+
+
+class Manifest(object):
+    """
+    Per-paper record of the content hash of every file read and of the
+    bibtex entries produced for each document. A document's entries are
+    reused as long as neither the document nor the files it includes have
+    changed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._digests = {}
+        try:
+            with open(path, 'r') as data:
+                content = json.load(data)
+        except (IOError, ValueError):
+            content = {}
+        self.files = content.get('files', {})
+        self.stats = content.get('stats', {})
+        self.filenames = content.get('filenames', [])
+
+    def digest(self, source, filename):
+        """ sha1 of a file content; unchanged stat results skip hashing """
+        if filename in self._digests:
+            return self._digests[filename]
+
+        if not source.exists(filename):
+            digest = None
+        else:
+            stat = source.stat(filename)
+            known = self.stats.get(filename)
+            if stat is not None and known and known[0] == list(stat):
+                digest = known[1]
+            else:
+                with source.mapped(filename) as content:
+                    digest = hashlib.sha1(content).hexdigest()
+                if stat is not None:
+                    self.stats[filename] = [list(stat), digest]
+        self._digests[filename] = digest
+        return digest
+
+    def lookup(self, source, filename):
+        """ previously produced entries of a document, None if outdated """
+        known = self.files.get(filename)
+        if known is None or known['sha1'] != self.digest(source, filename):
+            return None
+        for include, digest in known['includes'].items():
+            if self.digest(source, include) != digest:
+                return None
+        return [entry.encode('utf-8') for entry in known['entries']]
+
+    def record(self, source, filename, includes, entries):
+        self.files[filename] = {
+            'sha1': self.digest(source, filename),
+            'includes': {include: self.digest(source, include)
+                         for include in includes},
+            'entries': entries
+        }
+
+    def unchanged(self, source, filenames):
+        """
+        whether the paper still has exactly `filenames` and all of its
+        documents are up to date
+        """
+        return set(filenames) == set(self.filenames) and \
+            all(self.lookup(source, document) is not None
+                for document in self.files)
+
+    def prune(self, documents, filenames=None):
+        """
+        forget documents that are no longer part of the paper, whose files
+        are now `filenames`
+        """
+        documents = set(documents)
+        for document in set(self.files) - documents:
+            del self.files[document]
+        if filenames is not None:
+            self.filenames = sorted(filenames)
+
+    def __len__(self):
+        return sum(len(known['entries']) for known in self.files.values())
+
+    def save(self):
+        partial = self.path + '.part'
+        with open(partial, 'w') as data:
+            json.dump({'files': self.files, 'stats': self.stats,
+                       'filenames': self.filenames}, data)
+        os.rename(partial, self.path)
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+""" instrumentation of the bibliography pipeline """
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+# upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5.,
+                   10., float('inf'))
+PROMETHEUS_PREFIX = 'papper_'
+
+
+class Histogram(object):
+    """
+    >>> histogram = Histogram(buckets=(0.1, 1., float('inf')))
+    >>> for value in (0.05, 0.5, 0.7, 3.):
+    ...     histogram.observe(value)
+    >>> histogram.counts, histogram.count, histogram.sum
+    ([1, 2, 1], 4, 4.25)
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[position] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other['counts'])]
+        self.count += other['count']
+        self.sum += other['sum']
+
+    def to_dict(self):
+        # JSON has no infinity: the overflow bucket bound is spelled '+Inf'
+        buckets = ['+Inf' if bound == float('inf') else bound
+                   for bound in self.buckets]
+        return {'buckets': buckets, 'counts': list(self.counts),
+                'count': self.count, 'sum': self.sum}
+
+
+class Metrics(object):
+    """
+    Thread-safe record of the pipeline activity: wall time per stage,
+    counters (files, bytes, bibitems, fallbacks, cache hits...) and latency
+    histograms. Every record is also passed to the optional
+    `hook(kind, name, value)` callback, `kind` being 'stage', 'count' or
+    'observe'.
+
+    Lazy stages are timed with `timed`: the time spent in a stage excludes
+    the time spent in the stages it pulls items from.
+
+    >>> metrics = Metrics()
+    >>> numbers = metrics.timed('produce', iter(range(3)), counter='numbers')
+    >>> sum(metrics.timed('consume', numbers))
+    3
+    >>> metrics.counters['numbers'], sorted(metrics.stages)
+    (3, ['consume', 'produce'])
+    >>> metrics.count('references', 4)
+    >>> metrics.count('parse_fallbacks')
+    >>> metrics.to_dict()['rates']
+    {'local_resolution': 0.0, 'parse_fallback': 0.25}
+    """
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.stages = {}
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _notify(self, kind, name, value):
+        if self.hook is not None:
+            self.hook(kind, name, value)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self._notify('count', name, value)
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+        self._notify('observe', name, value)
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.) + seconds
+        self._notify('stage', stage, seconds)
+
+    @contextmanager
+    def latency(self, name):
+        """ observe the duration of the block in the `name` histogram """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def timer(self, stage):
+        """ add the (exclusive) duration of the block to `stage` """
+        stack = self._stack()
+        stack.append(0.)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.add_time(stage, elapsed - nested)
+
+    def timed(self, stage, iterable, counter=None):
+        """
+        Yield the items of `iterable`, adding the time spent producing them
+        to `stage` (and counting them in `counter`).
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.timer(stage):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            if counter is not None:
+                self.count(counter)
+            yield item
+
+    def merge(self, other):
+        """ add the records of `other` (a Metrics or its to_dict()) """
+        other = other.to_dict() if isinstance(other, Metrics) else other
+        with self._lock:
+            for stage, seconds in other['stages'].items():
+                self.stages[stage] = self.stages.get(stage, 0.) + seconds
+            for name, value in other['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, histogram in other['histograms'].items():
+                if name not in self.histograms:
+                    self.histograms[name] = Histogram(
+                        map(float, histogram['buckets']))
+                self.histograms[name].merge(histogram)
+
+    def rates(self):
+        counters = self.counters
+        rates = {}
+        if counters.get('references'):
+            references = float(counters['references'])
+            rates['parse_fallback'] = \
+                counters.get('parse_fallbacks', 0) / references
+            rates['local_resolution'] = \
+                counters.get('local_resolutions', 0) / references
+        lookups = counters.get('cache_hits', 0) + \
+            counters.get('cache_misses', 0)
+        if lookups:
+            rates['cache_hit'] = counters.get('cache_hits', 0) / \
+                float(lookups)
+        return rates
+
+    def to_dict(self):
+        with self._lock:
+            return {'stages': dict(self.stages),
+                    'counters': dict(self.counters),
+                    'histograms': dict((name, histogram.to_dict())
+                                       for name, histogram
+                                       in self.histograms.items()),
+                    'rates': self.rates()}
+
+    def to_json(self, **options):
+        return json.dumps(self.to_dict(), sort_keys=True, **options)
+
+    def to_prometheus(self, prefix=PROMETHEUS_PREFIX):
+        """
+        >>> metrics = Metrics()
+        >>> metrics.count('files', 2)
+        >>> metrics.add_time('resolve', 1.5)
+        >>> print(metrics.to_prometheus())
+        # TYPE papper_stage_seconds_total counter
+        papper_stage_seconds_total{stage="resolve"} 1.5
+        # TYPE papper_files_total counter
+        papper_files_total 2
+        <BLANKLINE>
+        """
+        metrics = self.to_dict()
+        lines = []
+        if metrics['stages']:
+            name = prefix + 'stage_seconds_total'
+            lines.append('# TYPE {} counter'.format(name))
+            lines.extend('{}{{stage="{}"}} {!r}'.format(name, stage, seconds)
+                         for stage, seconds
+                         in sorted(metrics['stages'].items()))
+        for counter, value in sorted(metrics['counters'].items()):
+            name = prefix + counter + '_total'
+            lines.append('# TYPE {} counter'.format(name))
+            lines.append('{} {}'.format(name, value))
+        for histogram, values in sorted(metrics['histograms'].items()):
+            name = prefix + histogram
+            lines.append('# TYPE {} histogram'.format(name))
+            cumulative = 0
+            for bound, count in zip(values['buckets'], values['counts']):
+                cumulative += count
+                bound = bound if isinstance(bound, basestring) \
+                    else repr(bound)
+                lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound,
+                                                             cumulative))
+            lines.append('{}_sum {!r}'.format(name, values['sum']))
+            lines.append('{}_count {}'.format(name, values['count']))
+        for rate, value in sorted(metrics['rates'].items()):
+            name = prefix + rate + '_ratio'
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {!r}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+class NullMetrics(Metrics):
+    """ Metrics recording nothing, used when instrumentation is disabled """
+    def count(self, name, value=1):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def add_time(self, stage, seconds):
+        pass
+
+    @contextmanager
+    def latency(self, name):
+        yield
+
+    @contextmanager
+    def timer(self, stage):
+        yield
+
+    def timed(self, stage, iterable, counter=None):
+        return iterable
+
+
+NULL_METRICS = NullMetrics()
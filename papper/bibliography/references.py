@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+""" local extraction of the fields of a bibitem """
+
+import re
+
+from . import bibliography
+from .latex import unlatexify
+
+
+# references parsed with at least this confidence skip CrossRef
+DEFAULT_CONFIDENCE = 0.8
+# below this confidence, local fields are not used at all
+MINIMUM_CONFIDENCE = 0.5
+# confidence of entries missing required fields, below MINIMUM_CONFIDENCE
+INVALID_CONFIDENCE = 0.4
+# confidence penalty of references without any \newblock or \bibinfo markup
+UNSTRUCTURED_PENALTY = 0.6
+
+_newblock = re.compile(r'\s*\\newblock\b\s*')
+_bibinfo = re.compile(r'\\bibinfo\s*\{(\w+)\}\s*\{')
+_emphasized = re.compile(r'\{\\(?:em|it|sl)\b\s*'
+                         r'|\\(?:emph|textit|textsl)\s*\{')
+_markup = re.compile(r'\\(?:em|it|bf|sc|rm|sl|tt|sf|bibnamefont|bibfnamefont'
+                     r'|textbf|textit|textsl|textsc|textrm|texttt|emph'
+                     r'|natexlab|enquote|bibitemopen|bibfield)\b\s*'
+                     r'|\\(?:url|href|doi|eprint|urlprefix|Eprint)\s*'
+                     r'\{[^{}]*\}'
+                     r'|[{}]')
+_year = re.compile(r'(?<![\d/:-])(?<!\d\.)((?:1[6-9]|20)\d\d)[a-z]?'
+                   r'(?![\d/:-]|\.\d)')
+_pages = re.compile(r'(?:\bpages?|\bpp?\.)\s*(\d+(?:\s*-+\s*\d+)?)'
+                    r'|(?<![\d.])(\d+\s*-+\s*\d+)(?!\d|\.\d)')
+_volume = re.compile(r'\\textbf\s*\{\s*(\d+)\s*\}|\{\\bf\s+(\d+)\s*\}'
+                     r'|\b[Vv]ol(?:ume|\.)?\s*(\d+)'
+                     r'|(?<![\d(.-])(\d+)\s*(?:\((\d+)\))?\s*:\s*\d')
+_arxiv = re.compile(r'\b(?:arXiv|ArXiv|arxiv)\s*:?\s*'
+                    r'((?:\d{4}\.\d{4,5}|[a-z-]+(?:\.[A-Z]{2})?/\d{7})'
+                    r'(?:v\d+)?)')
+_thesis = re.compile(r'\b(Ph\.?\s?D\.?|Doctoral|Master\'?s?|M\.?Sc\.?)\s*'
+                     r'(?:thesis|dissertation)\b', re.IGNORECASE)
+_report = re.compile(r'\b(?:Technical|Tech\.)\s*(?:Report|Rep\.)',
+                     re.IGNORECASE)
+_publisher = re.compile(r'\b(?:Press|Publishers?|Publishing|Springer|Wiley'
+                        r'|Elsevier|Verlag|Addison|McGraw|Prentice|Academic'
+                        r'|Dover|Birkh)', re.IGNORECASE)
+_proceedings = re.compile(r'^In\b|\bProc(?:eedings|\.)|\bConference\b'
+                          r'|\bWorkshop\b|\bSymposium\b')
+_authors = re.compile(r'\s*(?:,?\s+and\s+|;\s*|,\s+(?=[A-Z][^,]*\s\S))\s*')
+_initial = re.compile(r'\b[A-Z]\.$')
+_initials = re.compile(r'^(?:[A-Z][a-z]?\.-?)+$')
+_blanks = re.compile(r'\s+')
+
+
+def clean(text, strip=' ,.;:'):
+    """
+    >>> clean('{\\\\em On  M\\\\"{u}ller\\'s {Things}},')
+    "On M\\xc3\\xbcller's Things"
+    """
+    text = _markup.sub('', unlatexify(text))
+    return _blanks.sub(' ', text).strip(strip)
+
+
+def _braced(text, position):
+    """ content of the brace group opened right before `position` """
+    depth = 1
+    for index in xrange(position, len(text)):
+        if text[index] == '{':
+            depth += 1
+        elif text[index] == '}':
+            depth -= 1
+            if not depth:
+                return text[position:index]
+    return text[position:]
+
+
+def _emphasis(text):
+    """ first emphasized text of `text`, None if there is none """
+    match = _emphasized.search(text)
+    if match is None:
+        return None
+    return _braced(text, match.end())
+
+
+def _leading_emphasis(text):
+    """
+    (emphasized text, rest) when `text` starts with an emphasized group
+
+    >>> _leading_emphasis('{\\\\em Title}, arXiv:1501.00001')
+    ('Title', ', arXiv:1501.00001')
+    """
+    match = _emphasized.match(text.lstrip())
+    if match is None:
+        return (None, text)
+    text = text.lstrip()
+    emphasized = _braced(text, match.end())
+    return (emphasized, text[match.end() + len(emphasized) + 1:])
+
+
+def bibinfo_fields(reference):
+    """
+    fields of revtex-like references tagged with \\bibinfo{field}{value}
+
+    >>> sorted(bibinfo_fields('\\\\bibinfo{author}{J.~Doe}, \\\\bibinfo{journal}'
+    ...                       '{Phys. Rev.} \\\\textbf{\\\\bibinfo{volume}{9}}').items())
+    [('author', 'J. Doe'), ('journal', 'Phys. Rev.'), ('volume', '9')]
+    """
+    fields = {}
+    for match in _bibinfo.finditer(reference):
+        name = match.group(1).lower()
+        value = clean(_braced(reference, match.end()), strip=' ,;:')
+        if not value:
+            continue
+        if name == 'author' and 'author' in fields:
+            fields['author'] += ' and ' + value
+        else:
+            fields.setdefault(name, value)
+    return fields
+
+
+def _family_first(name):
+    """
+    whether `name` reads "Family, Given": no initials before the comma,
+    given names (initials last, or no initials at all) after it
+
+    >>> _family_first('Doe, John R.'), _family_first('J. Doe, A. Smith')
+    (True, False)
+    >>> _family_first('Doe, A. Smith')
+    False
+    """
+    if name.count(',') != 1:
+        return False
+    family, given = [part.split() for part in name.split(',')]
+    if not family or not given or any(map(_initials.match, family)):
+        return False
+    return bool(_initials.match(given[-1])) or \
+        not any(map(_initials.match, given))
+
+
+def split_authors(text):
+    """
+    >>> split_authors('J. Doe, A. B. Smith, and C.~Li')
+    'J. Doe and A. B. Smith and C. Li'
+    >>> split_authors('Doe, J. and Smith, A.')
+    'Doe, J. and Smith, A.'
+    >>> split_authors('J. Doe, A. Smith')
+    'J. Doe and A. Smith'
+    """
+    text = clean(text, strip=' ,;:')
+    if text.endswith('.') and not _initial.search(text):
+        text = text[:-1]
+    names = text.split(' and ')
+    if all(_family_first(name) for name in names):
+        # "Family, Given and Family, Given"
+        return ' and '.join(name.strip() for name in names)
+    names = [name for name in _authors.split(text) if name]
+    return ' and '.join(names)
+
+
+def venue_fields(venue):
+    """
+    numbers (year, volume, number, pages) and venue name of a publication
+    block
+
+    >>> sorted(venue_fields('{\\\\em Phys. Rev. B}, 98(3):1--10, 2007.').items())
+    [('journal', 'Phys. Rev. B'), ('number', '3'), ('pages', '1--10'), ('volume', '98'), ('year', '2007')]
+    """
+    fields = {}
+    years = _year.findall(venue)
+    if years:
+        fields['year'] = years[-1]
+    volume = _volume.search(venue)
+    if volume is not None:
+        fields['volume'] = next(group for group in volume.groups()[:4]
+                                if group)
+        if volume.group(5):
+            fields['number'] = volume.group(5)
+    pages = list(_pages.finditer(venue))
+    if pages:
+        value = pages[-1].group(1) or pages[-1].group(2)
+        fields['pages'] = re.sub(r'\s*-+\s*', '--', value)
+
+    name = _emphasis(venue)
+    if name is None:
+        # the name runs until the first number or comma
+        name = re.split(r'\\textbf|\{\\bf|\d|,|\(', venue, 1)[0]
+    name = clean(re.sub(r'^\s*In\b', '', name), strip=' ,;:')
+    if name:
+        fields['journal'] = name
+    return fields
+
+
+def _kind(fields, venue):
+    venue = venue.strip()
+    if _thesis.search(venue):
+        is_phd = not _thesis.search(venue).group(1).lower().startswith('m')
+        return bibliography.PhdThesis if is_phd \
+            else bibliography.MasterThesis
+    if _report.search(venue):
+        return bibliography.TechReport
+    if re.match(r'In\b', venue):
+        return bibliography.InProceedings
+    if 'journal' in fields and 'volume' in fields:
+        return bibliography.Article
+    if _proceedings.search(venue):
+        return bibliography.InProceedings
+    if 'journal' in fields and 'pages' in fields:
+        return bibliography.Article
+    if _publisher.search(venue):
+        return bibliography.Book
+    return bibliography.Misc
+
+
+def _institution(pattern, venue):
+    """ venue stripped of its type (thesis, report) and year """
+    return clean(_year.sub('', pattern.sub('', clean(venue))))
+
+
+def _rename(kind, fields, venue):
+    """ map the generic venue to the field of the entry type """
+    name = fields.pop('journal', None)
+    if kind is bibliography.Article:
+        fields['journal'] = name
+    elif kind is bibliography.InProceedings:
+        fields['booktitle'] = name
+    elif kind in (bibliography.PhdThesis, bibliography.MasterThesis):
+        fields['school'] = _institution(_thesis, venue) or name
+    elif kind is bibliography.TechReport:
+        fields['institution'] = _institution(_report, venue) or name
+    elif kind is bibliography.Book:
+        fields['publisher'] = name
+    elif name:
+        fields['howpublished'] = name
+    return dict((key, value) for key, value in fields.items() if value)
+
+
+def parse_reference(reference):
+    """
+    (entry, confidence) extracted from a bibitem: authors, title, venue,
+    volume, number, pages and year are split out of \\newblock (or revtex
+    \\bibinfo) markup and the entry type is guessed from the venue. The
+    confidence (in [0, 1]) tells how much the local fields can be trusted.
+
+    >>> entry, confidence = parse_reference(
+    ...     'J.~Doe and A.~Smith. \\\\newblock On things. \\\\newblock '
+    ...     '{\\\\em Phys. Rev. B}, 98(3):1--10, 2007.')
+    >>> print(entry.to_bibtex('doe07'))  # doctest: +NORMALIZE_WHITESPACE
+    @ARTICLE{doe07,
+        author = {J. Doe and A. Smith},
+        title = {On things},
+        journal = {Phys. Rev. B},
+        year = {2007},
+        volume = {98},
+        number = {3},
+        pages = {1--10}}
+    >>> confidence
+    1.0
+    >>> entry, confidence = parse_reference('J. Doe, Phys. Rev. 98, 1 (2007).')
+    >>> type(entry).__name__, confidence < DEFAULT_CONFIDENCE
+    ('Misc', True)
+    >>> parse_reference('')[1], parse_reference(' \\\\newblock ')[1]
+    (0.0, 0.0)
+    >>> entry, confidence = parse_reference(
+    ...     'J.~Doe and A.~Smith. \\\\newblock On things. \\\\newblock '
+    ...     '{\\\\em Phys. Rev. B}, 98:1--10.')
+    >>> entry.is_valid(), confidence < MINIMUM_CONFIDENCE
+    (False, True)
+    >>> entry, confidence = parse_reference(
+    ...     'J. Doe, A. Smith, \\\\newblock {\\\\em Some Book Title}, '
+    ...     '\\\\newblock Springer, 2001.')
+    >>> entry['author'], confidence
+    ('J. Doe and A. Smith', 1.0)
+    """
+    fields = bibinfo_fields(reference)
+    structured = bool(fields)
+    if structured:
+        venue = ' '.join(fields.get(name, '') for name in
+                         ('journal', 'booktitle', 'publisher', 'school',
+                          'institution', 'type', 'note'))
+        if 'journal' not in fields:
+            fields['journal'] = fields.pop('booktitle', None) or \
+                fields.pop('publisher', None)
+        if 'pages' in fields:
+            fields['pages'] = re.sub(r'\s*-+\s*', '--', fields['pages'])
+    else:
+        blocks = [block for block in _newblock.split(reference)
+                  if block.strip()]
+        if not blocks:
+            # empty bibitem
+            return (bibliography.Misc(json={}), 0.)
+        structured = len(blocks) > 2
+        if len(blocks) == 1:
+            # no markup: "authors, {\em title}, venue" or, failing that,
+            # "authors. title. venue"
+            blocks = re.split(r',\s*(?=\{\\(?:em|it)\b|\\emph\b|\\textit\b)',
+                              reference, 1)
+            if len(blocks) == 1:
+                blocks = re.split(r'(?<=[a-z]{3}[.])\s+(?=\S)', reference, 2)
+        if len(blocks) == 2:
+            title, rest = _leading_emphasis(blocks[1])
+            if title is not None:
+                blocks = [blocks[0], title, rest]
+        venue = ' '.join(blocks[2:]) if len(blocks) > 2 else \
+            ' '.join(blocks[1:])
+        fields = venue_fields(venue)
+        fields['author'] = split_authors(blocks[0])
+        if len(blocks) > 2:
+            fields['title'] = clean(blocks[1])
+    if 'arxiv' not in fields and _arxiv.search(reference):
+        fields['arxiv'] = _arxiv.search(reference).group(1)
+
+    kind = _kind(fields, venue)
+    arxiv = fields.pop('arxiv', None)
+    if arxiv and kind is bibliography.Misc:
+        fields['journal'] = 'arXiv:' + arxiv
+    fields = _rename(kind, fields, venue)
+    entry = kind(json=fields)
+
+    checks = [fields.get('author'),
+              len(fields.get('title', '').split()) > 1,
+              kind is not bibliography.Misc,
+              fields.get('year'),
+              fields.get('pages') or fields.get('volume') or
+              kind in (bibliography.Book, bibliography.PhdThesis,
+                       bibliography.MasterThesis, bibliography.TechReport)]
+    confidence = sum(1. for check in checks if check) / len(checks)
+    if not structured:
+        confidence *= UNSTRUCTURED_PENALTY
+    if not entry.is_valid():
+        confidence = min(confidence, INVALID_CONFIDENCE)
+    return (entry, confidence)
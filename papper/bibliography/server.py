@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+
+""" JSON/bibtex HTTP API over the bibliography pipeline """
+
+import BaseHTTPServer
+import errno
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.queues
+import os
+import re
+import SocketServer
+import tempfile
+import threading
+import urlparse
+from collections import OrderedDict
+
+from .bbl2bib import (iter_bib, DEFAULT_WORKERS, DEFAULT_PER_HOST,
+                      DEFAULT_BATCH_SIZE)
+from .cache import ResolutionCache
+from .deadline import Budget
+from .index import DoiIndex
+from .metrics import Metrics
+from .references import DEFAULT_CONFIDENCE
+from .sources import iter_files, is_archive
+from .transport import Transport
+
+
+DEFAULT_PORT = 8080
+# number of paper results kept in memory
+DEFAULT_LRU_SIZE = 1024
+# seconds a client waits for its paper before getting a 504
+DEFAULT_REQUEST_TIMEOUT = 600.
+MAX_UPLOAD_SIZE = 64 * 1024 * 1024
+# seconds between checks of the worker processes resolving papers
+WATCH_INTERVAL = 0.5
+
+
+class ResolutionTimeout(RuntimeError):
+    pass
+
+
+_label = re.compile(r'@\s*\w+\s*\{\s*([^,\s]*)')
+
+# per-process resolution settings, set by the pool initializer
+_options = {}
+# queue receiving the (key, process id) of each paper a worker starts
+_started = []
+
+
+def _initialize(workers, per_host, cache, doi_index, transport, confidence,
+                batch_size, metadata, budget, started=None):
+    _started[:] = [started] if started is not None else []
+    _options['workers'] = workers
+    _options['per_host'] = per_host
+    _options['cache'] = ResolutionCache(cache) if cache else None
+    _options['index'] = DoiIndex(doi_index) if doi_index else None
+    _options['transport'] = Transport(**(transport or {}))
+    _options['confidence'] = confidence
+    _options['batch_size'] = batch_size
+    _options['metadata'] = metadata
+    _options['budget'] = Budget(**budget) if budget else None
+
+
+def _resolve(key, path):
+    """
+    (entries, error, metrics) of a paper, errors are reported as strings
+    and metrics as a dict
+    """
+    for started in _started:
+        started.put((key, os.getpid()))
+    metrics = Metrics()
+    try:
+        return (list(iter_bib(path, metrics=metrics, **_options)), None,
+                metrics.to_dict())
+    except Exception as error:
+        return (None, '{}: {}'.format(type(error).__name__, error),
+                metrics.to_dict())
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno != errno.ESRCH
+    return True
+
+
+def source_key(path):
+    """
+    Key of a paper source: its path along with the size and modification
+    time of the files read, so that modified papers are resolved again.
+    """
+    path = os.path.realpath(path)
+    filenames = [path] if is_archive(path) \
+        else iter_files(path, extensions=('tex', 'bbl'))
+    signature = hashlib.sha1(path)
+    for filename in sorted(filenames):
+        stat = os.stat(filename)
+        signature.update('{}\0{}\0{}\0'.format(filename, stat.st_size,
+                                               stat.st_mtime))
+    return signature.hexdigest()
+
+
+def to_json(entries):
+    """
+    >>> to_json(['@MISC{foo, \\n\\tnote = {bar}}'])
+    [{'bibtex': '@MISC{foo, \\n\\tnote = {bar}}', 'label': 'foo'}]
+    """
+    labels = [_label.match(entry) for entry in entries]
+    return [{'label': label.group(1) if label else None, 'bibtex': entry}
+            for label, entry in zip(labels, entries)]
+
+
+class Pending(object):
+    """ result of a paper being resolved, shared by identical requests """
+    def __init__(self, cleanup=None):
+        self.event = threading.Event()
+        self.cleanup = cleanup
+        self.entries = None
+        self.error = None
+        # process resolving the paper, once started
+        self.pid = None
+
+
+class Resolver(object):
+    """
+    Resolve papers on a bounded process pool. Requests for a paper already
+    being resolved wait for that same resolution (coalescing) and the
+    latest results are kept in an LRU. The metrics recorded by the workers
+    are merged into `metrics`, and papers whose worker process died fail
+    instead of being waited for.
+    """
+    def __init__(self, processes=None, lru_size=DEFAULT_LRU_SIZE,
+                 workers=DEFAULT_WORKERS, per_host=DEFAULT_PER_HOST,
+                 cache=None, doi_index=None, transport=None, metrics=None,
+                 confidence=DEFAULT_CONFIDENCE,
+                 batch_size=DEFAULT_BATCH_SIZE, metadata=True, budget=None):
+        self.lru_size = lru_size
+        self.metrics = metrics or Metrics()
+        self._results = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        # written synchronously: notices are not lost when a worker dies
+        self._started = multiprocessing.queues.SimpleQueue()
+        self._closed = threading.Event()
+        self._pool = multiprocessing.Pool(
+            processes or multiprocessing.cpu_count(),
+            initializer=_initialize,
+            initargs=(workers, per_host, cache, doi_index, transport,
+                      confidence, batch_size, metadata, budget,
+                      self._started))
+        self._watcher = threading.Thread(target=self._watch)
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def resolve(self, key, path, cleanup=None,
+                timeout=DEFAULT_REQUEST_TIMEOUT):
+        """
+        Entries of the paper at `path` identified by `key`; `cleanup` is
+        called once the paper is resolved. Raises RuntimeError on failure
+        (ResolutionTimeout if it takes longer than `timeout` seconds).
+        """
+        with self._lock:
+            if key in self._results:
+                self._results[key] = entries = self._results.pop(key)
+                self.metrics.count('server_lru_hits')
+                if cleanup is not None:
+                    cleanup()
+                return entries
+            pending = self._pending.get(key)
+            submit = pending is None
+            if submit:
+                pending = self._pending[key] = Pending(cleanup)
+            else:
+                self.metrics.count('server_coalesced')
+        if submit:
+            self.metrics.count('server_resolutions')
+            self._pool.apply_async(_resolve, (key, path),
+                                   callback=lambda result: self._done(
+                                       key, pending, result))
+        elif cleanup is not None:
+            cleanup()
+
+        if not pending.event.wait(timeout):
+            raise ResolutionTimeout('timed out resolving the paper')
+        if pending.error:
+            raise RuntimeError(pending.error)
+        return pending.entries
+
+    def _done(self, key, pending, result):
+        entries, error, metrics = result
+        with self._lock:
+            if self._pending.get(key) is not pending:
+                # already failed by the watcher
+                return
+            del self._pending[key]
+            pending.entries, pending.error = entries, error
+            if error is None:
+                self._results[key] = entries
+                while len(self._results) > self.lru_size:
+                    self._results.popitem(last=False)
+        if metrics is not None:
+            self.metrics.merge(metrics)
+        if pending.cleanup is not None:
+            pending.cleanup()
+        pending.event.set()
+
+    def _watch(self):
+        """
+        Follow the worker process of each pending paper: the pool replaces
+        dead workers but never completes their task, so the papers they
+        were resolving are failed.
+        """
+        while not self._closed.wait(WATCH_INTERVAL):
+            while not self._started.empty():
+                key, pid = self._started.get()
+                with self._lock:
+                    if key in self._pending:
+                        self._pending[key].pid = pid
+            with self._lock:
+                lost = [(key, pending)
+                        for key, pending in self._pending.items()
+                        if pending.pid is not None and
+                        not _alive(pending.pid)]
+            for key, pending in lost:
+                self.metrics.count('server_worker_deaths')
+                self._done(key, pending,
+                           (None, 'worker process died resolving the paper',
+                            None))
+
+    def close(self):
+        self._closed.set()
+        self._pool.terminate()
+        self._pool.join()
+        self._watcher.join()
+
+
+class BibliographyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    GET  /bibliography?path=<paper folder or archive>[&format=bibtex]
+    POST /bibliography[?format=bibtex] with a source archive as body
+    GET  /health
+    GET  /metrics (Prometheus text format)
+    """
+    protocol_version = 'HTTP/1.1'
+    server_version = 'papper'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                                                              *args)
+
+    def _reply(self, status, body, content_type='application/json'):
+        if content_type == 'application/json':
+            body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message):
+        self._reply(status, {'error': message})
+
+    def _query(self):
+        url = urlparse.urlsplit(self.path)
+        return url.path, dict((key, values[-1]) for key, values
+                              in urlparse.parse_qs(url.query).items())
+
+    def _bibliography(self, key, path, query, cleanup=None):
+        try:
+            entries = self.server.resolver.resolve(key, path,
+                                                   cleanup=cleanup)
+        except ResolutionTimeout as error:
+            return self._error(504, str(error))
+        except RuntimeError as error:
+            return self._error(502, str(error))
+        if query.get('format') == 'bibtex':
+            return self._reply(200, '\n'.join(entries) + '\n',
+                               content_type='application/x-bibtex')
+        self._reply(200, {'count': len(entries), 'entries': to_json(entries)})
+
+    def do_GET(self):
+        path, query = self._query()
+        metrics = self.server.resolver.metrics
+        if path == '/health':
+            return self._reply(200, {'status': 'ok'})
+        if path == '/metrics':
+            return self._reply(200, metrics.to_prometheus(),
+                               content_type='text/plain; version=0.0.4')
+        if path != '/bibliography':
+            return self._error(404, 'unknown endpoint')
+        metrics.count('server_requests')
+        root = self.server.root
+        if root is None:
+            return self._error(403, 'paper paths are not served,'
+                                    ' upload the source archive instead')
+        paper = os.path.realpath(os.path.join(root, query.get('path', '')))
+        if os.path.commonprefix([paper, root + os.sep]) != root + os.sep:
+            return self._error(403, 'paper outside of the served folder')
+        if not os.path.exists(paper):
+            return self._error(404, 'paper not found')
+        self._bibliography(source_key(paper), paper, query)
+
+    def do_POST(self):
+        path, query = self._query()
+        if path != '/bibliography':
+            return self._error(404, 'unknown endpoint')
+        self.server.resolver.metrics.count('server_requests')
+        size = int(self.headers.get('Content-Length') or 0)
+        if not size:
+            return self._error(411, 'source archive expected as body')
+        if size > MAX_UPLOAD_SIZE:
+            return self._error(413, 'source archive too large')
+        content = self.rfile.read(size)
+        key = hashlib.sha1(content).hexdigest()
+        handle, archive = tempfile.mkstemp(suffix='.tar.gz',
+                                           prefix='papper-upload-')
+        with os.fdopen(handle, 'wb') as upload:
+            upload.write(content)
+        self._bibliography(key, archive, query,
+                           cleanup=lambda: os.path.exists(archive) and
+                           os.remove(archive))
+
+
+class BibliographyServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server: connections only wait on their paper, the
+    resolution itself runs on the resolver process pool.
+    """
+    daemon_threads = True
+    request_queue_size = 512
+    allow_reuse_address = True
+
+    def __init__(self, address, resolver, root=None, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, BibliographyHandler)
+        self.resolver = resolver
+        self.root = os.path.realpath(root) if root else None
+        self.verbose = verbose
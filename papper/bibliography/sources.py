@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+""" paper sources: extracted directory trees or arXiv source archives """
+
+import io
+import mmap
+import os
+import posixpath
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .lazy import LazyModule
+
+
+# only loaded by archive sources
+gzip = LazyModule('gzip')
+tarfile = LazyModule('tarfile')
+
+ARCHIVE_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.gz')
+TEXT_EXTENSIONS = ('tex', 'bbl')
+
+
+def iter_files(path, discard=None, extensions=None):
+    path = os.path.abspath(path)
+    discard = set(discard or ())
+    for root, _, files in os.walk(path, topdown=True):
+        for filename in files:
+            filename = os.path.join(root, filename)
+            if filename in discard:
+                continue
+            if extensions and not any(map(filename.endswith, extensions)):
+                continue
+            yield filename
+
+
+def is_archive(path):
+    """
+    >>> is_archive('1501.00001.tar.gz'), is_archive('main.tex')
+    (True, False)
+    """
+    return any(map(path.endswith, ARCHIVE_EXTENSIONS)) and \
+        not os.path.isdir(path)
+
+
+class Directory(object):
+    """ files read straight from an extracted paper tree """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def filenames(self, extensions=None):
+        return iter_files(self.path, extensions=extensions)
+
+    def open(self, filename):
+        return open(filename, 'r')
+
+    def exists(self, filename):
+        return os.path.exists(filename)
+
+    def stat(self, filename):
+        stat = os.stat(filename)
+        return (stat.st_size, stat.st_mtime)
+
+    @contextmanager
+    def mapped(self, filename):
+        """ read-only memory map of the file content """
+        with open(filename, 'rb') as data:
+            if not os.fstat(data.fileno()).st_size:
+                # empty files cannot be mapped
+                yield ''
+                return
+            content = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield content
+            finally:
+                content.close()
+
+
+class Archive(object):
+    """
+    Text members of a tar, tar.gz or single-file gzip arXiv submission.
+    The archive is read sequentially once and only `.tex`/`.bbl` members are
+    kept (in memory): nothing is extracted to disk.
+    """
+    def __init__(self, path, extensions=TEXT_EXTENSIONS):
+        self.path = path
+        self.members = OrderedDict()
+        try:
+            self._load_tar(extensions)
+        except tarfile.ReadError:
+            self._load_gzip()
+
+    @staticmethod
+    def normalize(filename):
+        """
+        >>> Archive.normalize('./sub/../main.tex')
+        'main.tex'
+        """
+        return posixpath.normpath(filename)
+
+    def _load_tar(self, extensions):
+        with tarfile.open(self.path, 'r|*') as archive:
+            for member in archive:
+                if member.isfile() and \
+                        any(map(member.name.endswith, extensions)):
+                    content = archive.extractfile(member).read()
+                    self.members[self.normalize(member.name)] = content
+
+    def _load_gzip(self):
+        # single-file submissions are a gzipped tex file
+        name = os.path.basename(self.path)
+        if name.endswith('.gz'):
+            name = name[:-len('.gz')]
+        if not any(map(name.endswith, TEXT_EXTENSIONS)):
+            name += '.tex'
+        with gzip.open(self.path, 'rb') as data:
+            self.members[name] = data.read()
+
+    def filenames(self, extensions=None):
+        for filename in self.members:
+            if not extensions or any(map(filename.endswith, extensions)):
+                yield filename
+
+    def read(self, filename):
+        try:
+            return self.members[self.normalize(filename)]
+        except KeyError:
+            raise IOError("'{}' not found in '{}'".format(filename,
+                                                          self.path))
+
+    def open(self, filename):
+        return io.BytesIO(self.read(filename))
+
+    @contextmanager
+    def mapped(self, filename):
+        """ members are already held in memory """
+        yield self.read(filename)
+
+    def exists(self, filename):
+        return self.normalize(filename) in self.members
+
+    def stat(self, filename):
+        # members carry no reliable stat information: always hash them
+        return None
+
+
+def open_source(path):
+    if isinstance(path, (Directory, Archive)):
+        return path
+    return Archive(path) if is_archive(path) else Directory(path)
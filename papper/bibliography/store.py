@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+""" append-only store of resolved bibliographies """
+
+import os
+import re
+import sqlite3
+import struct
+import threading
+from itertools import chain
+
+from .bibliography import Bibtex, Misc
+
+
+INDEX = 'index.sqlite'
+SEGMENTS = 'segments'
+# segments are closed (and a new one started) beyond this size
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+# entries read at once when iterating over the whole store
+EXPORT_BATCH = 10000
+
+# fields of every entry type, in spec order: a record flags the ones it has
+FIELDS = tuple(reduce(lambda fields, entry: fields + tuple(
+    field for field in entry.fields() if field not in fields),
+    Bibtex.entries, ()))
+TYPES = tuple(entry.spec['type'] for entry in Bibtex.entries)
+if len(FIELDS) > 64:
+    raise ValueError('{} entry fields do not fit the 64 field flags of a'
+                     ' record'.format(len(FIELDS)))
+
+# record length, entry type, number of extra fields and field flags
+_header = struct.Struct('<IBBQ')
+_length = struct.Struct('<I')
+# fields of the flag sets met so far, a handful in practice
+_flagged = {}
+_arxiv_id = re.compile(r'^(?:([a-z-]+(?:\.[A-Z]{2})?)/?)?(\d{4})(?:[.\d]|$)')
+_doi_url = re.compile(r'^https?://(?:dx\.)?doi\.org/', re.IGNORECASE)
+
+
+def shard_of(paper):
+    """
+    segment shard of a paper: the year and month prefix of its arXiv id
+
+    >>> shard_of('1501.00001'), shard_of('hep-th/9901001v2')
+    ('1501', 'hep-th-9901')
+    >>> shard_of('notes')
+    'misc'
+    """
+    match = _arxiv_id.match(paper)
+    if match is None:
+        return 'misc'
+    return '-'.join(filter(None, match.groups()))
+
+
+def normalize_doi(doi):
+    """
+    >>> normalize_doi('http://dx.doi.org/10.1103/PhysRev.47.777')
+    '10.1103/physrev.47.777'
+    """
+    return _doi_url.sub('', doi.strip()).lower() if doi else None
+
+
+def _pack(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    value = str(value)
+    return _length.pack(len(value)) + value
+
+
+def encode(paper, entry):
+    """
+    Binary record of an entry: a header (length, type, extra count, field
+    flags) followed by the length-prefixed paper id, label, set fields (in
+    FIELDS order) and extra name/value pairs.
+
+    >>> from .bibliography import Article
+    >>> entry = Article(json={'title': 'Foo', 'year': '2013', 'eprint': 'x'},
+    ...                 label='foo13')
+    >>> paper, decoded = decode(encode('1501.00001', entry))
+    >>> paper, decoded.label, decoded['title'], decoded['eprint']
+    ('1501.00001', 'foo13', 'Foo', 'x')
+    """
+    flags, values = 0, []
+    for bit, field in enumerate(FIELDS):
+        value = entry._get(field)
+        if value:
+            flags |= 1 << bit
+            values.append(_pack(value))
+    extra = [(name, value) for name, value in entry._extra.items() if value]
+    body = ''.join(chain([_pack(paper), _pack(entry.label or '')], values,
+                         (_pack(name) + _pack(value)
+                          for name, value in extra)))
+    kind = TYPES.index(entry.spec['type']) if entry.spec['type'] in TYPES \
+        else TYPES.index(Misc.spec['type'])
+    return _header.pack(len(body), kind, len(extra), flags) + body
+
+
+def decode(record):
+    """ (paper, entry) of a binary record """
+    _, kind, extras, flags = _header.unpack_from(record)
+    position = _header.size
+
+    def read():
+        size = _length.unpack_from(record, position)[0]
+        return record[position + _length.size:position + _length.size + size]
+
+    values = []
+    fields = _flagged.get(flags)
+    if fields is None:
+        fields = _flagged[flags] = [field for bit, field in enumerate(FIELDS)
+                                    if flags >> bit & 1]
+    for _ in xrange(2 + len(fields) + 2 * extras):
+        values.append(read())
+        position += _length.size + len(values[-1])
+    paper, label = values[:2]
+    json = dict(zip(fields, values[2:2 + len(fields)]))
+    extra = values[2 + len(fields):]
+    json.update(zip(extra[::2], extra[1::2]))
+    return (paper, Bibtex.entry(TYPES[kind], label or None, json))
+
+
+class EntryStore(object):
+    """
+    Resolved entries of each paper, appended as binary records to segment
+    files sharded by arXiv id prefix (`segments/<shard>/<number>.seg`).
+    A SQLite index maps papers, DOIs, labels and entry types to the record
+    locations, so lookups only read the matching records.
+    Storing a paper again appends its new records and repoints the index;
+    the previous records are left in place.
+
+    >>> import shutil, tempfile
+    >>> from .bibliography import Article
+    >>> directory = tempfile.mkdtemp()
+    >>> store = EntryStore(directory)
+    >>> store.put('1501.00001', [Article(label='foo', json={
+    ...     'title': 'Foo', 'doi': '10.1/FOO'})])
+    >>> [entry.label for entry in store.get('1501.00001')]
+    ['foo']
+    >>> [(paper, entry['title']) for paper, entry in store.by_doi('10.1/foo')]
+    [('1501.00001', 'Foo')]
+    >>> len(store), len(store.by_type('article')), store.by_label('bar')
+    (1, 1, [])
+    >>> [(paper, entry.label) for paper, entry in store]
+    [('1501.00001', 'foo')]
+    >>> store.close(); shutil.rmtree(directory)
+    """
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        if not os.path.isdir(os.path.join(directory, SEGMENTS)):
+            os.makedirs(os.path.join(directory, SEGMENTS))
+        self._readers = {}
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(directory, INDEX),
+                                           check_same_thread=False)
+        self._connection.text_factory = str
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                ' paper TEXT,'
+                ' position INTEGER,'
+                ' label TEXT,'
+                ' type TEXT,'
+                ' doi TEXT,'
+                ' segment TEXT,'
+                ' offset INTEGER,'
+                ' length INTEGER,'
+                ' PRIMARY KEY (paper, position))')
+            for column in ('label', 'type', 'doi'):
+                self._connection.execute(
+                    'CREATE INDEX IF NOT EXISTS entries_{0}'
+                    ' ON entries ({0})'.format(column))
+
+    def _segment(self, shard):
+        """ segment of `shard` open for appends """
+        folder = os.path.join(self.directory, SEGMENTS, shard)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        numbers = sorted(int(name[:-len('.seg')])
+                         for name in os.listdir(folder)
+                         if name.endswith('.seg'))
+        number = numbers[-1] if numbers else 0
+        if numbers and os.path.getsize(os.path.join(
+                folder, '{:06d}.seg'.format(number))) >= self.segment_size:
+            number += 1
+        return os.path.join(shard, '{:06d}.seg'.format(number))
+
+    def put(self, paper, entries):
+        """ store the entries of a paper, replacing the previous ones """
+        self.put_many([(paper, entries)])
+
+    def put_many(self, papers):
+        """
+        store `(paper, entries)` pairs in bulk: records are appended shard by
+        shard and the index is updated in a single transaction
+        """
+        writers, rows = {}, []
+        try:
+            for paper, entries in papers:
+                shard = shard_of(paper)
+                if shard not in writers:
+                    segment = self._segment(shard)
+                    writers[shard] = (segment, open(os.path.join(
+                        self.directory, SEGMENTS, segment), 'ab'))
+                    # append mode does not position the file at its end
+                    writers[shard][1].seek(0, os.SEEK_END)
+                segment, output = writers[shard]
+                rows.append((paper, None))
+                for position, entry in enumerate(entries):
+                    record = encode(paper, entry)
+                    offset = output.tell()
+                    output.write(record)
+                    rows.append((paper, (position, entry.label,
+                                         entry.spec['type'],
+                                         normalize_doi(entry._get('doi')),
+                                         segment, offset, len(record))))
+                if output.tell() >= self.segment_size:
+                    output.close()
+                    del writers[shard]
+        finally:
+            for _, output in writers.values():
+                output.close()
+        with self._lock:
+            with self._connection:
+                for paper, row in rows:
+                    if row is None:
+                        self._connection.execute(
+                            'DELETE FROM entries WHERE paper = ?', (paper,))
+                    else:
+                        self._connection.execute(
+                            'INSERT INTO entries VALUES'
+                            ' (?, ?, ?, ?, ?, ?, ?, ?)', (paper,) + row)
+
+    def _read(self, segment, offset, length):
+        reader = self._readers.get(segment)
+        if reader is None:
+            reader = self._readers[segment] = open(
+                os.path.join(self.directory, SEGMENTS, segment), 'rb')
+        reader.seek(offset)
+        return reader.read(length)
+
+    def _lookup(self, condition, value):
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT segment, offset, length FROM entries'
+                ' WHERE {} = ? ORDER BY paper, position'.format(condition),
+                (value,)).fetchall()
+            return [decode(self._read(*row)) for row in rows]
+
+    def get(self, paper):
+        """ entries of a paper, in their bibliography order """
+        return [entry for _, entry in self._lookup('paper', paper)]
+
+    def by_doi(self, doi):
+        """ (paper, entry) pairs citing `doi` """
+        return self._lookup('doi', normalize_doi(doi))
+
+    def by_label(self, label):
+        return self._lookup('label', label)
+
+    def by_type(self, kind):
+        return self._lookup('type', kind.lower())
+
+    def __iter__(self):
+        """
+        (paper, entry) of every stored entry, by paper: locations are read
+        from the index `EXPORT_BATCH` at a time
+        """
+        last = ('', -1)
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    'SELECT paper, position, segment, offset, length'
+                    ' FROM entries WHERE paper > ? OR paper = ? AND'
+                    ' position > ? ORDER BY paper, position LIMIT ?',
+                    (last[0], last[0], last[1], EXPORT_BATCH)).fetchall()
+                records = [decode(self._read(*row[2:])) for row in rows]
+            for record in records:
+                yield record
+            if len(rows) < EXPORT_BATCH:
+                return
+            last = rows[-1][:2]
+
+    def papers(self):
+        with self._lock:
+            return [paper for paper, in self._connection.execute(
+                'SELECT DISTINCT paper FROM entries ORDER BY paper')]
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            for reader in self._readers.values():
+                reader.close()
+            self._readers.clear()
+            self._connection.close()
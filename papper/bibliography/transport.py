@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+""" rate limiting, retries and circuit breaking of resolution requests """
+
+import random
+import threading
+import time
+
+from .lazy import LazyModule
+
+
+requests = LazyModule('requests')
+
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (3.05, 10.)
+DEFAULT_RETRIES = 3
+# backoff before the n-th retry is drawn in [0, min(cap, base * 2 ** n)]
+DEFAULT_BACKOFF = 0.5
+DEFAULT_BACKOFF_CAP = 10.
+# requests per second and per host
+DEFAULT_RATE = 20.
+DEFAULT_MIN_RATE = 0.5
+# consecutive failed calls opening the circuit, and seconds it stays open
+DEFAULT_FAILURES = 5
+DEFAULT_COOLDOWN = 30.
+
+THROTTLING_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class CircuitOpenError(IOError):
+    """
+    raised instead of calling a host deemed unhealthy; like the requests
+    exceptions it is an IOError, without requiring requests to be loaded
+    """
+
+
+def retry_after(response):
+    """
+    Delay (in seconds) requested by a Retry-After header, None if missing.
+
+    >>> class Response(object):
+    ...     def __init__(self, value):
+    ...         self.headers = {'Retry-After': value}
+    >>> retry_after(Response('7'))
+    7.0
+    >>> retry_after(Response('Thu, 01 Jan 1970 00:00:00 GMT'))
+    0.0
+    >>> retry_after(Response('soon')) is None
+    True
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        # email pulls in socket and ssl: only loaded for HTTP dates
+        from email.utils import mktime_tz, parsedate_tz
+        date = parsedate_tz(value)
+        return max(0., mktime_tz(date) - time.time()) if date else None
+
+
+class TokenBucket(object):
+    """
+    Token bucket whose rate adapts to the upstream: it is halved when the
+    host throttles us (additive increase, multiplicative decrease) and no
+    token is handed out before a Retry-After delay expires.
+
+    >>> bucket = TokenBucket(rate=10., burst=2)
+    >>> bucket.throttle()
+    >>> bucket.rate
+    5.0
+    >>> for _ in range(3):
+    ...     bucket.recover()
+    >>> bucket.rate
+    6.5
+    """
+    def __init__(self, rate=DEFAULT_RATE, burst=None,
+                 min_rate=DEFAULT_MIN_RATE, increase=0.5):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.burst = burst or max(1., rate)
+        self.increase = increase
+        self.tokens = self.burst
+        self.blocked_until = 0.
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """ block until a request may be sent """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1.:
+                    self.tokens -= 1.
+                    return
+                wait = max(self.blocked_until - now,
+                           (1. - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def throttle(self, delay=None):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2.)
+            if delay:
+                self.blocked_until = max(self.blocked_until,
+                                         time.time() + delay)
+
+    def recover(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class CircuitBreaker(object):
+    """
+    Closed while calls succeed, open (calls are refused) for `cooldown`
+    seconds after `failures` consecutive failures, then half-open: a single
+    trial call decides whether it closes again.
+
+    >>> breaker = CircuitBreaker(failures=2, cooldown=60.)
+    >>> breaker.failure(); breaker.allow()
+    True
+    >>> breaker.failure(); breaker.allow()
+    False
+    >>> breaker.opened_at -= 60.
+    >>> breaker.allow(), breaker.allow()
+    (True, False)
+    >>> breaker.success(); breaker.allow()
+    True
+    """
+    def __init__(self, failures=DEFAULT_FAILURES, cooldown=DEFAULT_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.consecutive = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial or time.time() - self.opened_at < self.cooldown:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.consecutive = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.consecutive += 1
+            if self._trial or self.consecutive >= self.failures:
+                self.opened_at = time.time()
+            self._trial = False
+
+
+class Transport(object):
+    """
+    Send policy shared by the resolution workers: per-host adaptive rate
+    limit and circuit breaker, per-request timeouts and bounded retries with
+    jittered exponential backoff on timeouts, connection errors and
+    throttling (429/5xx) responses.
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 rate=DEFAULT_RATE, backoff=DEFAULT_BACKOFF,
+                 backoff_cap=DEFAULT_BACKOFF_CAP, failures=DEFAULT_FAILURES,
+                 cooldown=DEFAULT_COOLDOWN):
+        self.timeout = timeout
+        self.retries = retries
+        self.rate = rate
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.failures = failures
+        self.cooldown = cooldown
+        self._buckets = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, host):
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(rate=self.rate)
+            return self._buckets[host]
+
+    def breaker(self, host):
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(
+                    failures=self.failures, cooldown=self.cooldown)
+            return self._breakers[host]
+
+    def delay(self, attempt):
+        return random.uniform(0., min(self.backoff_cap,
+                                      self.backoff * 2 ** attempt))
+
+    def send(self, host, request, slot=None, **kwargs):
+        """
+        Call `request(**kwargs)` (adding the timeout) against `host`. Once
+        retries are exhausted, the last transport error, or an HTTPError
+        for a last response still throttled, is raised. Other errors are
+        raised right away; every failure counts for the circuit breaker.
+        A `slot` (a semaphore bounding the requests to the host) is only
+        held by each attempt, not while waiting for a token or backing off.
+        """
+        breaker = self.breaker(host)
+        if not breaker.allow():
+            raise CircuitOpenError('circuit open for {}'.format(host))
+        bucket = self.bucket(host)
+        kwargs.setdefault('timeout', self.timeout)
+        response, error = None, None
+        for attempt in xrange(self.retries + 1):
+            if attempt:
+                time.sleep(self.delay(attempt - 1))
+            bucket.acquire()
+            if slot is not None:
+                slot.acquire()
+            try:
+                response = request(**kwargs)
+            except (requests.Timeout, requests.ConnectionError) as failure:
+                response, error = None, failure
+                continue
+            except Exception:
+                # not retried, but still a failed call (a half-open
+                # trial included)
+                breaker.failure()
+                raise
+            finally:
+                if slot is not None:
+                    slot.release()
+            if response.status_code not in THROTTLING_STATUSES:
+                bucket.recover()
+                breaker.success()
+                return response
+            bucket.throttle(retry_after(response))
+        breaker.failure()
+        if response is None:
+            raise error
+        response.raise_for_status()
+        return response
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+""" long-lived worker resolving the papers read from a stream """
+
+import json
+import os
+import time
+
+from .bbl2bib import iter_bib, PooledSession, DEFAULT_WORKERS, \
+    DEFAULT_PER_HOST
+from .metrics import NULL_METRICS
+from .server import to_json
+from .sources import is_archive
+from .transport import Transport
+
+
+def parse_job(line):
+    """
+    Job of an input line: a JSON object with at least a 'path' (and
+    optionally an 'id', an 'output' bibtex file and a 'format', 'json' or
+    'bibtex'), or the bare path of a paper.
+
+    >>> parse_job('papers/1501.00001.tar.gz\\n')
+    {'path': 'papers/1501.00001.tar.gz'}
+    >>> job = parse_job('{"path": "papers/1501.00002", "id": 7}')
+    >>> job['path'], job['id']
+    ('papers/1501.00002', 7)
+    """
+    line = line.strip()
+    if line.startswith('{'):
+        job = json.loads(line)
+        if not isinstance(job, dict) or not job.get('path'):
+            raise ValueError('job without a paper path')
+        # paths are handled as bytes, like the ones of the command line
+        for key in ('path', 'output'):
+            if isinstance(job.get(key), unicode):
+                job[key] = job[key].encode('utf-8')
+        return job
+    return {'path': line}
+
+
+def _input(path):
+    if os.path.isfile(path) and not is_archive(path):
+        return os.path.dirname(path)
+    return path
+
+
+def run_job(job, **options):
+    """ result of a job, with the entries of its paper """
+    if not os.path.exists(job['path']):
+        raise IOError('paper not found: {}'.format(job['path']))
+    entries = list(iter_bib(_input(job['path']), **options))
+    result = {'count': len(entries)}
+    if job.get('output'):
+        with open(job['output'], 'w') as output:
+            output.write(''.join(entry + '\n' for entry in entries))
+        result['output'] = job['output']
+    elif job.get('format') == 'bibtex':
+        result['bibtex'] = '\n'.join(entries) + '\n' if entries else ''
+    else:
+        result['entries'] = to_json(entries)
+    return result
+
+
+def run_worker(jobs, output, workers=DEFAULT_WORKERS,
+               per_host=DEFAULT_PER_HOST, transport=None, metrics=None,
+               **options):
+    """
+    Resolve the paper of each line of `jobs` (see parse_job) and write one
+    JSON result per line to `output`, flushed as soon as the paper is done.
+    A single pooled session (hence its open connections), along with the
+    cache, index and near-duplicates of `options`, is shared by every job.
+    Failed jobs are reported with an 'error' and do not stop the worker.
+    Returns the number of jobs processed.
+    """
+    metrics = metrics or NULL_METRICS
+    transport = transport or Transport()
+    session = PooledSession(workers=workers, per_host=per_host,
+                            transport=transport)
+    count = 0
+    try:
+        for line in iter(jobs.readline, ''):
+            if not line.strip():
+                continue
+            start = time.time()
+            job = {}
+            try:
+                job = parse_job(line)
+                result = run_job(job, workers=workers, per_host=per_host,
+                                 session=session, metrics=metrics,
+                                 transport=transport, **options)
+                metrics.count('worker_jobs')
+            except Exception as error:
+                metrics.count('worker_errors')
+                result = {'error': '{}: {}'.format(type(error).__name__,
+                                                   error)}
+            result.update((key, job[key]) for key in ('id', 'path')
+                          if key in job)
+            result['seconds'] = round(time.time() - start, 3)
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            count += 1
+    finally:
+        session.close()
+    return count